@@ -0,0 +1,230 @@
+import argparse
+import glob
+import os
+from collections import defaultdict, deque
+from utils.event_trace import EventTrace
+
+NS = 1_000_000_000
+
+
+def load_traces(directory):
+    # Merges every peer's trace into one time-ordered list of
+    # (time_ns, peer_id, event, remote_peer_id, piece_index, value).
+    events = []
+    paths = sorted(glob.glob(os.path.join(directory, "peer_*", "trace_peer_*.bin")))
+    for path in paths:
+        peer_id, records = EventTrace.read_trace(path)
+        events.extend(
+            (time_ns, peer_id, event, remote, piece, value)
+            for time_ns, event, remote, piece, value in records
+        )
+    events.sort()
+    return paths, events
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report_summary(events, t0):
+    print("Per-peer summary")
+    stats = defaultdict(lambda: {"received": 0, "sent": 0, "pieces": 0, "start": None, "done": None})
+    for time_ns, peer_id, event, remote, piece, value in events:
+        peer = stats[peer_id]
+        if event == EventTrace.START and peer["start"] is None:
+            peer["start"] = time_ns
+        elif event == EventTrace.PIECE_RECEIVED:
+            peer["received"] += value
+            peer["pieces"] += 1
+        elif event == EventTrace.PIECE_SENT:
+            peer["sent"] += value
+        elif event == EventTrace.DOWNLOAD_COMPLETE:
+            peer["done"] = time_ns
+    print(f"{'peer':>6} {'start (s)':>10} {'done (s)':>10} {'recv MiB':>10} {'sent MiB':>10} {'recv MiB/s':>11}")
+    for peer_id in sorted(stats):
+        peer = stats[peer_id]
+        start = (peer["start"] or t0) - t0
+        done = peer["done"] - t0 if peer["done"] else None
+        duration = (done - start) / NS if done is not None and done > start else None
+        rate = peer["received"] / duration / (1 << 20) if duration else 0.0
+        print(
+            f"{peer_id:>6} {start / NS:>10.3f} "
+            f"{(f'{done / NS:.3f}' if done is not None else '-'):>10} "
+            f"{peer['received'] / (1 << 20):>10.2f} {peer['sent'] / (1 << 20):>10.2f} {rate:>11.2f}"
+        )
+    print()
+
+
+def report_throughput(events, t0, bucket):
+    print(f"Download throughput over time (MiB/s, {bucket:g}s buckets)")
+    received = defaultdict(lambda: defaultdict(int))
+    last_bucket = 0
+    for time_ns, peer_id, event, remote, piece, value in events:
+        if event == EventTrace.PIECE_RECEIVED:
+            index = int((time_ns - t0) / NS / bucket)
+            received[peer_id][index] += value
+            last_bucket = max(last_bucket, index)
+    peers = sorted(received)
+    if not peers:
+        print("  no pieces received\n")
+        return
+    print(f"{'t (s)':>8} " + " ".join(f"{peer_id:>8}" for peer_id in peers))
+    for index in range(last_bucket + 1):
+        rates = [received[peer_id][index] / bucket / (1 << 20) for peer_id in peers]
+        print(f"{index * bucket:>8.2f} " + " ".join(f"{rate:>8.2f}" for rate in rates))
+    print()
+
+
+def report_request_latency(events):
+    print("Request-to-piece latency")
+    outstanding = defaultdict(deque)
+    latencies = []
+    for time_ns, peer_id, event, remote, piece, value in events:
+        if event == EventTrace.REQUEST_SENT:
+            outstanding[(peer_id, remote, piece)].append(time_ns)
+        elif event == EventTrace.PIECE_RECEIVED:
+            requests = outstanding.get((peer_id, remote, piece))
+            if requests:
+                latencies.append((time_ns - requests.popleft()) / 1e6)
+        elif event in (EventTrace.CHOKED, EventTrace.DISCONNECT):
+            # Requests outstanding at a choke or disconnect are never answered.
+            for key in [key for key in outstanding if key[0] == peer_id and key[1] == remote]:
+                del outstanding[key]
+    if not latencies:
+        print("  no matched requests\n")
+        return
+    print(
+        f"  {len(latencies)} requests: p50 {percentile(latencies, 0.5):.2f} ms, "
+        f"p90 {percentile(latencies, 0.9):.2f} ms, p99 {percentile(latencies, 0.99):.2f} ms, "
+        f"max {max(latencies):.2f} ms"
+    )
+    histogram = defaultdict(int)
+    for latency in latencies:
+        upper = 1.0
+        while latency >= upper:
+            upper *= 2
+        histogram[upper] += 1
+    widest = max(histogram.values())
+    for upper in sorted(histogram):
+        count = histogram[upper]
+        bar = "#" * max(1, round(40 * count / widest))
+        print(f"  < {upper:>8g} ms {count:>7} {bar}")
+    print()
+
+
+def report_propagation(events):
+    print("Piece propagation (first upload of a piece to its completion on each peer)")
+    first_sent = {}
+    completions = defaultdict(list)
+    for time_ns, peer_id, event, remote, piece, value in events:
+        if event == EventTrace.PIECE_SENT and piece not in first_sent:
+            first_sent[piece] = time_ns
+        elif event == EventTrace.PIECE_COMPLETED:
+            completions[piece].append(time_ns)
+    per_hop = []
+    to_half = []
+    to_all = []
+    for piece, times in completions.items():
+        origin = first_sent.get(piece)
+        if origin is None:
+            continue
+        times = sorted(times)
+        per_hop.extend((t - origin) / 1e6 for t in times)
+        to_half.append((times[(len(times) - 1) // 2] - origin) / 1e6)
+        to_all.append((times[-1] - origin) / 1e6)
+    if not to_all:
+        print("  no completed pieces\n")
+        return
+    for label, values in (
+        ("each downloader", per_hop),
+        ("half of downloaders", to_half),
+        ("all downloaders", to_all),
+    ):
+        print(
+            f"  to {label:<20} p50 {percentile(values, 0.5):>9.2f} ms  "
+            f"p90 {percentile(values, 0.9):>9.2f} ms  max {max(values):>9.2f} ms"
+        )
+    print()
+
+
+def report_critical_path(events, t0):
+    print("Critical path to swarm completion")
+    done = [(time_ns, peer_id) for time_ns, peer_id, event, *_ in events if event == EventTrace.DOWNLOAD_COMPLETE]
+    if not done:
+        print("  no peer completed\n")
+        return
+    finish_ns, peer_id = max(done)
+    completed = {}
+    received = {}
+    requested = defaultdict(list)
+    for time_ns, pid, event, remote, piece, value in events:
+        if event == EventTrace.PIECE_COMPLETED:
+            completed.setdefault((pid, piece), (time_ns, remote))
+        elif event == EventTrace.PIECE_RECEIVED:
+            received.setdefault((pid, remote, piece), time_ns)
+        elif event == EventTrace.REQUEST_SENT:
+            requested[(pid, remote, piece)].append(time_ns)
+    # The piece that completed last on the last peer gated the swarm; follow
+    # it back through the peers it was relayed by.
+    last_piece = max(
+        ((time_ns, piece) for (pid, piece), (time_ns, _) in completed.items() if pid == peer_id),
+        default=None,
+    )
+    if last_piece is None:
+        print(f"  Peer {peer_id} completed without downloading\n")
+        return
+    piece = last_piece[1]
+    print(f"  swarm complete at {(finish_ns - t0) / NS:.3f}s on Peer {peer_id}, gated by piece {piece}")
+    hops = []
+    seen = set()
+    while (peer_id, piece) in completed and peer_id not in seen:
+        seen.add(peer_id)
+        time_ns, source = completed[(peer_id, piece)]
+        request_times = [t for t in requested.get((peer_id, source, piece), []) if t <= time_ns]
+        hops.append(
+            (
+                peer_id,
+                source,
+                request_times[-1] if request_times else None,
+                received.get((peer_id, source, piece)),
+                time_ns,
+            )
+        )
+        peer_id = source
+    print(f"  piece {piece} originates at Peer {peer_id}")
+    for pid, source, request_ns, receive_ns, complete_ns in reversed(hops):
+        fmt = lambda t: f"{(t - t0) / NS:.3f}s" if t is not None else "-"
+        print(
+            f"  Peer {source} -> Peer {pid}: requested {fmt(request_ns)}, "
+            f"received {fmt(receive_ns)}, completed {fmt(complete_ns)}"
+        )
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge peer_*/trace_peer_*.bin event traces and summarize the run."
+    )
+    parser.add_argument("directory", nargs="?", default=".")
+    parser.add_argument("--bucket", type=float, default=1.0, help="throughput bucket in seconds")
+    args = parser.parse_args()
+
+    paths, events = load_traces(args.directory)
+    if not events:
+        print(f"No trace records found under {args.directory}. Enable EventTrace in Common.cfg.")
+        return
+    t0 = events[0][0]
+    duration = (events[-1][0] - t0) / NS
+    print(f"{len(events)} events from {len(paths)} peers over {duration:.3f}s\n")
+    report_summary(events, t0)
+    report_throughput(events, t0, args.bucket)
+    report_request_latency(events)
+    report_propagation(events)
+    report_critical_path(events, t0)
+
+
+if __name__ == "__main__":
+    main()
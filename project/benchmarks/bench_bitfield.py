@@ -0,0 +1,124 @@
+import argparse
+import random
+import sys
+import timeit
+from utils.bitfield import BitField
+
+
+def list_is_interested(theirs, mine):
+    for i in range(len(theirs)):
+        if theirs[i] == 1 and mine[i] == 0:
+            return True
+    return False
+
+
+def list_first_missing(bits):
+    try:
+        return bits.index(0)
+    except ValueError:
+        return -1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare list-of-int bitfields with the packed BitField, and its wire encodings."
+    )
+    parser.add_argument("--pieces", type=int, default=100_000)
+    parser.add_argument("--fill", type=float, default=0.9)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(1)
+    n = args.pieces
+    mine_list = [1 if random.random() < args.fill else 0 for _ in range(n)]
+    theirs_list = list(mine_list)
+    # The only piece the remote has that we lack sits at the very end, so the
+    # interest check has to look at the whole bitfield.
+    mine_list[-1] = 0
+    theirs_list[-1] = 1
+    wire = bytes(theirs_list)
+    mine = BitField.from_unpacked_bytes(bytes(mine_list), n)
+    almost_done_list = [1] * (n - 1) + [0]
+    almost_done = BitField(n, complete=True)
+    almost_done.clear(n - 1)
+    theirs = BitField.from_unpacked_bytes(wire, n)
+
+    cases = [
+        (
+            "interested (and-not)",
+            lambda: list_is_interested(theirs_list, mine_list),
+            lambda: theirs.any_and_not(mine),
+        ),
+        (
+            "pieces they have I lack",
+            lambda: [i for i in range(n) if theirs_list[i] == 1 and mine_list[i] == 0],
+            lambda: list(theirs.and_not(mine).iter_set()),
+        ),
+        ("popcount", lambda: sum(mine_list), lambda: mine.popcount()),
+        (
+            "first missing",
+            lambda: list_first_missing(almost_done_list),
+            lambda: almost_done.first_missing(),
+        ),
+        (
+            "iterate set bits",
+            lambda: [i for i, bit in enumerate(mine_list) if bit == 1],
+            lambda: list(mine.iter_set()),
+        ),
+        (
+            "set + test every piece",
+            lambda: [mine_list.__setitem__(i, mine_list[i]) for i in range(n)],
+            lambda: [mine.set(i) for i in range(n) if not mine.test(i)],
+        ),
+        (
+            "decode BITFIELD payload",
+            lambda: list(wire),
+            lambda: BitField.from_unpacked_bytes(wire, n),
+        ),
+    ]
+
+    print(f"{n} pieces, {args.repeat} repetitions")
+    print(f"{'operation':<26} {'list (ms)':>11} {'BitField (ms)':>14} {'speedup':>9}")
+    for name, list_op, bitfield_op in cases:
+        list_time = min(timeit.repeat(list_op, number=1, repeat=args.repeat)) * 1000
+        bitfield_time = min(timeit.repeat(bitfield_op, number=1, repeat=args.repeat)) * 1000
+        print(
+            f"{name:<26} {list_time:>11.3f} {bitfield_time:>14.3f} {list_time / max(bitfield_time, 1e-9):>8.1f}x"
+        )
+    list_bytes = sys.getsizeof(mine_list)
+    bitfield_bytes = sys.getsizeof(mine.bits)
+    print(f"{'memory (bytes)':<26} {list_bytes:>11} {bitfield_bytes:>14} {list_bytes / bitfield_bytes:>8.1f}x")
+
+    # Wire encodings of a BITFIELD: size, and time to encode plus decode.
+    # Run lengths are capped at the packed size, as when sending; a busy
+    # bitfield falls back to packed.
+    encodings = [
+        ("unpacked", BitField.to_unpacked_bytes, BitField.from_unpacked_bytes),
+        ("packed", BitField.to_bytes, BitField.from_bytes),
+        (
+            "run-length",
+            lambda bitfield: bitfield.to_rle_bytes(len(bitfield.bits)),
+            BitField.from_rle_bytes,
+        ),
+    ]
+    print()
+    print(f"{'bitfield':<16} {'encoding':<11} {'bytes':>9} {'encode+decode (ms)':>19}")
+    for label, fill in (("nearly empty", 0.001), ("half, random", 0.5), ("nearly full", 0.999)):
+        bitfield = BitField(n)
+        for i in range(n):
+            if random.random() < fill:
+                bitfield.set(i)
+        for name, encode, decode in encodings:
+            data = encode(bitfield)
+            if data is None:
+                elapsed = min(timeit.repeat(lambda: encode(bitfield), number=1, repeat=args.repeat)) * 1000
+                print(f"{label:<16} {name:<11} {'(packed)':>9} {elapsed:>19.3f}")
+                continue
+            assert decode(data, n) == bitfield
+            elapsed = min(
+                timeit.repeat(lambda: decode(encode(bitfield), n), number=1, repeat=args.repeat)
+            ) * 1000
+            print(f"{label:<16} {name:<11} {len(data):>9} {elapsed:>19.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import logging
+import timeit
+from utils.message import Message, Have, Request, Piece
+
+
+# The codec before the struct rewrite: int.to_bytes per field, a debug log
+# call per message, and REQUEST/PIECE bodies framed a second time inside the
+# outer message.
+def legacy_create_message(msg_type, payload=b""):
+    length = len(payload) + 1
+    message = length.to_bytes(4, "big") + msg_type.to_bytes(1, "big") + payload
+    logging.debug(
+        f"Created message: type={msg_type}, length={length}, payload_length={len(payload)}"
+    )
+    return message
+
+
+def legacy_have(piece_index):
+    return legacy_create_message(Message.HAVE, piece_index.to_bytes(4, "big"))
+
+
+def legacy_request(piece_index, begin, length):
+    inner = legacy_create_message(
+        Message.REQUEST,
+        b"\x06" + piece_index.to_bytes(4, "big") + begin.to_bytes(4, "big") + length.to_bytes(4, "big"),
+    )
+    return legacy_create_message(Message.REQUEST, inner)
+
+
+def legacy_piece(piece_index, data, begin):
+    inner = legacy_create_message(
+        Message.PIECE, piece_index.to_bytes(4, "big") + begin.to_bytes(4, "big") + data
+    )
+    return legacy_create_message(Message.PIECE, inner)
+
+
+def legacy_decode(stream, parse):
+    # One message at a time: read the length, slice the frame, parse it.
+    view = memoryview(stream)
+    start = 0
+    while start < len(stream):
+        length = int.from_bytes(view[start : start + 4], "big")
+        msg_type = view[start + 4]
+        parse(msg_type, view[start + 5 : start + 4 + length])
+        start += 4 + length
+
+
+def legacy_parse_have(msg_type, payload):
+    return int.from_bytes(payload[:4], "big")
+
+
+def legacy_parse_request(msg_type, payload):
+    return (
+        int.from_bytes(payload[7:10], "big"),
+        int.from_bytes(payload[10:14], "big"),
+        int.from_bytes(payload[14:18], "big"),
+    )
+
+
+def legacy_parse_piece(msg_type, payload):
+    return int.from_bytes(payload[6:9], "big"), int.from_bytes(payload[9:13], "big"), payload[13:]
+
+
+def batch_decode(stream, parse):
+    for msg_type, payload, _ in Message.iter_messages(stream):
+        parse(payload)
+
+
+def pack_requests(blocks):
+    buffer = bytearray(Request.SIZE * len(blocks))
+    offset = 0
+    for piece_index, begin, length in blocks:
+        offset = Request.pack_into(buffer, offset, piece_index, begin, length)
+    return buffer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the old message codec with the struct codec and batch decoding."
+    )
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--block-size", type=int, default=16384)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    n = args.messages
+    block = bytes(args.block_size)
+    blocks = [(i, (i % 16) * args.block_size, args.block_size) for i in range(n)]
+    have_stream = b"".join(Have.create(i) for i in range(n))
+    request_stream = bytes(pack_requests(blocks))
+    piece_stream = b"".join(Piece.create(i, block, begin) for i, begin, _ in blocks)
+    legacy_have_stream = b"".join(legacy_have(i) for i in range(n))
+    legacy_request_stream = b"".join(legacy_request(*b) for b in blocks)
+    legacy_piece_stream = b"".join(legacy_piece(i, block, begin) for i, begin, _ in blocks)
+
+    cases = [
+        (
+            "HAVE encode",
+            lambda: [legacy_have(i) for i in range(n)],
+            lambda: [Have.create(i) for i in range(n)],
+        ),
+        (
+            "REQUEST encode",
+            lambda: [legacy_request(*b) for b in blocks],
+            lambda: [Request.create(*b) for b in blocks],
+        ),
+        (
+            "REQUEST encode, batch",
+            lambda: b"".join(legacy_request(*b) for b in blocks),
+            lambda: pack_requests(blocks),
+        ),
+        (
+            f"PIECE {args.block_size // 1024}KB encode",
+            lambda: [legacy_piece(i, block, begin) for i, begin, _ in blocks],
+            lambda: [Piece.create(i, block, begin) for i, begin, _ in blocks],
+        ),
+        (
+            "HAVE decode",
+            lambda: legacy_decode(legacy_have_stream, legacy_parse_have),
+            lambda: batch_decode(have_stream, Have.parse_payload),
+        ),
+        (
+            "REQUEST decode",
+            lambda: legacy_decode(legacy_request_stream, legacy_parse_request),
+            lambda: batch_decode(request_stream, Request.parse_payload),
+        ),
+        (
+            f"PIECE {args.block_size // 1024}KB decode",
+            lambda: legacy_decode(legacy_piece_stream, legacy_parse_piece),
+            lambda: batch_decode(piece_stream, Piece.parse_payload),
+        ),
+    ]
+
+    print(f"{n} messages per run, best of {args.repeat}")
+    print(f"{'operation':<24} {'old (msg/s)':>13} {'struct (msg/s)':>15} {'speedup':>9}")
+    for name, old_op, new_op in cases:
+        old_time = min(timeit.repeat(old_op, number=1, repeat=args.repeat))
+        new_time = min(timeit.repeat(new_op, number=1, repeat=args.repeat))
+        print(
+            f"{name:<24} {n / old_time:>13,.0f} {n / new_time:>15,.0f} {old_time / new_time:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
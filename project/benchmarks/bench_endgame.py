@@ -0,0 +1,120 @@
+import argparse
+import os
+import signal
+import threading
+from benchmarks.swarm import Swarm
+from utils.event_trace import EventTrace
+
+
+class StallingSwarm(Swarm):
+    # Repeatedly freezes one leecher with SIGSTOP so that it behaves like a
+    # slow uploader: requests sent to it wait until it is resumed.
+    def __init__(self, *args, stall_peer=None, stall_on=1.0, stall_off=0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stall_peer = stall_peer
+        self.stall_on = stall_on
+        self.stall_off = stall_off
+        self.done = threading.Event()
+
+    def stall(self):
+        while not self.done.wait(self.stall_off):
+            process = self.processes.get(self.stall_peer)
+            if process is None or process.poll() is not None:
+                continue
+            process.send_signal(signal.SIGSTOP)
+            self.done.wait(self.stall_on)
+            process.send_signal(signal.SIGCONT)
+
+    def run(self, *args, **kwargs):
+        staller = threading.Thread(target=self.stall, daemon=True)
+        staller.start()
+        try:
+            return super().run(*args, **kwargs)
+        finally:
+            staller.join()
+
+    def stop(self):
+        self.done.set()
+        process = self.processes.get(self.stall_peer)
+        if process is not None and process.poll() is None:
+            process.send_signal(signal.SIGCONT)
+        super().stop()
+
+
+def completion_times(swarm, peer_id):
+    path = os.path.join(swarm.workdir, f"peer_{peer_id}", f"trace_peer_{peer_id}.bin")
+    try:
+        _, records = EventTrace.read_trace(path)
+    except (OSError, ValueError):
+        return []
+    return sorted(
+        time_ns / 1e9
+        for time_ns, event, remote, piece, value in records
+        if event == EventTrace.PIECE_COMPLETED
+    )
+
+
+def run_mode(endgame, args):
+    swarm = StallingSwarm(
+        args.peers,
+        args.file_size,
+        args.piece_size,
+        common_overrides={"Endgame": endgame, "EventTrace": 1, "FastResume": 0},
+        stall_on=args.stall_on,
+        stall_off=args.stall_off,
+    )
+    swarm.stall_peer = swarm.peer_ids[1]
+    try:
+        completed = swarm.run(timeout=args.timeout)
+        tails = []
+        for peer_id in swarm.peer_ids[1:]:
+            if peer_id == swarm.stall_peer:
+                continue
+            times = completion_times(swarm, peer_id)
+            if not times:
+                continue
+            # Time to fetch the last tail_fraction of the pieces.
+            start = times[min(len(times) - 1, int(len(times) * (1 - args.tail_fraction)))]
+            tails.append(times[-1] - start)
+        finished = [
+            seconds for peer_id, seconds in swarm.completed_at.items() if peer_id != swarm.stall_peer
+        ]
+        return {
+            "completed": completed,
+            "finish": max(finished, default=float("nan")),
+            "tail_mean": sum(tails) / len(tails) if tails else float("nan"),
+            "tail_max": max(tails, default=float("nan")),
+        }
+    finally:
+        swarm.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure download tail time with and without endgame mode while one peer stalls."
+    )
+    parser.add_argument("--peers", type=int, default=5)
+    parser.add_argument("--file-size", type=int, default=32 * 1024 * 1024)
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--stall-on", type=float, default=1.0, help="seconds the slow peer is frozen")
+    parser.add_argument("--stall-off", type=float, default=0.5, help="seconds it runs in between")
+    parser.add_argument("--tail-fraction", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    print(
+        f"{'endgame':<8} {'run':>4} {'done':>5} {'finish (s)':>11} "
+        f"{'tail mean (s)':>14} {'tail max (s)':>13}"
+    )
+    for endgame in (0, 1):
+        for run in range(args.runs):
+            result = run_mode(endgame, args)
+            print(
+                f"{('on' if endgame else 'off'):<8} {run + 1:>4} {str(result['completed']):>5} "
+                f"{result['finish']:>11.2f} {result['tail_mean']:>14.3f} {result['tail_max']:>13.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
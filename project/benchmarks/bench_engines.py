@@ -0,0 +1,48 @@
+import argparse
+from benchmarks.swarm import Swarm
+
+
+def run_engine(engine, args):
+    swarm = Swarm(args.peers, args.file_size, args.piece_size, peer_args=[engine])
+    try:
+        completed = swarm.run(timeout=args.timeout)
+        leechers = swarm.peer_ids[1:]
+        rss = [swarm.peak_rss_kb.get(peer_id, 0) for peer_id in swarm.peer_ids]
+        threads = [swarm.peak_threads.get(peer_id, 0) for peer_id in swarm.peer_ids]
+        return {
+            "engine": engine,
+            "completed": completed,
+            "completion_time": max(swarm.completed_at.values(), default=float("nan")),
+            "finished": f"{len(swarm.completed_at)}/{len(leechers)}",
+            "avg_rss_kb": sum(rss) / len(rss),
+            "max_rss_kb": max(rss),
+            "max_threads": max(threads),
+        }
+    finally:
+        swarm.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare swarm completion time and per-peer memory of the threaded and asyncio engines."
+    )
+    parser.add_argument("--peers", type=int, default=5)
+    parser.add_argument("--file-size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    print(
+        f"{'engine':<10} {'finished':>9} {'time (s)':>9} {'avg RSS (KiB)':>14} {'max RSS (KiB)':>14} {'threads':>8}"
+    )
+    for engine in args.engines:
+        result = run_engine(engine, args)
+        print(
+            f"{result['engine']:<10} {result['finished']:>9} {result['completion_time']:>9.2f} "
+            f"{result['avg_rss_kb']:>14.0f} {result['max_rss_kb']:>14} {result['max_threads']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
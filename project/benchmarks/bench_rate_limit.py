@@ -0,0 +1,135 @@
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import timeit
+from utils.connection import ConnectionManager
+from utils.log_manager import LogManager
+from utils.message import Message
+from utils.rate_limiter import RateLimiter
+
+PEER_ID = 1001
+
+
+def connect():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("localhost", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return conn, client
+
+
+def drain(conn, counts, index, stop):
+    buffer = bytearray(1024 * 1024)
+    while not stop.is_set():
+        try:
+            count = conn.recv_into(buffer)
+        except OSError:
+            return
+        if count == 0:
+            return
+        counts[index] += count
+
+
+def run_shaping(rate_limiter, peers, block_size, seconds):
+    # Every connection keeps its writer's queue full of PIECE data; the
+    # receivers count what actually arrives.
+    connections = []
+    counts = [0] * peers
+    stop = threading.Event()
+    payload = bytes(8 + block_size)
+    for index in range(peers):
+        conn, client = connect()
+        writer = ConnectionManager.attach_writer(
+            PEER_ID, PEER_ID + 1 + index, conn, "upload", 4 * block_size, rate_limiter
+        )
+        receiver = threading.Thread(target=drain, args=(client, counts, index, stop))
+        receiver.start()
+        connections.append((conn, client, writer, receiver))
+
+    def feed(index):
+        conn, _, writer, _ = connections[index]
+        while not stop.is_set():
+            ConnectionManager.send_message(PEER_ID, PEER_ID + 1 + index, conn, Message.PIECE, payload)
+            writer.wait_for_space(0.1)
+
+    feeders = [threading.Thread(target=feed, args=(index,)) for index in range(peers)]
+    for feeder in feeders:
+        feeder.start()
+    # Skip the initial burst, then measure.
+    time.sleep(0.5)
+    start_counts = list(counts)
+    start = time.perf_counter()
+    time.sleep(seconds)
+    rates = [(counts[i] - start_counts[i]) / (time.perf_counter() - start) for i in range(peers)]
+    stop.set()
+    for conn, client, _, receiver in connections:
+        ConnectionManager.release_writer(conn)
+        client.close()
+        receiver.join()
+        conn.close()
+    for feeder in feeders:
+        feeder.join()
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the token-bucket rate limiter's overhead and how evenly it shares a global limit."
+    )
+    parser.add_argument("--peers", type=int, default=4)
+    parser.add_argument("--block-size", type=int, default=16384)
+    parser.add_argument("--limit", type=float, default=8, help="global upload limit in MiB/s")
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--calls", type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f"{'reservation':<28} {'calls/s':>14}")
+    cases = (
+        ("no limit", RateLimiter()),
+        ("global limit", RateLimiter(upload_rate=10**12)),
+        ("global + per-peer limit", RateLimiter(upload_rate=10**12, peer_upload_rate=10**12)),
+    )
+    for name, rate_limiter in cases:
+        elapsed = min(
+            timeit.repeat(
+                lambda: rate_limiter.delay(RateLimiter.UPLOAD, 1002, args.block_size),
+                number=args.calls,
+                repeat=3,
+            )
+        )
+        print(f"{name:<28} {args.calls / elapsed:>14,.0f}")
+
+    workdir = tempfile.mkdtemp(prefix="p2p_rate_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        LogManager.start_logger(PEER_ID)
+        limit = args.limit * 1024 * 1024
+        print()
+        print(f"{args.peers} connections, {args.block_size}-byte PIECEs, {args.seconds:g} s")
+        print(f"{'limit':<14} {'total MiB/s':>12} {'per connection MiB/s':>32} {'fairness':>9}")
+        for name, rate_limiter in (
+            ("none", None),
+            (f"{args.limit:g} MiB/s", RateLimiter(upload_rate=limit)),
+        ):
+            rates = run_shaping(rate_limiter, args.peers, args.block_size, args.seconds)
+            # Jain's index: 1.0 when every connection gets the same rate.
+            fairness = sum(rates) ** 2 / (len(rates) * sum(rate * rate for rate in rates))
+            per_connection = " ".join(f"{rate / 1024 / 1024:.2f}" for rate in rates)
+            print(
+                f"{name:<14} {sum(rates) / 1024 / 1024:>12.2f} {per_connection:>32} {fairness:>9.3f}"
+            )
+    finally:
+        LogManager.close_all_loggers()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
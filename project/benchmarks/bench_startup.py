@@ -0,0 +1,124 @@
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.swarm import PEER_PROCESS, read_proc_status
+from utils.metainfo import Metainfo
+
+PEER_ID = 1001
+READY_MARKER = "Server listener started successfully."
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def write_file(path, size):
+    chunk = os.urandom(1 << 20)
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining > 0:
+            written = file.write(chunk[: min(remaining, len(chunk))])
+            remaining -= written
+
+
+def write_config(workdir, file_size, piece_size, overrides):
+    common = {
+        "NumberOfPreferredNeighbors": 3,
+        "UnchokingInterval": 5,
+        "OptimisticUnchokingInterval": 10,
+        "FileName": "TheFile.dat",
+        "FileSize": file_size,
+        "PieceSize": piece_size,
+        "MetainfoFile": "TheFile.dat.meta",
+    }
+    common.update(overrides)
+    with open(os.path.join(workdir, "Common.cfg"), "w") as file:
+        file.write("\n".join(f"{key} {value}" for key, value in common.items()))
+
+
+def time_startup(workdir, timeout):
+    # Seconds from launching the seeder until it is listening, and its peak RSS.
+    log_path = os.path.join(workdir, f"peer_{PEER_ID}", f"log_peer_{PEER_ID}.log")
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, PEER_PROCESS, str(PEER_ID)],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    elapsed = None
+    peak_kb = 0
+    try:
+        while time.perf_counter() - start < timeout:
+            status = read_proc_status(process.pid)
+            peak_kb = max(peak_kb, int(status.get("VmHWM", "0 kB").split()[0]))
+            try:
+                with open(log_path, "r", errors="replace") as file:
+                    if READY_MARKER in file.read():
+                        elapsed = time.perf_counter() - start
+                        break
+            except OSError:
+                pass
+            time.sleep(0.002)
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return elapsed, peak_kb
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time seeder startup (until listening) with and without verification."
+    )
+    parser.add_argument("--sizes", default="20M,1G,10G")
+    parser.add_argument("--piece-size", type=int, default=16384)
+    parser.add_argument("--timeout", type=float, default=1800)
+    args = parser.parse_args()
+
+    modes = (
+        ("as-is", {"SeederCheck": "trust", "FastResume": 0}),
+        ("verify", {"SeederCheck": "verify", "FastResume": 0}),
+        ("resume record", {"SeederCheck": "verify", "FastResume": 1}),
+    )
+    print(f"{'size':>8} {'mode':<14} {'startup (s)':>12} {'peak RSS (MiB)':>15}")
+    for size_text in args.sizes.split(","):
+        file_size = parse_size(size_text)
+        workdir = tempfile.mkdtemp(prefix="p2p_startup_")
+        try:
+            with open(os.path.join(workdir, "PeerInfo.cfg"), "w") as file:
+                file.write(f"{PEER_ID} localhost {40000 + os.getpid() % 20000} 1\n")
+            peer_dir = os.path.join(workdir, f"peer_{PEER_ID}")
+            os.makedirs(peer_dir)
+            file_path = os.path.join(peer_dir, "TheFile.dat")
+            write_file(file_path, file_size)
+            Metainfo.generate(file_path, args.piece_size).save(
+                os.path.join(workdir, "TheFile.dat.meta")
+            )
+            for name, overrides in modes:
+                write_config(workdir, file_size, args.piece_size, overrides)
+                if overrides["FastResume"]:
+                    # The first start verifies and writes the record; time the next.
+                    time_startup(workdir, args.timeout)
+                elapsed, peak_kb = time_startup(workdir, args.timeout)
+                shown = f"{elapsed:.3f}" if elapsed is not None else "timeout"
+                print(f"{size_text:>8} {name:<14} {shown:>12} {peak_kb / 1024:>15.1f}")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from utils.connection import ConnectionManager
+from utils.file_manager import FileManager
+from utils.log_manager import LogManager
+from utils.message import Piece
+
+PEER_ID = 1001
+
+
+def drain(conn, total, done):
+    buffer = bytearray(1024 * 1024)
+    received = 0
+    while received < total:
+        count = conn.recv_into(buffer)
+        if count == 0:
+            break
+        received += count
+    done.append(received)
+
+
+def copying_upload(sock, file_manager, piece_index):
+    # The upload path before sendfile: read the piece into bytes and copy it
+    # again behind the PIECE header.
+    with open(file_manager.file_path, "rb") as file:
+        file.seek(piece_index * file_manager.piece_size)
+        piece_data = file.read(file_manager.piece_size)
+    sock.sendall(Piece.create(piece_index, piece_data))
+
+
+def sendfile_upload(sock, file_manager, piece_index):
+    ConnectionManager.send_piece(PEER_ID, PEER_ID + 1, sock, file_manager, piece_index)
+
+
+def run(upload, file_manager, total_pieces):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("localhost", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    header_bytes = len(Piece.create_header(0, 0))
+    expected = sum(
+        header_bytes + file_manager.piece_span(i)[1] for i in range(total_pieces)
+    )
+    done = []
+    receiver = threading.Thread(target=drain, args=(client, expected, done))
+    receiver.start()
+    tracemalloc.start()
+    start = time.perf_counter()
+    for piece_index in range(total_pieces):
+        upload(conn, file_manager, piece_index)
+    receiver.join()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for sock in (conn, client, server):
+        sock.close()
+    return done[0] / elapsed / (1024 * 1024), peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare seeder upload throughput of the copying and sendfile PIECE paths."
+    )
+    parser.add_argument("--file-size", type=int, default=256 * 1024 * 1024)
+    parser.add_argument("--piece-size", type=int, default=16384)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="p2p_upload_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        LogManager.start_logger(PEER_ID)
+        total_pieces = -(-args.file_size // args.piece_size)
+        os.makedirs(f"peer_{PEER_ID}", exist_ok=True)
+        with open(os.path.join(f"peer_{PEER_ID}", "TheFile.dat"), "wb") as file:
+            for _ in range(args.file_size // (1024 * 1024)):
+                file.write(os.urandom(1024 * 1024))
+            file.write(os.urandom(args.file_size % (1024 * 1024)))
+        file_manager = FileManager(PEER_ID, args.piece_size, "TheFile.dat", total_pieces)
+
+        print(f"{args.file_size} bytes, {total_pieces} pieces of {args.piece_size} bytes")
+        print(f"{'path':<10} {'MiB/s':>10} {'peak Python heap (KiB)':>24}")
+        for name, upload in (("copying", copying_upload), ("sendfile", sendfile_upload)):
+            throughput, peak = run(upload, file_manager, total_pieces)
+            print(f"{name:<10} {throughput:>10.1f} {peak:>24.1f}")
+        file_manager.close()
+    finally:
+        LogManager.close_all_loggers()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from utils.connection import ConnectionManager
+from utils.framed_reader import FramedReader
+from utils.log_manager import LogManager
+from utils.message import Message, Have
+
+PEER_ID = 1001
+TARGET_ID = 1002
+
+
+def connect():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("localhost", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return conn, client
+
+
+def drain(conn, total):
+    buffer = bytearray(1024 * 1024)
+    received = 0
+    while received < total:
+        count = conn.recv_into(buffer)
+        if count == 0:
+            break
+        received += count
+
+
+def run_small(use_writer, threads, messages):
+    # threads senders each send messages HAVEs on one socket, as the message
+    # loops and the HAVE fan-out do.
+    conn, client = connect()
+    if use_writer:
+        writer = ConnectionManager.attach_writer(PEER_ID, TARGET_ID, conn, "upload", 1 << 30)
+    expected = threads * messages * len(Have.create(0))
+    receiver = threading.Thread(target=drain, args=(client, expected))
+    receiver.start()
+
+    def send():
+        for piece_index in range(messages):
+            ConnectionManager.send_message(
+                PEER_ID, TARGET_ID, conn, Message.HAVE, Have.create_payload(piece_index)
+            )
+
+    start = time.perf_counter()
+    senders = [threading.Thread(target=send) for _ in range(threads)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    receiver.join()
+    elapsed = time.perf_counter() - start
+    syscalls = writer.get_stats()["syscalls"] if use_writer else threads * messages
+    ConnectionManager.release_writer(conn)
+    conn.close()
+    client.close()
+    return threads * messages / elapsed, syscalls
+
+
+def run_priority(use_writer, pieces, piece_size, rate):
+    # Queues pieces PIECE messages on a link drained at rate bytes/s, then
+    # sends one HAVE, and measures how long the sender was blocked and how
+    # much PIECE data reached the receiver ahead of the HAVE.
+    conn, client = connect()
+    if use_writer:
+        ConnectionManager.attach_writer(PEER_ID, TARGET_ID, conn, "upload", 1 << 30)
+    piece_payload = bytes(8 + piece_size)
+    result = {}
+
+    def receive():
+        reader = FramedReader(client)
+        ahead = 0
+        started = time.perf_counter()
+        while True:
+            message = reader.read_message()
+            if message is None:
+                return
+            msg_type, payload = message
+            if msg_type == Message.HAVE:
+                result["arrived"] = time.perf_counter()
+                result["ahead"] = ahead
+                if ahead >= pieces * piece_size:
+                    return
+            elif msg_type == Message.PIECE:
+                ahead += len(payload)
+                if ahead >= pieces * piece_size and "arrived" in result:
+                    return
+                delay = started + ahead / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+
+    def send_pieces():
+        for _ in range(pieces):
+            ConnectionManager.send_message(PEER_ID, TARGET_ID, conn, Message.PIECE, piece_payload)
+
+    bulk = threading.Thread(target=send_pieces)
+    bulk.start()
+    time.sleep(0.05)
+    sent = time.perf_counter()
+    ConnectionManager.send_message(PEER_ID, TARGET_ID, conn, Message.HAVE, Have.create_payload(0))
+    blocked = time.perf_counter() - sent
+    bulk.join()
+    receiver.join()
+    ConnectionManager.release_writer(conn)
+    conn.close()
+    client.close()
+    return blocked, result["arrived"] - sent, result["ahead"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare direct locked sendall with the per-connection writer."
+    )
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=20_000)
+    parser.add_argument("--pieces", type=int, default=64)
+    parser.add_argument("--piece-size", type=int, default=256 * 1024)
+    parser.add_argument("--rate", type=float, default=64, help="receiver read rate in MiB/s")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="p2p_writer_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        LogManager.start_logger(PEER_ID)
+        print(f"{args.threads} threads x {args.messages} HAVE messages")
+        print(f"{'path':<10} {'msg/s':>12} {'send syscalls':>14}")
+        for name, use_writer in (("direct", False), ("writer", True)):
+            rate, syscalls = run_small(use_writer, args.threads, args.messages)
+            print(f"{name:<10} {rate:>12,.0f} {syscalls:>14}")
+
+        print()
+        print(
+            f"HAVE sent behind {args.pieces} PIECEs of {args.piece_size} bytes, "
+            f"read at {args.rate:g} MiB/s"
+        )
+        print(f"{'path':<10} {'sender blocked (ms)':>20} {'delivered after (ms)':>21} {'PIECE KiB ahead':>16}")
+        for name, use_writer in (("direct", False), ("writer", True)):
+            blocked, latency, ahead = run_priority(
+                use_writer, args.pieces, args.piece_size, args.rate * 1024 * 1024
+            )
+            print(f"{name:<10} {blocked * 1000:>20.1f} {latency * 1000:>21.1f} {ahead / 1024:>16.0f}")
+    finally:
+        LogManager.close_all_loggers()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
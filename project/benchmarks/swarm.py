@@ -0,0 +1,130 @@
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PEER_PROCESS = os.path.join(PROJECT_DIR, "peerProcess.py")
+COMPLETE_MARKER = "Download of complete file is complete."
+
+
+def read_proc_status(pid):
+    status = {}
+    try:
+        with open(f"/proc/{pid}/status", "r") as file:
+            for line in file:
+                key, _, value = line.partition(":")
+                status[key] = value.strip()
+    except OSError:
+        return {}
+    return status
+
+
+class Swarm:
+    def __init__(
+        self,
+        num_peers,
+        file_size,
+        piece_size,
+        peer_args=(),
+        common_overrides=None,
+        base_port=None,
+        workdir=None,
+    ):
+        self.num_peers = num_peers
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.peer_args = list(peer_args)
+        self.common_overrides = common_overrides or {}
+        self.base_port = base_port or random.randint(20000, 50000)
+        self.workdir = workdir or tempfile.mkdtemp(prefix="p2p_swarm_")
+        self.peer_ids = [1001 + i for i in range(num_peers)]
+        self.processes = {}
+        self.peak_rss_kb = {}
+        self.peak_threads = {}
+        self.completed_at = {}
+
+    def write_config(self):
+        common = {
+            "NumberOfPreferredNeighbors": 3,
+            "UnchokingInterval": 5,
+            "OptimisticUnchokingInterval": 10,
+            "FileName": "TheFile.dat",
+            "FileSize": self.file_size,
+            "PieceSize": self.piece_size,
+        }
+        common.update(self.common_overrides)
+        with open(os.path.join(self.workdir, "Common.cfg"), "w") as file:
+            file.write("\n".join(f"{key} {value}" for key, value in common.items()))
+        with open(os.path.join(self.workdir, "PeerInfo.cfg"), "w") as file:
+            for i, peer_id in enumerate(self.peer_ids):
+                file.write(f"{peer_id} localhost {self.base_port + i} {1 if i == 0 else 0}\n")
+        seeder_dir = os.path.join(self.workdir, f"peer_{self.peer_ids[0]}")
+        os.makedirs(seeder_dir, exist_ok=True)
+        with open(os.path.join(seeder_dir, "TheFile.dat"), "wb") as file:
+            remaining = self.file_size
+            while remaining > 0:
+                chunk = os.urandom(min(remaining, 1 << 20))
+                file.write(chunk)
+                remaining -= len(chunk)
+
+    def log_path(self, peer_id):
+        return os.path.join(self.workdir, f"peer_{peer_id}", f"log_peer_{peer_id}.log")
+
+    def is_complete(self, peer_id):
+        try:
+            with open(self.log_path(peer_id), "r", errors="replace") as file:
+                return COMPLETE_MARKER in file.read()
+        except OSError:
+            return False
+
+    def sample(self):
+        for peer_id, process in self.processes.items():
+            status = read_proc_status(process.pid)
+            rss = int(status.get("VmRSS", "0 kB").split()[0])
+            threads = int(status.get("Threads", "0"))
+            self.peak_rss_kb[peer_id] = max(self.peak_rss_kb.get(peer_id, 0), rss)
+            self.peak_threads[peer_id] = max(self.peak_threads.get(peer_id, 0), threads)
+
+    def run(self, timeout=300, start_delay=0.2, sample_interval=0.2):
+        self.write_config()
+        start = time.time()
+        for peer_id in self.peer_ids:
+            self.processes[peer_id] = subprocess.Popen(
+                [sys.executable, PEER_PROCESS, str(peer_id)] + self.peer_args,
+                cwd=self.workdir,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            time.sleep(start_delay)
+        leechers = self.peer_ids[1:]
+        try:
+            while time.time() - start < timeout:
+                self.sample()
+                for peer_id in leechers:
+                    if peer_id not in self.completed_at and self.is_complete(peer_id):
+                        self.completed_at[peer_id] = time.time() - start
+                if len(self.completed_at) == len(leechers):
+                    break
+                time.sleep(sample_interval)
+        finally:
+            self.stop()
+        return len(self.completed_at) == len(leechers)
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        deadline = time.time() + 3
+        for process in self.processes.values():
+            try:
+                process.wait(max(0.1, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
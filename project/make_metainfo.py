@@ -0,0 +1,32 @@
+import os
+import sys
+import time
+from utils.file_manager import FileManager
+from utils.metainfo import Metainfo
+
+
+def make_metainfo(peer_id, workers=None):
+    common_config = FileManager.parse_common_config()
+    file_name = common_config.get("filename")
+    piece_size = int(common_config.get("piecesize"))
+    file_size = int(common_config.get("filesize"))
+    metainfo_path = common_config.get("metainfofile", f"{file_name}.meta")
+    file_path = os.path.join(f"peer_{peer_id}", file_name)
+
+    started = time.perf_counter()
+    metainfo = Metainfo.generate(file_path, piece_size, file_name=file_name, workers=workers)
+    metainfo.check_config(file_size, piece_size)
+    metainfo.save(metainfo_path)
+    elapsed = time.perf_counter() - started
+    print(
+        f"Hashed {metainfo.total_pieces} pieces of {file_path} in {elapsed:.2f}s "
+        f"({file_size / elapsed / 1e6:.1f} MB/s), wrote {metainfo_path}."
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python make_metainfo.py <peerID> [workers]")
+        sys.exit(1)
+
+    make_metainfo(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) == 3 else None)
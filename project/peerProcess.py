@@ -1,3 +1,4 @@
+import os
 import threading
 import signal
 import sys
@@ -6,12 +7,38 @@ from utils.file_manager import FileManager
 from utils.log_manager import LogManager
 from utils.peer_manager import PeerManager
 from utils.connection import ServerListener, ClientListener, ConnectionManager
-from utils.message import Have, Message
+from utils.async_engine import AsyncEngine
+from utils.bitfield import BitField
+from utils.disk_io import DiskIO
+from utils.metainfo import Metainfo
+from utils.resume import ResumeState
+from utils.event_trace import EventTrace
+from utils.metrics import MetricsServer
+from utils.scheduler import Scheduler
+from utils.have_announcer import HaveAnnouncer
+from utils.rate_limiter import RateLimiter
+from utils.message import Handshake
 
 
 class PeerProcess:
-    def __init__(self, peer_id):
+    ENGINES = ("threaded", "asyncio")
+    # BitfieldEncoding -> handshake features; "rle" also allows packed.
+    BITFIELD_ENCODINGS = {
+        "unpacked": 0,
+        "packed": Handshake.PACKED_BITFIELD,
+        "rle": Handshake.PACKED_BITFIELD | Handshake.RLE_BITFIELD,
+    }
+
+    def __init__(self, peer_id, engine="threaded"):
+        if engine not in PeerProcess.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}'. Expected one of {PeerProcess.ENGINES}.")
         self.peer_id = peer_id
+        self.engine = engine
+        self.async_engine = None
+        self.metrics_server = None
+        self.metrics_port = 0
+        self.disk_io = None
+        self.resume = None
         self.file_manager = None
         self.peer_manager = None
         self.bitfield = None
@@ -22,11 +49,35 @@ class PeerProcess:
         self.piece_size = None
         self.port = None
         self.has_complete_file = None
+        self.pipeline_options = {}
+        self.seeder_check = "verify"
+        self.hash_workers = None
+        self.unchoking_interval = 5
+        self.optimistic_unchoking_interval = 10
+        self.request_timeout = 30
+        self.stats_interval = 60
+        self.have_window = 0.05
+        self.scheduler = None
+        self.rate_limiter = None
 
     def initialize(self):
         try:
             LogManager.log(self.peer_id, "Initializing peer process...")
             common_config = FileManager.parse_common_config()
+            LogManager.configure(
+                level=common_config.get("loglevel", "INFO"),
+                debug_sample=int(common_config.get("logdebugsample", 1)),
+                flush_bytes=int(common_config.get("logflushbytes", 65536)),
+                flush_interval=float(common_config.get("logflushinterval", 0.5)),
+                max_bytes=int(common_config.get("logmaxbytes", 10485760)),
+                backups=int(common_config.get("logbackups", 3)),
+            )
+            if common_config.get("eventtrace", "0") == "1":
+                EventTrace.start(
+                    self.peer_id,
+                    capacity=int(common_config.get("eventtracebufferrecords", 65536)),
+                    flush_interval=float(common_config.get("eventtraceflushinterval", 1)),
+                )
             peer_info = FileManager.parse_peer_info()
             self.file_name = common_config.get("filename")
             self.piece_size = int(common_config.get("piecesize"))
@@ -34,18 +85,160 @@ class PeerProcess:
             self.total_pieces = -(-file_size // self.piece_size)
             self.port = peer_info[self.peer_id]["port"]
             self.has_complete_file = peer_info[self.peer_id]["has_file"]
+            self.pipeline_options = {
+                "pipeline_depth": int(common_config.get("requestpipelinedepth", 10)),
+                "adaptive_pipeline": common_config.get("adaptiverequestpipeline", "0")
+                == "1",
+                "max_pipeline_depth": int(
+                    common_config.get("maxrequestpipelinedepth", 64)
+                ),
+            }
+            metainfo = self.load_metainfo(common_config, file_size)
             self.file_manager = FileManager(
-                self.peer_id, self.piece_size, self.file_name, self.total_pieces
+                self.peer_id,
+                self.piece_size,
+                self.file_name,
+                self.total_pieces,
+                file_size=file_size,
+                storage=common_config.get("storagebackend", "file"),
+                flush_pieces=int(common_config.get("storageflushpieces", 64)),
+                flush_interval=float(common_config.get("storageflushinterval", 5)),
+                cache_bytes=int(common_config.get("piececachebytes", 0)),
+                metainfo=metainfo,
+                block_size=int(common_config.get("blocksize", 16384)),
             )
+            bitfield_encoding = common_config.get("bitfieldencoding", "rle").lower()
+            if bitfield_encoding not in PeerProcess.BITFIELD_ENCODINGS:
+                raise ValueError(
+                    f"Unknown BitfieldEncoding '{bitfield_encoding}'. "
+                    f"Expected one of {tuple(PeerProcess.BITFIELD_ENCODINGS)}."
+                )
             self.peer_manager = PeerManager(
-                self.peer_id, self.total_pieces, self.file_manager
+                self.peer_id,
+                self.total_pieces,
+                self.file_manager,
+                max_hash_failures=int(common_config.get("maxhashfailures", 3)),
+                preferred_neighbors=int(common_config.get("numberofpreferredneighbors", 3)),
+                endgame=common_config.get("endgame", "1") == "1",
+                request_timeout=float(common_config.get("requesttimeout", 30)),
+                bitfield_features=PeerProcess.BITFIELD_ENCODINGS[bitfield_encoding],
+                send_high_water=int(common_config.get("sendqueuehighwater", 1048576)),
+            )
+            self.unchoking_interval = float(common_config.get("unchokinginterval", 5))
+            self.optimistic_unchoking_interval = float(
+                common_config.get("optimisticunchokinginterval", 10)
+            )
+            self.request_timeout = float(common_config.get("requesttimeout", 30))
+            self.stats_interval = float(common_config.get("statsinterval", 60))
+            disk_workers = int(common_config.get("diskworkers", 2))
+            if metainfo is not None and disk_workers <= 0:
+                # Pieces are verified on the disk workers, never on a socket thread.
+                LogManager.log(self.peer_id, "Piece verification needs a disk worker; using one.")
+                disk_workers = 1
+            if disk_workers > 0:
+                self.disk_io = DiskIO(
+                    self.peer_id,
+                    self.file_manager,
+                    workers=disk_workers,
+                    max_pending_writes=int(common_config.get("diskqueuedepth", 64)),
+                    coalesce_window=float(common_config.get("diskcoalescewindow", 0.002)),
+                    durable=common_config.get("durablewrites", "1") == "1",
+                )
+                self.peer_manager.disk_io = self.disk_io
+            self.metrics_port = int(common_config.get("metricsport", 0))
+            self.seeder_check = common_config.get("seedercheck", "verify")
+            hash_workers = int(common_config.get("hashworkers", 0))
+            self.hash_workers = hash_workers if hash_workers > 0 else None
+            if common_config.get("fastresume", "1") == "1":
+                self.resume = ResumeState(
+                    self.peer_id,
+                    self.file_manager,
+                    self.peer_manager.get_bitfield,
+                    checkpoint_pieces=int(common_config.get("resumecheckpointpieces", 64)),
+                    checkpoint_interval=float(
+                        common_config.get("resumecheckpointinterval", 5)
+                    ),
+                )
+                self.peer_manager.resume = self.resume
+            self.have_window = float(common_config.get("havebatchwindow", 0.05))
+            self.peer_manager.announcer = HaveAnnouncer(
+                self.peer_id, self.peer_manager, window=self.have_window
             )
-            self.bitfield = [1 if self.has_complete_file else 0] * self.total_pieces
+            self.rate_limiter = RateLimiter(**PeerProcess.rate_limits(common_config))
+            self.peer_manager.rate_limiter = self.rate_limiter
+            self.bitfield = BitField(self.total_pieces, complete=self.has_complete_file)
             LogManager.log(self.peer_id, "Peer process initialized successfully.")
         except Exception as e:
             LogManager.log(self.peer_id, f"Failed to initialize peer process: {e}")
             raise
 
+    @staticmethod
+    def rate_limits(common_config):
+        return {
+            "upload_rate": int(common_config.get("uploadratelimit", 0)),
+            "download_rate": int(common_config.get("downloadratelimit", 0)),
+            "peer_upload_rate": int(common_config.get("peeruploadratelimit", 0)),
+            "peer_download_rate": int(common_config.get("peerdownloadratelimit", 0)),
+            "burst": float(common_config.get("ratelimitburst", 0.25)),
+        }
+
+    def reload_rate_limits(self):
+        # SIGHUP: re-read the rate limits from Common.cfg and apply them to the
+        # running buckets.
+        try:
+            self.rate_limiter.set_limits(**PeerProcess.rate_limits(FileManager.parse_common_config()))
+            limits = self.rate_limiter.get_limits()
+            LogManager.log(
+                self.peer_id,
+                f"Rate limits reloaded: upload {limits['upload_rate']} B/s "
+                f"({limits['peer_upload_rate']} per peer), download {limits['download_rate']} B/s "
+                f"({limits['peer_download_rate']} per peer).",
+            )
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error reloading rate limits: {e}")
+
+    def load_metainfo(self, common_config, file_size):
+        metainfo_path = common_config.get("metainfofile", f"{self.file_name}.meta")
+        if not os.path.exists(metainfo_path):
+            LogManager.log(
+                self.peer_id,
+                f"Metainfo file '{metainfo_path}' not found. Pieces will not be verified.",
+            )
+            return None
+        metainfo = Metainfo.load(metainfo_path)
+        metainfo.check_config(file_size, self.piece_size)
+        LogManager.log(
+            self.peer_id,
+            f"Loaded metainfo '{metainfo_path}' with {metainfo.total_pieces} piece hashes.",
+        )
+        return metainfo
+
+    def load_seeder_pieces(self):
+        # Pieces of the complete file that can be served: a resume record
+        # matching the file on disk is trusted, otherwise the file is checked
+        # against the metainfo in parallel. With neither, it is served as-is.
+        if self.resume:
+            trusted = self.resume.load_trusted()
+            if trusted is not None:
+                return trusted
+        metainfo = self.file_manager.metainfo
+        bitfield = BitField(self.total_pieces, complete=True)
+        if metainfo is None or self.seeder_check != "verify":
+            LogManager.log(self.peer_id, f"Serving '{self.file_name}' as-is without verification.")
+            return bitfield
+        started = time.perf_counter()
+        failed = metainfo.verify_file(self.file_manager.file_path, workers=self.hash_workers)
+        for piece_index in failed:
+            bitfield.clear(piece_index)
+        LogManager.log(
+            self.peer_id,
+            f"Verified {self.total_pieces} pieces in {time.perf_counter() - started:.2f}s; "
+            f"{len(failed)} failed and will be downloaded.",
+        )
+        if self.resume:
+            self.resume.checkpoint(bitfield)
+        return bitfield
+
     def start_server_listener(self):
         try:
             self.server_listener = ServerListener(
@@ -68,7 +261,9 @@ class PeerProcess:
                 list(peer_info.keys()),
                 {pid: data["port"] for pid, data in peer_info.items()},
                 self.peer_manager,
+                **self.pipeline_options,
             )
+            self.server_listener.on_peer_connected = self.client_listener.dial
             client_thread = threading.Thread(
                 target=self.client_listener.connect_to_peers, daemon=True
             )
@@ -78,34 +273,117 @@ class PeerProcess:
             LogManager.log(self.peer_id, f"Error starting client listener: {e}")
             raise
 
-    def announce_pieces(self):
+    def start_async_engine(self):
         try:
-            for i in range(self.total_pieces):
-                have_message = Have.create(i)
-                for target_peer_id, conn in self.peer_manager.connected_peers.items():
-                    if conn["socket"]:
-                        ConnectionManager.send_message(
-                            self.peer_id,
-                            target_peer_id,
-                            conn["socket"],
-                            Message.HAVE,
-                            have_message,
-                        )
-            LogManager.log(
-                self.peer_id, "Announced available pieces to connected peers."
+            peer_info = FileManager.parse_peer_info()
+            self.async_engine = AsyncEngine(
+                self.peer_id,
+                self.port,
+                list(peer_info.keys()),
+                {pid: data["port"] for pid, data in peer_info.items()},
+                self.peer_manager,
+                **self.pipeline_options,
             )
+            engine_thread = threading.Thread(target=self.async_engine.start, daemon=True)
+            engine_thread.start()
+            self.async_engine.started.wait()
+            LogManager.log(self.peer_id, "Async engine started successfully.")
         except Exception as e:
-            LogManager.log(self.peer_id, f"Error announcing pieces: {e}")
+            LogManager.log(self.peer_id, f"Error starting async engine: {e}")
+            raise
+
+    def start_metrics_server(self):
+        try:
+            if self.async_engine:
+                client_listener = self.async_engine.client_handler
+            else:
+                client_listener = self.client_listener
+            # MetricsPort is a base port; each peer listens on base + its index.
+            peer_ids = sorted(FileManager.parse_peer_info())
+            self.metrics_server = MetricsServer(
+                self.peer_id,
+                self.metrics_port + peer_ids.index(self.peer_id),
+                self.peer_manager,
+                lambda: client_listener.pipelines,
+                ConnectionManager.get_writers,
+            )
+            self.metrics_server.start()
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error starting metrics server: {e}")
+
+    def start_scheduler(self):
+        try:
+            if self.async_engine:
+                client_listener = self.async_engine.client_handler
+            else:
+                client_listener = self.client_listener
+            self.scheduler = Scheduler(self.peer_id)
+            self.scheduler.every(
+                "preferred neighbors",
+                self.unchoking_interval,
+                self.peer_manager.run_choking_round,
+            )
+            self.scheduler.every(
+                "optimistic unchoke",
+                self.optimistic_unchoking_interval,
+                self.peer_manager.run_optimistic_unchoke,
+            )
+            if self.request_timeout > 0:
+                self.scheduler.every(
+                    "request timeouts",
+                    min(1.0, self.request_timeout / 4),
+                    client_listener.expire_requests,
+                )
+            if self.have_window > 0:
+                self.scheduler.every(
+                    "have announcements",
+                    self.have_window,
+                    self.peer_manager.announcer.flush,
+                )
+            if self.stats_interval > 0:
+                self.scheduler.every("stats", self.stats_interval, self.peer_manager.log_stats)
+            if self.resume:
+                self.scheduler.every(
+                    "resume checkpoint",
+                    self.resume.checkpoint_interval,
+                    self.resume.checkpoint_if_dirty,
+                )
+            self.scheduler.start()
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error starting scheduler: {e}")
             raise
 
     def handle_shutdown(self, stop_event):
         while not stop_event.is_set():
             stop_event.wait(1)
+        if self.scheduler:
+            self.scheduler.stop()
+            for name, stats in self.scheduler.get_stats().items():
+                LogManager.log(
+                    self.peer_id,
+                    f"Scheduled job '{name}': {stats['runs']} runs, {stats['skipped']} skipped, "
+                    f"max lateness {stats['max_lateness'] * 1000:.1f} ms.",
+                )
+        if self.peer_manager:
+            self.peer_manager.log_stats()
+        if self.metrics_server:
+            self.metrics_server.stop()
         if self.server_listener:
             self.server_listener.stop()
+        if self.async_engine:
+            self.async_engine.stop()
+            LogManager.log(self.peer_id, "Async engine stopped.")
         if self.client_listener:
             LogManager.log(self.peer_id, "Client listener stopped.")
+        if self.disk_io:
+            self.disk_io.stop()
+        if self.resume:
+            self.resume.close()
+        EventTrace.stop()
+        if self.file_manager:
+            self.file_manager.close()
         LogManager.log(self.peer_id, "Peer process exited cleanly.")
+        LogManager.close_logger(self.peer_id)
 
     def start(self):
         try:
@@ -114,39 +392,50 @@ class PeerProcess:
 
             if self.has_complete_file:
                 self.file_manager.initialize_pieces(has_complete_file=True)
-                self.peer_manager.initialize_peer_bitfield(complete=True)
+                available = self.load_seeder_pieces()
+                if available.is_complete():
+                    self.peer_manager.initialize_peer_bitfield(complete=True)
+                else:
+                    self.file_manager.restore_pieces(available)
+                    self.peer_manager.initialize_peer_bitfield(
+                        complete=False, resumed=available
+                    )
+            elif self.resume:
+                resumed = self.resume.load()
+                self.file_manager.restore_pieces(resumed)
+                self.peer_manager.initialize_peer_bitfield(complete=False, resumed=resumed)
             else:
                 self.file_manager.initialize_pieces(has_complete_file=False)
                 self.peer_manager.initialize_peer_bitfield(complete=False)
 
-            self.start_server_listener()
-            self.start_client_listener()
+            EventTrace.record(
+                EventTrace.START, value=self.peer_manager.get_bitfield().popcount()
+            )
+            if self.engine == "asyncio":
+                self.start_async_engine()
+            else:
+                self.start_server_listener()
+                self.start_client_listener()
+            if self.metrics_port:
+                self.start_metrics_server()
 
-            if self.has_complete_file:
-                self.announce_pieces()
-            # common_config = FileManager.parse_common_config()
-            # optimistic_interval = int(common_config.get("optimisticunchokinginterval"))
-            # self.start_optimistic_unchoking(self.peer_manager, optimistic_interval)
+            self.start_scheduler()
             stop_event = threading.Event()
             signal.signal(signal.SIGINT, lambda s, f: stop_event.set())
             signal.signal(signal.SIGTERM, lambda s, f: stop_event.set())
+            if hasattr(signal, "SIGHUP"):
+                signal.signal(signal.SIGHUP, lambda s, f: self.reload_rate_limits())
             self.handle_shutdown(stop_event)
         except Exception as e:
             LogManager.log(self.peer_id, f"Error during peer process execution: {e}")
             raise
-    def start_optimistic_unchoking(self,peer_manager, interval):
-        def run_unchoking():
-            while True:
-                time.sleep(interval)
-                peer_manager.optimistic_unchoking()
-
-        threading.Thread(target=run_unchoking, daemon=True).start()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python PeerProcess.py <peerID>")
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python PeerProcess.py <peerID> [threaded|asyncio]")
         sys.exit(1)
 
     peer_id = int(sys.argv[1])
-    PeerProcess(peer_id).start()
+    engine = sys.argv[2] if len(sys.argv) == 3 else "threaded"
+    PeerProcess(peer_id, engine).start()
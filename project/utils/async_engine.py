@@ -0,0 +1,302 @@
+import asyncio
+import threading
+from utils.message import InvalidMessageError, Message, Handshake
+from utils.connection import ServerListener, ClientListener, ConnectionManager
+from utils.framed_reader import FramedReader
+from utils.rate_limiter import RateLimiter
+from utils.log_manager import LogManager
+
+
+class StreamSocket:
+    # Lets the existing ConnectionManager.send_message / trigger_have code paths
+    # write to an asyncio StreamWriter, including from threads outside the loop.
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        # PIECE bytes sent, counted by ConnectionManager.send_piece; the only
+        # writes charged to the upload limit.
+        self.piece_written = 0
+
+    def sendall(self, data):
+        if self.writer.is_closing():
+            raise BrokenPipeError("Stream is closed.")
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            self._write(data)
+        else:
+            self.loop.call_soon_threadsafe(self._write, bytes(data))
+
+    def _write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        if self.writer.is_closing():
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncEngine:
+    DISK_BACKPRESSURE_POLL = 0.005
+    READ_SIZE = 256 * 1024
+
+    def __init__(self, peer_id, port, all_peer_ids, peer_ports, peer_manager, **client_options):
+        self.peer_id = peer_id
+        self.port = port
+        self.all_peer_ids = all_peer_ids
+        self.peer_ports = peer_ports
+        self.peer_manager = peer_manager
+        self.server_handler = ServerListener(peer_id, port, peer_manager)
+        self.client_handler = ClientListener(
+            peer_id, all_peer_ids, peer_ports, peer_manager, **client_options
+        )
+        self.loop = None
+        self.stop_event = None
+        # peer id -> task holding the outbound connection to it
+        self.dialing = {}
+        # task handling an inbound connection -> its StreamWriter
+        self.handlers = {}
+        self.started = threading.Event()
+
+    def start(self):
+        try:
+            asyncio.run(self.run())
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error in async engine: {e}")
+        finally:
+            self.started.set()
+
+    def stop(self):
+        if self.loop and self.stop_event and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        server = await asyncio.start_server(self.handle_connection, "localhost", self.port)
+        LogManager.log(
+            self.peer_id, f"Peer {self.peer_id} listening on port {self.port}..."
+        )
+        self.started.set()
+
+        for target_peer_id in self.all_peer_ids:
+            if target_peer_id != self.peer_id:
+                self.dial(target_peer_id)
+        try:
+            await self.stop_event.wait()
+        finally:
+            server.close()
+            # Close and await the connection tasks here rather than leaving
+            # them to asyncio.run's teardown; server.wait_closed() also waits
+            # for the inbound handlers on newer Pythons.
+            for writer in list(self.handlers.values()):
+                writer.close()
+            tasks = list(self.handlers) + list(self.dialing.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await server.wait_closed()
+
+    def dial(self, target_peer_id):
+        if target_peer_id in self.dialing or target_peer_id not in self.peer_ports:
+            return
+        self.dialing[target_peer_id] = asyncio.create_task(
+            self.connect_to_peer(target_peer_id, self.peer_ports[target_peer_id])
+        )
+
+    async def receive_message(self, source_peer_id, reader):
+        try:
+            header = await reader.readexactly(4)
+            length = int.from_bytes(header, "big")
+            if length <= 0 or length > FramedReader.MAX_MESSAGE_SIZE:
+                raise ValueError(
+                    f"Invalid message length received: {length} from Peer {source_peer_id}"
+                )
+            data = await reader.readexactly(length)
+            msg_type = data[0]
+            payload = memoryview(data)[1:]
+            if LogManager.debug_enabled():
+                LogManager.debug(
+                    self.peer_id,
+                    "Peer %s received message %s from Peer %s. Payload Length: %s",
+                    self.peer_id,
+                    Message.get_message_type_name(msg_type),
+                    source_peer_id,
+                    len(payload),
+                )
+            return msg_type, payload
+        except asyncio.IncompleteReadError:
+            LogManager.log(
+                self.peer_id,
+                f"Connection closed by Peer {source_peer_id}. No header received.",
+            )
+            return None
+        except ConnectionResetError:
+            LogManager.log(self.peer_id, f"Connection reset by Peer {source_peer_id}.")
+            return None
+        except ValueError as ve:
+            LogManager.log(
+                self.peer_id, f"Message validation error from Peer {source_peer_id}: {ve}"
+            )
+            return None
+
+    async def message_loop(self, handler, conn, target_peer_id, reader):
+        # Handles every complete message in each read; an incomplete tail is
+        # carried over and completed by the next read. With a rate limiter the
+        # loop sleeps off the tokens for what it read and, on an upload
+        # connection, for the PIECE data sent since, before reading on.
+        pending = b""
+        charged = conn.piece_written
+        while True:
+            try:
+                needed = self.READ_SIZE
+                if len(pending) >= 4:
+                    length = int.from_bytes(pending[:4], "big")
+                    # Checked before reading, so a bogus length cannot make
+                    # the stream buffer it.
+                    if length > FramedReader.MAX_MESSAGE_SIZE:
+                        LogManager.log(
+                            self.peer_id,
+                            f"Message validation error from Peer {target_peer_id}: Invalid message length received: {length}",
+                        )
+                        break
+                    needed = max(needed, 4 + length - len(pending))
+                if needed > self.READ_SIZE:
+                    chunk = await reader.readexactly(needed)
+                else:
+                    chunk = await reader.read(needed)
+            except asyncio.IncompleteReadError:
+                chunk = b""
+            except ConnectionResetError:
+                LogManager.log(self.peer_id, f"Connection reset by Peer {target_peer_id}.")
+                break
+            if not chunk:
+                LogManager.log(self.peer_id, f"Connection closed by Peer {target_peer_id}.")
+                break
+            data = pending + chunk if pending else chunk
+            consumed = 0
+            try:
+                for msg_type, payload, consumed in Message.iter_messages(
+                    data, 0, len(data), FramedReader.MAX_MESSAGE_SIZE
+                ):
+                    handler.handle_message(conn, target_peer_id, msg_type, payload)
+                    await conn.writer.drain()
+                    disk_io = self.peer_manager.disk_io
+                    while disk_io is not None and disk_io.is_backlogged():
+                        await asyncio.sleep(self.DISK_BACKPRESSURE_POLL)
+            except InvalidMessageError as e:
+                LogManager.log(
+                    self.peer_id, f"Message validation error from Peer {target_peer_id}: {e}"
+                )
+                break
+            pending = data[consumed:]
+            rate_limiter = self.peer_manager.rate_limiter
+            if rate_limiter is not None:
+                wait = rate_limiter.delay(RateLimiter.DOWNLOAD, target_peer_id, len(chunk))
+                if handler is self.server_handler:
+                    written, charged = conn.piece_written - charged, conn.piece_written
+                    wait = max(
+                        wait, rate_limiter.delay(RateLimiter.UPLOAD, target_peer_id, written)
+                    )
+                if wait > 0:
+                    await asyncio.sleep(wait)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.handlers[task] = writer
+        conn = StreamSocket(self.loop, writer)
+        addr = writer.get_extra_info("peername")
+        LogManager.log(
+            self.peer_id, f"Peer {self.peer_id} is connected from Peer at {addr}."
+        )
+        registered_peer_id = None
+        try:
+            handshake_data = await reader.readexactly(32)
+            peer_id = Handshake.parse_handshake(handshake_data)
+            LogManager.log(self.peer_id, f"Handshake received from Peer {peer_id}.")
+            LogManager.log(
+                self.peer_id, f"Peer {self.peer_id} is connected from Peer {peer_id}."
+            )
+            features = ConnectionManager.negotiate_features(
+                self.peer_id, self.peer_manager, conn, handshake_data
+            )
+            writer.transport.set_write_buffer_limits(high=self.peer_manager.send_high_water)
+            self.peer_manager.add_peer(self.peer_id, conn=None)
+            self.peer_manager.add_peer(peer_id, conn, direction="upload")
+            registered_peer_id = peer_id
+            self.server_handler.send_bitfield(conn, peer_id, features)
+            self.dial(peer_id)
+            await self.message_loop(self.server_handler, conn, peer_id, reader)
+        except asyncio.CancelledError:
+            # Cancelled by run() at shutdown. Returning normally keeps the
+            # stream protocol's done callback from reporting the cancellation
+            # as an unhandled exception.
+            pass
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error handling connection from {addr}: {e}")
+        finally:
+            self.handlers.pop(task, None)
+            if registered_peer_id is not None:
+                self.peer_manager.disconnect_peer(registered_peer_id)
+            writer.close()
+
+    async def connect_to_peer(self, target_peer_id, port):
+        writer = None
+        registered = False
+        try:
+            reader, writer = await asyncio.open_connection("localhost", port)
+            conn = StreamSocket(self.loop, writer)
+            writer.transport.set_write_buffer_limits(high=self.peer_manager.send_high_water)
+            features = self.peer_manager.bitfield_features
+            writer.write(Handshake.create_handshake(self.peer_id, features))
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} makes a connection to Peer {target_peer_id}.",
+            )
+            if features:
+                reply = await reader.readexactly(32)
+                if Handshake.parse_handshake(reply) != target_peer_id:
+                    raise ConnectionError("Handshake reply from an unexpected peer.")
+                features &= Handshake.parse_features(reply)
+
+            self.peer_manager.add_peer(self.peer_id, conn=None)
+            self.peer_manager.add_peer(target_peer_id, conn, direction="download")
+            registered = True
+
+            self.client_handler.send_bitfield(conn, target_peer_id, features)
+            LogManager.log(
+                self.peer_id,
+                f"Waiting to receive BITFIELD message from Peer {target_peer_id}...",
+            )
+            bitfield_message = await self.receive_message(target_peer_id, reader)
+            self.client_handler.process_bitfield(conn, target_peer_id, bitfield_message)
+            if bitfield_message is None:
+                # Closed, or a frame that leaves the stream out of step.
+                return
+            await self.message_loop(self.client_handler, conn, target_peer_id, reader)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LogManager.log(
+                self.peer_id, f"Error connecting to Peer {target_peer_id}: {e}"
+            )
+        finally:
+            self.dialing.pop(target_peer_id, None)
+            if writer is not None:
+                LogManager.log(
+                    self.peer_id, f"Closing connection with Peer {target_peer_id}."
+                )
+                if registered:
+                    self.peer_manager.disconnect_peer(target_peer_id)
+                writer.close()
+                if registered:
+                    self.client_handler.on_download_closed(target_peer_id)
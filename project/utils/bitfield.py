@@ -1,10 +1,226 @@
+import re
+from itertools import compress
+
+# Piece i lives in byte i // 8 at bit 7 - i % 8 (most significant bit first),
+# matching the BitTorrent BITFIELD layout. Padding bits are always zero.
+# Bulk conversions go through an ASCII "0101..." string so that int() and
+# format() do the bit twiddling in C.
+_TO_ASCII = bytes([ord("0")] + [ord("1")] * 255)
+_FROM_ASCII = bytes.maketrans(b"01", b"\x00\x01")
+_INVERT = bytes.maketrans(b"\x00\x01", b"\x01\x00")
+_NON_ZERO_BYTE = re.compile(rb"[^\x00]")
+_NON_FULL_BYTE = re.compile(rb"[^\xff]")
+_RUNS = re.compile(rb"0+|1+")
+
+
+def _popcount(value):
+    if hasattr(value, "bit_count"):
+        return value.bit_count()
+    return bin(value).count("1")
+
+
 class BitField:
-    @staticmethod
-    def initialize(has_complete_file, total_pieces):
-        if has_complete_file:
-            return [1] * total_pieces
-        return [0] * total_pieces
-
-    @staticmethod
-    def update(bitfield, piece_index):
-        bitfield[piece_index] = 1
+    def __init__(self, total_pieces, complete=False):
+        self.total_pieces = total_pieces
+        self.bits = bytearray(-(-total_pieces // 8))
+        if complete:
+            self.fill()
+
+    @classmethod
+    def from_bytes(cls, data, total_pieces):
+        bitfield = cls(total_pieces)
+        length = min(len(data), len(bitfield.bits))
+        bitfield.bits[:length] = data[:length]
+        bitfield._clear_padding()
+        return bitfield
+
+    @classmethod
+    def from_unpacked_bytes(cls, data, total_pieces):
+        # One byte per piece, any non-zero byte meaning "has piece".
+        bitfield = cls(total_pieces)
+        bitfield._load_digits(bytes(data[:total_pieces]).translate(_TO_ASCII))
+        return bitfield
+
+    @classmethod
+    def from_rle_bytes(cls, data, total_pieces):
+        # Lengths of alternating runs of missing and held pieces as LEB128
+        # varints, starting with missing (a zero-length run if piece 0 is held).
+        runs = []
+        value = shift = 0
+        for byte in data:
+            value |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+            else:
+                runs.append(value)
+                value = shift = 0
+        if shift or sum(runs) != total_pieces:
+            raise ValueError(f"Run lengths do not add up to {total_pieces} pieces.")
+        bitfield = cls(total_pieces)
+        start = 0
+        for i, run in enumerate(runs):
+            if i & 1:
+                bitfield._set_range(start, start + run)
+            start += run
+        return bitfield
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+    def to_unpacked_bytes(self):
+        return self._digits().translate(_FROM_ASCII)
+
+    def to_rle_bytes(self, limit=None):
+        # Returns None once the encoding grows past limit bytes. Every run
+        # takes at least a byte, so counting the 0/1 transitions (in C) rules
+        # out busy bitfields without walking them.
+        if limit is not None:
+            value = self._as_int()
+            if _popcount(value ^ (value >> 1)) > limit + 1:
+                return None
+        digits = self._digits()
+        encoded = bytearray()
+        if digits.startswith(b"1"):
+            encoded.append(0)
+        for match in _RUNS.finditer(digits):
+            run = match.end() - match.start()
+            while run >= 0x80:
+                encoded.append(run & 0x7F | 0x80)
+                run >>= 7
+            encoded.append(run)
+            if limit is not None and len(encoded) > limit:
+                return None
+        return bytes(encoded)
+
+    def _set_range(self, start, end):
+        if start >= end:
+            return
+        first, last = start >> 3, (end - 1) >> 3
+        head = 0xFF >> (start & 7)
+        tail = (0xFF << (7 - ((end - 1) & 7))) & 0xFF
+        if first == last:
+            self.bits[first] |= head & tail
+            return
+        self.bits[first] |= head
+        self.bits[first + 1 : last] = b"\xff" * (last - first - 1)
+        self.bits[last] |= tail
+
+    def _digits(self):
+        return format(self._as_int(), f"0{8 * len(self.bits)}b")[: self.total_pieces].encode("ascii")
+
+    def _load_digits(self, digits):
+        if digits:
+            value = int(digits, 2) << (8 * len(self.bits) - len(digits))
+            self.bits[:] = value.to_bytes(len(self.bits), "big")
+
+    def _clear_padding(self):
+        spare = -self.total_pieces % 8
+        if spare:
+            self.bits[-1] &= (0xFF << spare) & 0xFF
+
+    def fill(self):
+        self.bits[:] = b"\xff" * len(self.bits)
+        self._clear_padding()
+
+    def set(self, piece_index):
+        if not 0 <= piece_index < self.total_pieces:
+            raise IndexError(f"Piece index {piece_index} out of range.")
+        self.bits[piece_index >> 3] |= 0x80 >> (piece_index & 7)
+
+    def clear(self, piece_index):
+        if not 0 <= piece_index < self.total_pieces:
+            raise IndexError(f"Piece index {piece_index} out of range.")
+        self.bits[piece_index >> 3] &= ~(0x80 >> (piece_index & 7)) & 0xFF
+
+    def test(self, piece_index):
+        if not 0 <= piece_index < self.total_pieces:
+            raise IndexError(f"Piece index {piece_index} out of range.")
+        return (self.bits[piece_index >> 3] >> (7 - (piece_index & 7))) & 1 == 1
+
+    def __getitem__(self, piece_index):
+        return 1 if self.test(piece_index) else 0
+
+    def __setitem__(self, piece_index, value):
+        if value:
+            self.set(piece_index)
+        else:
+            self.clear(piece_index)
+
+    def __len__(self):
+        return self.total_pieces
+
+    def __iter__(self):
+        return iter(self.to_unpacked_bytes())
+
+    def __eq__(self, other):
+        if not isinstance(other, BitField):
+            return NotImplemented
+        return self.total_pieces == other.total_pieces and self.bits == other.bits
+
+    def __repr__(self):
+        return f"BitField({self.popcount()}/{self.total_pieces})"
+
+    def copy(self):
+        bitfield = BitField(self.total_pieces)
+        bitfield.bits[:] = self.bits
+        return bitfield
+
+    def _as_int(self):
+        return int.from_bytes(self.bits, "big")
+
+    def _from_int(self, value):
+        bitfield = BitField(self.total_pieces)
+        bitfield.bits[:] = value.to_bytes(len(self.bits), "big")
+        return bitfield
+
+    def popcount(self):
+        return _popcount(self._as_int())
+
+    def is_complete(self):
+        return self.first_missing() == -1
+
+    def and_not(self, other):
+        # Pieces set here but not in other, e.g. "pieces they have that I lack".
+        return self._from_int(self._as_int() & ~other._as_int())
+
+    def any_and_not(self, other):
+        return self._as_int() & ~other._as_int() != 0
+
+    def union(self, other):
+        return self._from_int(self._as_int() | other._as_int())
+
+    def update(self, other):
+        self.bits[:] = (self._as_int() | other._as_int()).to_bytes(len(self.bits), "big")
+
+    def first_set(self):
+        match = _NON_ZERO_BYTE.search(self.bits)
+        if match is None:
+            return -1
+        byte_index = match.start()
+        return byte_index * 8 + 8 - self.bits[byte_index].bit_length()
+
+    def first_missing(self):
+        match = _NON_FULL_BYTE.search(self.bits)
+        if match is None:
+            return -1
+        byte_index = match.start()
+        piece_index = byte_index * 8 + 8 - (~self.bits[byte_index] & 0xFF).bit_length()
+        return piece_index if piece_index < self.total_pieces else -1
+
+    def iter_set(self):
+        if self.popcount() * 8 < len(self.bits):
+            return self._iter_set_sparse()
+        return compress(range(self.total_pieces), self.to_unpacked_bytes())
+
+    def _iter_set_sparse(self):
+        for match in _NON_ZERO_BYTE.finditer(self.bits):
+            byte_index = match.start()
+            byte = self.bits[byte_index]
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield byte_index * 8 + bit
+
+    def iter_missing(self):
+        return compress(
+            range(self.total_pieces), self.to_unpacked_bytes().translate(_INVERT)
+        )
@@ -1,21 +1,74 @@
+import os
+import select
 import socket
-import time
 import threading
+import weakref
 from utils.message import (
+    InvalidMessageError,
     Message,
     Choke,
     Unchoke,
     Interested,
     NotInterested,
     Have,
+    HaveBatch,
+    CompactBitfield,
     Request,
+    Cancel,
     Piece,
     Handshake,
 )
 from utils.log_manager import LogManager
+from utils.bitfield import BitField
+from utils.framed_reader import FramedReader
+from utils.metainfo import PieceHashError
+from utils.event_trace import EventTrace
+from utils.metrics import Metrics
+from utils.request_pipeline import RequestPipeline
+from utils.socket_writer import SocketWriter
 
 
 class ConnectionManager:
+    send_locks = weakref.WeakKeyDictionary()
+    send_locks_guard = threading.Lock()
+    # socket -> SocketWriter for the connections of the threaded engine
+    writers = {}
+
+    @staticmethod
+    def send_lock(sock):
+        # Several threads write to the same socket (message loops, HAVE fan-out,
+        # unchoking); a PIECE is now written in two parts, so each socket gets a
+        # lock that keeps whole messages together on the wire. Only used for
+        # sockets without a writer.
+        with ConnectionManager.send_locks_guard:
+            lock = ConnectionManager.send_locks.get(sock)
+            if lock is None:
+                lock = threading.Lock()
+                ConnectionManager.send_locks[sock] = lock
+            return lock
+
+    @staticmethod
+    def attach_writer(peer_id, target_peer_id, sock, direction, high_water, rate_limiter=None):
+        # From here on everything sent on sock goes through its writer thread.
+        writer = SocketWriter(
+            peer_id, target_peer_id, sock, direction, high_water, rate_limiter=rate_limiter
+        )
+        with ConnectionManager.send_locks_guard:
+            ConnectionManager.writers[sock] = writer
+        return writer
+
+    @staticmethod
+    def release_writer(sock):
+        with ConnectionManager.send_locks_guard:
+            writer = ConnectionManager.writers.pop(sock, None)
+        if writer is not None:
+            writer.close()
+
+    @staticmethod
+    def get_writers():
+        with ConnectionManager.send_locks_guard:
+            return list(ConnectionManager.writers.values())
+
     @staticmethod
     def send_message(peer_id, target_peer_id, socket, msg_type, payload=b""):
         try:
@@ -32,11 +85,19 @@ class ConnectionManager:
                 payload = b""
 
             message = Message.create_message(msg_type, payload)
-            if message is None:
-                raise ValueError(
-                    f"Failed to create message {message_name}. Message object is None."
-                )
+        except ValueError as ve:
+            LogManager.log(
+                peer_id,
+                f"Validation error while sending message to Peer {target_peer_id}: {ve}",
+            )
+            return
+        ConnectionManager.send_frames(peer_id, target_peer_id, socket, msg_type, message)
 
+    @staticmethod
+    def send_frames(peer_id, target_peer_id, socket, msg_type, data):
+        # data holds one or more already framed messages of type msg_type.
+        message_name = Message.get_message_type_name(msg_type)
+        try:
             if socket is None:
                 LogManager.log(
                     peer_id,
@@ -44,72 +105,184 @@ class ConnectionManager:
                 )
                 return
 
-            socket.sendall(message)
-            LogManager.log(
+            writer = ConnectionManager.writers.get(socket)
+            if writer is not None:
+                writer.send((data,), bulk=msg_type == Message.PIECE)
+            else:
+                with ConnectionManager.send_lock(socket):
+                    socket.sendall(data)
+            if msg_type == Message.CHOKE:
+                EventTrace.record(EventTrace.CHOKE_SENT, target_peer_id)
+            elif msg_type == Message.UNCHOKE:
+                EventTrace.record(EventTrace.UNCHOKE_SENT, target_peer_id)
+            LogManager.debug(
                 peer_id,
-                f"Peer {peer_id} successfully sent message {message_name} to Peer {target_peer_id}. Payload Length: {len(payload)}",
+                "Peer %s successfully sent message %s to Peer %s. Length: %s",
+                peer_id,
+                message_name,
+                target_peer_id,
+                len(data),
             )
         except BrokenPipeError:
             LogManager.log(
                 peer_id,
                 f"Broken pipe error while sending message {message_name} to Peer {target_peer_id}. Peer may have disconnected.",
             )
-        except ValueError as ve:
+        except Exception as e:
             LogManager.log(
                 peer_id,
-                f"Validation error while sending message {message_name} to Peer {target_peer_id}: {ve}",
+                f"Unexpected error sending message {message_name} to Peer {target_peer_id}: {e}",
+            )
+
+    SENDFILE_CHUNK = 1024 * 1024
+
+    @staticmethod
+    def send_file_range(sock, fd, offset, count):
+        if hasattr(os, "sendfile") and isinstance(sock, socket.socket):
+            sockno = sock.fileno()
+            while count > 0:
+                try:
+                    sent = os.sendfile(sockno, fd, offset, count)
+                except BlockingIOError:
+                    select.select([], [sockno], [])
+                    continue
+                except InterruptedError:
+                    continue
+                except OSError:
+                    # e.g. the descriptor types do not support sendfile here;
+                    # finish the range through the buffered path.
+                    break
+                if sent == 0:
+                    raise EOFError("File ended before the requested range was sent.")
+                offset += sent
+                count -= sent
+        while count > 0:
+            chunk = os.pread(fd, min(count, ConnectionManager.SENDFILE_CHUNK), offset)
+            if not chunk:
+                raise EOFError("File ended before the requested range was sent.")
+            sock.sendall(chunk)
+            offset += len(chunk)
+            count -= len(chunk)
+
+    @staticmethod
+    def send_piece(
+        peer_id, target_peer_id, sock, file_manager, piece_index, begin=0, length=None, piece_data=None
+    ):
+        # Sends length bytes at offset begin of the piece (the rest of the
+        # piece by default) as one PIECE message. piece_data is the whole
+        # piece when the caller already took it from the piece cache.
+        try:
+            if sock is None:
+                LogManager.log(
+                    peer_id,
+                    f"Socket is None. Cannot send message PIECE to Peer {target_peer_id}.",
+                )
+                return False
+            if file_manager.cache is not None:
+                # Hot pieces are served from the in-memory cache; get_piece
+                # admits the piece on a miss.
+                if piece_data is None:
+                    piece_data = file_manager.get_piece(piece_index)
+                if not piece_data:
+                    LogManager.log(peer_id, f"Piece {piece_index} not found.")
+                    return False
+                if length is None:
+                    length = len(piece_data) - begin
+                parts = (
+                    Piece.create_header(piece_index, length, begin),
+                    memoryview(piece_data)[begin : begin + length],
+                )
+            else:
+                offset, piece_length = file_manager.piece_span(piece_index)
+                if length is None:
+                    length = piece_length - begin
+                if piece_length == 0:
+                    LogManager.log(peer_id, f"Piece {piece_index} not found.")
+                    return False
+                fd = file_manager.fileno()
+                parts = (
+                    Piece.create_header(piece_index, length, begin),
+                    lambda target: ConnectionManager.send_file_range(
+                        target, fd, offset + begin, length
+                    ),
+                )
+            writer = ConnectionManager.writers.get(sock)
+            if writer is not None:
+                writer.send(parts, bulk=True, size=Piece.HEADER_SIZE + length)
+            else:
+                with ConnectionManager.send_lock(sock):
+                    for part in parts:
+                        if callable(part):
+                            part(sock)
+                        else:
+                            sock.sendall(part)
+                    if hasattr(sock, "piece_written"):
+                        # The asyncio engine charges these to the upload limit.
+                        sock.piece_written += Piece.HEADER_SIZE + length
+            EventTrace.record(EventTrace.PIECE_SENT, target_peer_id, piece_index, length)
+            Metrics.add_upload(target_peer_id, length)
+            LogManager.debug(
+                peer_id,
+                "Peer %s successfully sent message PIECE to Peer %s. Payload Length: %s",
+                peer_id,
+                target_peer_id,
+                length,
+            )
+            return True
+        except BrokenPipeError:
+            LogManager.log(
+                peer_id,
+                f"Broken pipe error while sending message PIECE to Peer {target_peer_id}. Peer may have disconnected.",
             )
         except Exception as e:
             LogManager.log(
                 peer_id,
-                f"Unexpected error sending message {message_name} to Peer {target_peer_id}: {e}",
+                f"Unexpected error sending message PIECE to Peer {target_peer_id}: {e}",
             )
+        return False
 
     @staticmethod
-    def receive_message(peer_id, source_peer_id, socket):
+    def close_connection(sock):
+        # Safe from any thread: shutdown() wakes a reader blocked in recv, and
+        # its receive loop then closes the socket as usual.
         try:
-            LogManager.log(
+            if hasattr(sock, "shutdown"):
+                sock.shutdown(socket.SHUT_RDWR)
+            else:
+                sock.close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def receive_message(peer_id, source_peer_id, reader):
+        try:
+            LogManager.debug(
                 peer_id,
-                f"Peer {peer_id} waiting to receive a message header from Peer {source_peer_id}...",
+                "Peer %s waiting to receive a message header from Peer %s...",
+                peer_id,
+                source_peer_id,
             )
 
-            header = socket.recv(4)
-            if not header:
+            result = reader.read_message()
+            if result is None:
                 LogManager.log(
                     peer_id,
                     f"Connection closed by Peer {source_peer_id}. No header received.",
                 )
                 return None
 
-            length = int.from_bytes(header, "big")
-            if length <= 0:
-                raise ValueError(
-                    f"Invalid message length received: {length} from Peer {source_peer_id}"
+            msg_type, payload = result
+            if LogManager.debug_enabled():
+                LogManager.debug(
+                    peer_id,
+                    "Peer %s received message %s from Peer %s. Payload Length: %s",
+                    peer_id,
+                    Message.get_message_type_name(msg_type),
+                    source_peer_id,
+                    len(payload),
                 )
-
-            LogManager.log(
-                peer_id,
-                f"Message length {length} bytes received from Peer {source_peer_id}. Receiving full message...",
-            )
-
-            data = b""
-            while len(data) < length:
-                chunk = socket.recv(length - len(data))
-                if not chunk:
-                    raise ConnectionError(
-                        f"Connection closed by Peer {source_peer_id} before full message was received."
-                    )
-                data += chunk
-
-            msg_type, payload = Message.parse_message(header + data)
-            message_name = Message.get_message_type_name(msg_type)
-
-            LogManager.log(
-                peer_id,
-                f"Peer {peer_id} received message {message_name} from Peer {source_peer_id}. Payload Length: {len(payload)}",
-            )
             return msg_type, payload
-        except socket.timeout:
+        except TimeoutError:
             LogManager.log(
                 peer_id,
                 f"Socket timed out while waiting for a message from Peer {source_peer_id}.",
@@ -130,6 +303,74 @@ class ConnectionManager:
             )
             return None
 
+    @staticmethod
+    def send_interested(peer_id, peer_manager, target_peer_id, piece_indices):
+        # A HAVE can arrive on either connection; INTERESTED always goes out on
+        # the one we download over.
+        conn = peer_manager.update_interest(target_peer_id, piece_indices)
+        if conn is not None:
+            ConnectionManager.send_message(peer_id, target_peer_id, conn, Message.INTERESTED)
+            LogManager.log(
+                peer_id,
+                f"Peer {peer_id} sent the 'interested' message to Peer {target_peer_id}.",
+            )
+
+    @staticmethod
+    def send_bitfield(peer_id, target_peer_id, conn, bitfield, features=0):
+        # A complete or empty bitfield goes out as a bodiless HAVE_ALL or
+        # HAVE_NONE. Otherwise peers that negotiated it get the packed bits or
+        # their run lengths, whichever is shorter, instead of one byte per
+        # piece.
+        if bitfield.is_complete():
+            msg_type, payload = Message.HAVE_ALL, b""
+        elif bitfield.first_set() == -1:
+            msg_type, payload = Message.HAVE_NONE, b""
+        elif features & (Handshake.PACKED_BITFIELD | Handshake.RLE_BITFIELD):
+            msg_type = Message.COMPACT_BITFIELD
+            packed = bitfield.to_bytes()
+            runs = None
+            if features & Handshake.RLE_BITFIELD:
+                limit = len(packed) if features & Handshake.PACKED_BITFIELD else None
+                runs = bitfield.to_rle_bytes(limit)
+            if runs is not None:
+                payload = CompactBitfield.create_payload(CompactBitfield.RUN_LENGTH, runs)
+            else:
+                payload = CompactBitfield.create_payload(CompactBitfield.PACKED, packed)
+        else:
+            msg_type, payload = Message.BITFIELD, bitfield.to_unpacked_bytes()
+        LogManager.log(peer_id, f"Sending {Message.get_message_type_name(msg_type)} message.")
+        ConnectionManager.send_message(peer_id, target_peer_id, conn, msg_type, payload)
+
+    @staticmethod
+    def negotiate_features(peer_id, peer_manager, conn, handshake_data):
+        # Answers a handshake that advertised features with our own and
+        # returns the features both ends support.
+        remote = Handshake.parse_features(handshake_data)
+        if not remote:
+            return 0
+        local = peer_manager.bitfield_features
+        conn.sendall(Handshake.create_handshake(peer_id, local))
+        return local & remote
+
+    @staticmethod
+    def parse_bitfield(msg_type, payload, total_pieces):
+        # The bitfield announced by a BITFIELD, COMPACT_BITFIELD, HAVE_ALL or
+        # HAVE_NONE message; None for any other message.
+        if msg_type == Message.BITFIELD:
+            return BitField.from_unpacked_bytes(payload, total_pieces)
+        if msg_type == Message.COMPACT_BITFIELD:
+            encoding, data = CompactBitfield.parse_payload(payload)
+            if encoding == CompactBitfield.PACKED:
+                return BitField.from_bytes(data, total_pieces)
+            if encoding == CompactBitfield.RUN_LENGTH:
+                return BitField.from_rle_bytes(data, total_pieces)
+            raise InvalidMessageError(f"Unknown bitfield encoding {encoding}.")
+        if msg_type == Message.HAVE_ALL:
+            return BitField(total_pieces, complete=True)
+        if msg_type == Message.HAVE_NONE:
+            return BitField(total_pieces)
+        return None
+
 
 class ServerListener:
     def __init__(self, peer_id, port, peer_manager):
@@ -138,6 +379,12 @@ class ServerListener:
         self.peer_manager = peer_manager
         self.server_socket = None
         self.running = True
+        # Called with the peer id after each inbound handshake.
+        self.on_peer_connected = None
+        # (peer id, piece index) -> "queued" or "cancelled" for uploads
+        # waiting on a disk read
+        self.queued_uploads = {}
+        self.queued_uploads_lock = threading.Lock()
 
     def start(self):
         try:
@@ -170,19 +417,39 @@ class ServerListener:
             self.server_socket.close()
 
     def handle_connection(self, conn, addr):
+        registered_peer_id = None
         try:
-            handshake_data = conn.recv(32)
+            reader = FramedReader(conn)
+            handshake_data = reader.read_exact(32)
+            if handshake_data is None:
+                raise ConnectionError("Connection closed before handshake.")
             peer_id = Handshake.parse_handshake(handshake_data)
             LogManager.log(self.peer_id, f"Handshake received from Peer {peer_id}.")
             LogManager.log(
                 self.peer_id, f"Peer {self.peer_id} is connected from Peer {peer_id}."
             )
+            features = ConnectionManager.negotiate_features(
+                self.peer_id, self.peer_manager, conn, handshake_data
+            )
+            writer = ConnectionManager.attach_writer(
+                self.peer_id,
+                peer_id,
+                conn,
+                "upload",
+                self.peer_manager.send_high_water,
+                self.peer_manager.rate_limiter,
+            )
             self.peer_manager.add_peer(self.peer_id, conn=None)
-            self.peer_manager.add_peer(peer_id, conn)
-            self.send_bitfield(conn, peer_id)
+            self.peer_manager.add_peer(peer_id, conn, direction="upload")
+            registered_peer_id = peer_id
+            self.send_bitfield(conn, peer_id, features)
+            if self.on_peer_connected is not None:
+                self.on_peer_connected(peer_id)
 
             while True:
-                result = ConnectionManager.receive_message(self.peer_id, peer_id, conn)
+                result = ConnectionManager.receive_message(
+                    self.peer_id, peer_id, reader
+                )
                 if result is None:
                     LogManager.log(
                         self.peer_id, f"Connection closed by Peer {peer_id}."
@@ -190,18 +457,22 @@ class ServerListener:
                     break
                 msg_type, payload = result
                 self.handle_message(conn, peer_id, msg_type, payload)
+                self.peer_manager.throttle_download(peer_id, Message.HEADER_SIZE + len(payload))
+                # Stop reading REQUESTs while the PIECEs already queued for
+                # this peer are above the high-water mark.
+                writer.wait_for_space()
         except Exception as e:
             LogManager.log(self.peer_id, f"Error handling connection from {addr}: {e}")
         finally:
+            if registered_peer_id is not None:
+                self.peer_manager.disconnect_peer(registered_peer_id)
+            ConnectionManager.release_writer(conn)
             conn.close()
 
-    def send_bitfield(self, conn, target_peerid):
-        bitfield = self.peer_manager.get_bitfield()
-        if bitfield:
-            LogManager.log(self.peer_id, "Sending BITFIELD message.")
-            ConnectionManager.send_message(
-                self.peer_id, target_peerid, conn, Message.BITFIELD, bytearray(bitfield)
-            )
+    def send_bitfield(self, conn, target_peerid, features=0):
+        ConnectionManager.send_bitfield(
+            self.peer_id, target_peerid, conn, self.peer_manager.get_bitfield(), features
+        )
 
     def handle_message(self, conn, peer_id, msg_type, payload):
         try:
@@ -211,8 +482,9 @@ class ServerListener:
                     f"Peer {self.peer_id} received the 'interested' message from Peer {peer_id}.",
                 )
                 self.peer_manager.mark_peer_interested(peer_id)
-
-                self.send_unchoke(conn, peer_id)
+                # Otherwise the peer waits for the next choking round.
+                if self.peer_manager.unchoke_if_slot_free(peer_id):
+                    self.send_unchoke(conn, peer_id)
 
             elif msg_type == Message.NOT_INTERESTED:
                 LogManager.log(
@@ -220,19 +492,40 @@ class ServerListener:
                     f"Peer {self.peer_id} received the 'not interested' message from Peer {peer_id}.",
                 )
                 self.peer_manager.mark_peer_not_interested(peer_id)
-                self.send_choke(conn, peer_id)
+                if self.peer_manager.choke_if_unchoked(peer_id):
+                    self.send_choke(conn, peer_id)
 
             elif msg_type == Message.HAVE:
-                piece_index = int.from_bytes(payload[7:10], "big")
+                piece_index = Have.parse_payload(payload)
                 LogManager.log(
                     self.peer_id,
                     f"Peer {self.peer_id} received the 'have' message from Peer {peer_id} for the piece {piece_index}.",
                 )
                 self.peer_manager.update_peer_bitfield(peer_id, piece_index)
+                ConnectionManager.send_interested(
+                    self.peer_id, self.peer_manager, peer_id, [piece_index]
+                )
+
+            elif msg_type == Message.HAVE_BATCH:
+                piece_indices = HaveBatch.parse_payload(payload)
+                LogManager.log(
+                    self.peer_id,
+                    f"Peer {self.peer_id} received the 'have' message from Peer {peer_id} for {len(piece_indices)} pieces.",
+                )
+                self.peer_manager.update_peer_pieces(peer_id, piece_indices)
+                ConnectionManager.send_interested(
+                    self.peer_id, self.peer_manager, peer_id, piece_indices
+                )
 
             elif msg_type == Message.REQUEST:
-                piece_index = int.from_bytes(payload[7:10], "big")
-                LogManager.log(self.peer_id, f"Extracted piece index: {piece_index}")
+                piece_index, begin, length = Request.parse_payload(payload)
+                LogManager.debug(
+                    self.peer_id,
+                    "Extracted piece index: %s, block %s+%s",
+                    piece_index,
+                    begin,
+                    length,
+                )
 
                 if piece_index < 0 or piece_index >= self.peer_manager.total_pieces:
                     LogManager.log(
@@ -240,36 +533,82 @@ class ServerListener:
                         f"Invalid piece index {piece_index} requested by Peer {peer_id}.",
                     )
                     return
+                _, piece_length = self.peer_manager.file_manager.piece_span(piece_index)
+                if length == 0:
+                    length = piece_length - begin
+                if length <= 0 or begin + length > piece_length:
+                    LogManager.log(
+                        self.peer_id,
+                        f"Invalid block {begin}+{length} of piece {piece_index} requested by Peer {peer_id}.",
+                    )
+                    return
                 if self.peer_manager.is_peer_choked(peer_id):
                     LogManager.log(
                         self.peer_id,
                         f"Cannot send piece {piece_index} to Peer {peer_id}: Peer is choked.",
                     )
+                elif self.peer_manager.disk_io is not None:
+                    with self.queued_uploads_lock:
+                        self.queued_uploads[(peer_id, piece_index, begin)] = "queued"
+                    self.peer_manager.disk_io.read(
+                        piece_index,
+                        lambda index, error, piece_data: self.on_piece_read(
+                            conn, peer_id, index, begin, length, error, piece_data
+                        ),
+                        begin,
+                        length,
+                    )
                 else:
-                    piece_data = self.peer_manager.file_manager.get_piece(piece_index)
-                    if piece_data:
-                        piece_message = Piece.create(piece_index, piece_data)
-                        ConnectionManager.send_message(
-                            self.peer_id, peer_id, conn, Message.PIECE, piece_message
-                        )
-                    else:
-                        LogManager.log(self.peer_id, f"Piece {piece_index} not found.")
+                    ConnectionManager.send_piece(
+                        self.peer_id,
+                        peer_id,
+                        conn,
+                        self.peer_manager.file_manager,
+                        piece_index,
+                        begin,
+                        length,
+                    )
+
+            elif msg_type == Message.CANCEL:
+                piece_index, begin, length = Cancel.parse_payload(payload)
+                LogManager.debug(
+                    self.peer_id,
+                    "Peer %s received the 'cancel' message from Peer %s for the piece %s, block %s+%s.",
+                    self.peer_id,
+                    peer_id,
+                    piece_index,
+                    begin,
+                    length,
+                )
+                with self.queued_uploads_lock:
+                    if (peer_id, piece_index, begin) in self.queued_uploads:
+                        self.queued_uploads[(peer_id, piece_index, begin)] = "cancelled"
 
             elif msg_type == Message.CHOKE:
                 LogManager.log(
                     self.peer_id, f"Peer {self.peer_id} is choked by Peer {peer_id}."
                 )
-                self.peer_manager.mark_peer_choked(peer_id)
+                self.peer_manager.mark_choked_by(peer_id)
 
             elif msg_type == Message.UNCHOKE:
                 LogManager.log(
                     self.peer_id, f"Peer {self.peer_id} is unchoked by Peer {peer_id}."
                 )
-                self.peer_manager.mark_peer_unchoked(self.peer_id)
-            elif msg_type == Message.BITFIELD:
-                LogManager.log(self.peer_id, f"Received BITFIELD from Peer {peer_id}.")
-                peer_bitfield = list(payload)
-                self.peer_manager.connected_peers[peer_id]["bitfield"] = peer_bitfield
+                self.peer_manager.mark_unchoked_by(peer_id)
+            elif msg_type in (
+                Message.BITFIELD,
+                Message.COMPACT_BITFIELD,
+                Message.HAVE_ALL,
+                Message.HAVE_NONE,
+            ):
+                LogManager.log(
+                    self.peer_id,
+                    f"Received {Message.get_message_type_name(msg_type)} from Peer {peer_id}.",
+                )
+                peer_bitfield = ConnectionManager.parse_bitfield(
+                    msg_type, payload, self.peer_manager.total_pieces
+                )
+                self.peer_manager.merge_peer_bitfield(peer_id, peer_bitfield)
                 LogManager.log(
                     self.peer_id, f"Updated Peer {peer_id}'s bitfield: {peer_bitfield}"
                 )
@@ -277,8 +616,34 @@ class ServerListener:
         except Exception as e:
             LogManager.log(self.peer_id, f"Error handling message: {e}")
 
-    def send_choke(self, target_peer_id, conn):
-        LogManager.log(self.peer_id, "Sending CHOKE message.")
+    def on_piece_read(self, conn, peer_id, piece_index, begin, length, error, piece_data=None):
+        with self.queued_uploads_lock:
+            state = self.queued_uploads.pop((peer_id, piece_index, begin), None)
+        if state == "cancelled":
+            LogManager.debug(
+                self.peer_id,
+                "Dropped cancelled upload of piece %s, block %s, to Peer %s.",
+                piece_index,
+                begin,
+                peer_id,
+            )
+            return
+        if error is not None:
+            LogManager.log(self.peer_id, f"Piece {piece_index} not found.")
+            return
+        ConnectionManager.send_piece(
+            self.peer_id,
+            peer_id,
+            conn,
+            self.peer_manager.file_manager,
+            piece_index,
+            begin,
+            length,
+            piece_data,
+        )
+
+    def send_choke(self, conn, target_peer_id):
+        LogManager.log(self.peer_id, f"Sending CHOKE message to Peer {target_peer_id}.")
         ConnectionManager.send_message(
             self.peer_id, target_peer_id, conn, Message.CHOKE
         )
@@ -288,140 +653,189 @@ class ServerListener:
         try:
 
             ConnectionManager.send_message(self.peer_id, peer_id, conn, Message.UNCHOKE)
-            self.peer_manager.mark_peer_unchoked(peer_id)
 
         except Exception as e:
             LogManager.log(
                 self.peer_id, f"Failed to send UNCHOKE message to Peer {peer_id}: {e}"
             )
 
-    def trigger_have(self, target_peer_id, piece_index):
-        payload = piece_index.to_bytes(4, "big")
-        for peer_id, peer_info in self.peer_manager.connected_peers.items():
-            ConnectionManager.send_message(
-                self.peer_id, target_peer_id, peer_info["socket"], Message.HAVE, payload
-            )
-            LogManager.log(
-                self.peer_id,
-                f"Peer {self.peer_id} sent 'have' message for piece {piece_index} to Peer {peer_id}.",
-            )
-
 
 class ClientListener:
-    def __init__(self, peer_id, all_peer_ids, peer_ports, peer_manager):
+    def __init__(
+        self,
+        peer_id,
+        all_peer_ids,
+        peer_ports,
+        peer_manager,
+        pipeline_depth=10,
+        adaptive_pipeline=False,
+        max_pipeline_depth=64,
+    ):
         self.peer_id = peer_id
         self.all_peer_ids = all_peer_ids
         self.peer_ports = peer_ports
         self.peer_manager = peer_manager
+        self.pipeline_depth = pipeline_depth
+        self.adaptive_pipeline = adaptive_pipeline
+        self.max_pipeline_depth = max_pipeline_depth
+        self.pipelines = {}
+        self.pipelines_lock = threading.Lock()
+        # Peers with an outbound connection or a connection attempt under way.
+        self.dialing = set()
+        self.dialing_lock = threading.Lock()
 
     def connect_to_peers(self):
         for target_peer_id in self.all_peer_ids:
             if target_peer_id != self.peer_id:
-                port = self.peer_ports[target_peer_id]
-                threading.Thread(
-                    target=self.connect_to_peer, args=(target_peer_id, port)
-                ).start()
+                self.dial(target_peer_id)
+
+    def dial(self, target_peer_id):
+        # Also used to dial back a peer that connected to us, so that we can
+        # download from the peers we upload to.
+        with self.dialing_lock:
+            if target_peer_id in self.dialing or target_peer_id not in self.peer_ports:
+                return
+            self.dialing.add(target_peer_id)
+        threading.Thread(
+            target=self.connect_to_peer,
+            args=(target_peer_id, self.peer_ports[target_peer_id]),
+        ).start()
 
     def connect_to_peer(self, target_peer_id, port):
+        client_socket = None
         try:
             client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             client_socket.connect(("localhost", port))
 
-            handshake = Handshake.create_handshake(self.peer_id)
+            features = self.peer_manager.bitfield_features
+            handshake = Handshake.create_handshake(self.peer_id, features)
             client_socket.sendall(handshake)
             LogManager.log(
                 self.peer_id,
                 f"Peer {self.peer_id} makes a connection to Peer {target_peer_id}.",
             )
+            reader = FramedReader(client_socket)
+            if features:
+                reply = reader.read_exact(32)
+                if reply is None:
+                    raise ConnectionError("Connection closed before handshake.")
+                if Handshake.parse_handshake(reply) != target_peer_id:
+                    raise ConnectionError("Handshake reply from an unexpected peer.")
+                features &= Handshake.parse_features(reply)
 
+            ConnectionManager.attach_writer(
+                self.peer_id,
+                target_peer_id,
+                client_socket,
+                "download",
+                self.peer_manager.send_high_water,
+                self.peer_manager.rate_limiter,
+            )
             self.peer_manager.add_peer(self.peer_id, conn=None)
-            self.peer_manager.add_peer(target_peer_id, client_socket)
+            self.peer_manager.add_peer(target_peer_id, client_socket, direction="download")
 
-            self.send_bitfield(client_socket, target_peer_id)
+            self.send_bitfield(client_socket, target_peer_id, features)
             LogManager.log(
                 self.peer_id,
                 f"Waiting to receive BITFIELD message from Peer {target_peer_id}...",
             )
             bitfield_message = ConnectionManager.receive_message(
-                self.peer_id, target_peer_id, client_socket
+                self.peer_id, target_peer_id, reader
             )
-            if bitfield_message:
-                LogManager.log(
-                    self.peer_id, f"Received BITFIELD message: {bitfield_message}"
-                )
-            else:
-                LogManager.log(
-                    self.peer_id,
-                    f"Failed to receive BITFIELD message from Peer {target_peer_id}.",
-                )
-
-            if bitfield_message and bitfield_message[0] == Message.BITFIELD:
-                peer_bitfield = list(bitfield_message[1])
-                LogManager.log(
-                    self.peer_id,
-                    f"Peer {self.peer_id} received the BITFIELD message from Peer {target_peer_id}.",
-                )
-                for i, bit in enumerate(peer_bitfield):
-                    if bit == 1:
-                        self.peer_manager.update_peer_bitfield(target_peer_id, i)
-            else:
-                LogManager.log(
-                    self.peer_id,
-                    f"Peer {self.peer_id} did not receive BITFIELD from Peer {target_peer_id}. Using an empty bitfield.",
-                )
-                peer_bitfield = [0] * self.peer_manager.total_pieces
-
-            if self.is_interested(peer_bitfield):
-                ConnectionManager.send_message(
-                    self.peer_id, target_peer_id, client_socket, Message.INTERESTED
-                )
-                LogManager.log(
-                    self.peer_id,
-                    f"Peer {self.peer_id} sent the 'interested' message to Peer {target_peer_id}.",
-                )
-            else:
-                ConnectionManager.send_message(
-                    self.peer_id, target_peer_id, client_socket, Message.NOT_INTERESTED
-                )
-                LogManager.log(
-                    self.peer_id,
-                    f"Peer {self.peer_id} sent the 'not interested' message to Peer {target_peer_id}.",
-                )
+            self.process_bitfield(client_socket, target_peer_id, bitfield_message)
 
             threading.Thread(
-                target=self.handle_messages, args=(client_socket, target_peer_id)
+                target=self.handle_messages,
+                args=(client_socket, target_peer_id, reader),
             ).start()
 
         except Exception as e:
             LogManager.log(
                 self.peer_id, f"Error connecting to Peer {target_peer_id}: {e}"
             )
+            if client_socket is not None:
+                ConnectionManager.release_writer(client_socket)
+            with self.dialing_lock:
+                self.dialing.discard(target_peer_id)
+
+    def process_bitfield(self, conn, target_peer_id, bitfield_message):
+        if bitfield_message:
+            LogManager.log(
+                self.peer_id,
+                f"Received message {Message.get_message_type_name(bitfield_message[0])} from Peer {target_peer_id}. Payload Length: {len(bitfield_message[1])}",
+            )
+        else:
+            LogManager.log(
+                self.peer_id,
+                f"Failed to receive BITFIELD message from Peer {target_peer_id}.",
+            )
+
+        peer_bitfield = None
+        if bitfield_message:
+            peer_bitfield = ConnectionManager.parse_bitfield(
+                bitfield_message[0], bitfield_message[1], self.peer_manager.total_pieces
+            )
+        if peer_bitfield is not None:
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} received the BITFIELD message from Peer {target_peer_id}.",
+            )
+            self.peer_manager.merge_peer_bitfield(target_peer_id, peer_bitfield)
+        else:
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} did not receive BITFIELD from Peer {target_peer_id}. Using an empty bitfield.",
+            )
+            peer_bitfield = BitField(self.peer_manager.total_pieces)
 
-    def send_bitfield(self, conn, target_peer_id):
-        bitfield = self.peer_manager.get_bitfield()
-        if bitfield:
-            LogManager.log(self.peer_id, "Sending BITFIELD message.")
+        interested = self.is_interested(peer_bitfield)
+        self.peer_manager.set_am_interested(target_peer_id, interested)
+        if interested:
             ConnectionManager.send_message(
+                self.peer_id, target_peer_id, conn, Message.INTERESTED
+            )
+            LogManager.log(
                 self.peer_id,
-                target_peer_id,
-                conn,
-                Message.BITFIELD,
-                bytearray(bitfield),
+                f"Peer {self.peer_id} sent the 'interested' message to Peer {target_peer_id}.",
             )
         else:
-            LogManager.log(self.peer_id, "No BITFIELD to send.")
+            ConnectionManager.send_message(
+                self.peer_id, target_peer_id, conn, Message.NOT_INTERESTED
+            )
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} sent the 'not interested' message to Peer {target_peer_id}.",
+            )
+
+    def send_bitfield(self, conn, target_peer_id, features=0):
+        ConnectionManager.send_bitfield(
+            self.peer_id, target_peer_id, conn, self.peer_manager.get_bitfield(), features
+        )
+
+    def get_pipeline(self, target_peer_id):
+        with self.pipelines_lock:
+            pipeline = self.pipelines.get(target_peer_id)
+            if pipeline is None:
+                pipeline = RequestPipeline(
+                    self.peer_manager,
+                    target_peer_id,
+                    depth=self.pipeline_depth,
+                    adaptive=self.adaptive_pipeline,
+                    max_depth=self.max_pipeline_depth,
+                )
+                self.pipelines[target_peer_id] = pipeline
+            return pipeline
 
     def is_interested(self, peer_bitfield):
-        for i in range(len(peer_bitfield)):
-            if peer_bitfield[i] == 1 and self.peer_manager.bitfield[i] == 0:
-                return True
-        return False
+        return peer_bitfield.any_and_not(self.peer_manager.get_bitfield())
 
-    def handle_messages(self, conn, target_peer_id):
+    def handle_messages(self, conn, target_peer_id, reader=None):
+        if reader is None:
+            reader = FramedReader(conn)
         try:
             while True:
                 result = ConnectionManager.receive_message(
-                    self.peer_id, target_peer_id, conn
+                    self.peer_id, target_peer_id, reader
                 )
                 if result is None:
                     LogManager.log(
@@ -430,122 +844,271 @@ class ClientListener:
                     break
 
                 msg_type, payload = result
-                if msg_type == Message.CHOKE:
-                    LogManager.log(
-                        self.peer_id,
-                        f"Peer {self.peer_id} is choked by Peer {target_peer_id}.",
-                    )
-                    self.peer_manager.mark_peer_choked(target_peer_id)
+                self.handle_message(conn, target_peer_id, msg_type, payload)
+                self.peer_manager.throttle_download(
+                    target_peer_id, Message.HEADER_SIZE + len(payload)
+                )
+                if self.peer_manager.disk_io is not None:
+                    self.peer_manager.disk_io.throttle()
+        except Exception as e:
+            LogManager.log(
+                self.peer_id,
+                f"Error processing message from Peer {target_peer_id}: {e}",
+            )
+        finally:
+            LogManager.log(
+                self.peer_id, f"Closing connection with Peer {target_peer_id}."
+            )
+            self.peer_manager.disconnect_peer(target_peer_id)
+            ConnectionManager.release_writer(conn)
+            conn.close()
+            self.on_download_closed(target_peer_id)
+            with self.dialing_lock:
+                self.dialing.discard(target_peer_id)
 
-                elif msg_type == Message.UNCHOKE:
-                    LogManager.log(
-                        self.peer_id,
-                        f"Peer {self.peer_id} is unchoked by Peer {target_peer_id}.",
-                    )
-                    self.peer_manager.mark_peer_unchoked(self.peer_id)
-                    self.peer_manager.mark_peer_unchoked(target_peer_id)
-                    LogManager.log(
-                        self.peer_id,
-                        f"Peer {self.peer_id} is requesting pieces from Peer {target_peer_id}.",
-                    )
-                    self.request_pieces(conn, target_peer_id)
+    def handle_message(self, conn, target_peer_id, msg_type, payload):
+        if msg_type == Message.CHOKE:
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} is choked by Peer {target_peer_id}.",
+            )
+            EventTrace.record(EventTrace.CHOKED, target_peer_id)
+            self.peer_manager.mark_choked_by(target_peer_id)
+            self.get_pipeline(target_peer_id).reset()
+            self.reassign(target_peer_id)
 
-                elif msg_type == Message.HAVE:
-                    piece_index = int.from_bytes(payload[:4], "big")
-                    LogManager.log(
-                        self.peer_id,
-                        f"Peer {self.peer_id} received the 'have' message from Peer {target_peer_id} for the piece {piece_index}.",
-                    )
-                    self.peer_manager.update_peer_bitfield(target_peer_id, piece_index)
+        elif msg_type == Message.UNCHOKE:
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} is unchoked by Peer {target_peer_id}.",
+            )
+            EventTrace.record(EventTrace.UNCHOKED, target_peer_id)
+            self.peer_manager.mark_unchoked_by(target_peer_id)
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} is requesting pieces from Peer {target_peer_id}.",
+            )
+            self.request_pieces(conn, target_peer_id)
 
-                elif msg_type == Message.PIECE:
-                    piece_index = int.from_bytes(payload[6:9], "big")
-                    piece_data = payload[9:]
-                    LogManager.log(
-                        self.peer_id,
-                        f"Extracted piece index: {piece_index}, Piece data length: {len(piece_data)}",
-                    )
-                    self.peer_manager.file_manager.save_piece(piece_index, piece_data)
-                    self.peer_manager.mark_piece_downloaded(piece_index, target_peer_id)
-                    self.trigger_have(target_peer_id, piece_index)
+        elif msg_type == Message.HAVE:
+            piece_index = Have.parse_payload(payload)
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} received the 'have' message from Peer {target_peer_id} for the piece {piece_index}.",
+            )
+            self.peer_manager.update_peer_bitfield(target_peer_id, piece_index)
+            ConnectionManager.send_interested(
+                self.peer_id, self.peer_manager, target_peer_id, [piece_index]
+            )
+            self.request_pieces(conn, target_peer_id)
 
-                elif msg_type == Message.NOT_INTERESTED:
-                    LogManager.log(
-                        self.peer_id,
-                        f"Peer {self.peer_id} received the 'not interested' message from Peer {target_peer_id}.",
-                    )
+        elif msg_type == Message.HAVE_BATCH:
+            piece_indices = HaveBatch.parse_payload(payload)
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} received the 'have' message from Peer {target_peer_id} for {len(piece_indices)} pieces.",
+            )
+            self.peer_manager.update_peer_pieces(target_peer_id, piece_indices)
+            ConnectionManager.send_interested(
+                self.peer_id, self.peer_manager, target_peer_id, piece_indices
+            )
+            self.request_pieces(conn, target_peer_id)
 
-                elif msg_type == Message.INTERESTED:
-                    LogManager.log(
-                        self.peer_id,
-                        f"Peer {self.peer_id} received the 'interested' message from Peer {target_peer_id}.",
-                    )
-                    if self.peer_manager.is_peer_choked(target_peer_id):
-                        LogManager.log(
-                            self.peer_id,
-                            f"Sending UNCHOKE message to Peer {target_peer_id}.",
-                        )
-                        ConnectionManager.send_message(
-                            self.peer_id, target_peer_id, conn, Message.UNCHOKE
-                        )
-                        self.peer_manager.mark_peer_unchoked(target_peer_id)
+        elif msg_type == Message.PIECE:
+            piece_index, begin, block_data = Piece.parse_payload(payload)
+            EventTrace.record(
+                EventTrace.PIECE_RECEIVED, target_peer_id, piece_index, len(block_data)
+            )
+            Metrics.add_download(target_peer_id, len(block_data))
+            self.peer_manager.record_download(target_peer_id, len(block_data))
+            self.cancel_duplicates(target_peer_id, piece_index, begin, len(block_data))
+            LogManager.debug(
+                self.peer_id,
+                "Extracted piece index: %s, block %s+%s",
+                piece_index,
+                begin,
+                len(block_data),
+            )
+            self.get_pipeline(target_peer_id).on_block((piece_index, begin))
+            if self.peer_manager.receive_block(
+                piece_index, begin, len(block_data), target_peer_id
+            ):
+                # store_block copies the block out of the receive buffer,
+                # which is reused for the next message.
+                piece_data = self.peer_manager.file_manager.store_block(
+                    piece_index, begin, block_data
+                )
+                if piece_data is not None:
+                    self.on_piece_assembled(conn, target_peer_id, piece_index, piece_data)
+            self.request_pieces(conn, target_peer_id)
 
-                else:
-                    LogManager.log(
-                        self.peer_id,
-                        f"Unknown message type received from Peer {target_peer_id}: {msg_type}",
-                    )
-        except Exception as e:
+        elif msg_type == Message.NOT_INTERESTED:
             LogManager.log(
                 self.peer_id,
-                f"Error processing message from Peer {target_peer_id}: {e}",
+                f"Peer {self.peer_id} received the 'not interested' message from Peer {target_peer_id}.",
             )
-        finally:
+
+        elif msg_type == Message.INTERESTED:
             LogManager.log(
-                self.peer_id, f"Closing connection with Peer {target_peer_id}."
+                self.peer_id,
+                f"Peer {self.peer_id} received the 'interested' message from Peer {target_peer_id}.",
+            )
+            # Unchoking is decided by the choking rounds and sent on the
+            # upload connection.
+            self.peer_manager.mark_peer_interested(target_peer_id)
+
+        else:
+            LogManager.log(
+                self.peer_id,
+                f"Unknown message type received from Peer {target_peer_id}: {msg_type}",
+            )
+
+    def on_piece_assembled(self, conn, target_peer_id, piece_index, piece_data):
+        sources = self.peer_manager.mark_piece_pending(piece_index)
+        if sources is None:
+            return
+        disk_io = self.peer_manager.disk_io
+        if disk_io is None:
+            try:
+                self.peer_manager.file_manager.save_piece(piece_index, piece_data)
+            except Exception as e:
+                self.on_piece_written(conn, target_peer_id, piece_index, e, sources)
+                return
+            self.on_piece_written(conn, target_peer_id, piece_index, None, sources)
+        else:
+            disk_io.write(
+                piece_index,
+                piece_data,
+                lambda index, error: self.on_piece_written(
+                    conn, target_peer_id, index, error, sources
+                ),
+            )
+
+    def on_piece_written(self, conn, target_peer_id, piece_index, error, sources=None):
+        if isinstance(error, PieceHashError):
+            self.peer_manager.mark_piece_failed(piece_index)
+            banned = self.peer_manager.record_hash_failure(
+                sources or {target_peer_id}, piece_index
+            )
+            for peer_id in banned:
+                peer_conn = self.peer_manager.connected_peers.get(peer_id, {}).get(
+                    "download_socket"
+                )
+                if peer_conn is not None:
+                    ConnectionManager.close_connection(peer_conn)
+            return
+        if error is not None:
+            LogManager.log(
+                self.peer_id,
+                f"Failed to store piece {piece_index} from Peer {target_peer_id}: {error}",
+            )
+            self.peer_manager.mark_piece_failed(piece_index)
+            return
+        self.peer_manager.mark_piece_downloaded(piece_index, target_peer_id)
+        self.trigger_have(target_peer_id, piece_index)
+        self.check_complete()
+
+    def check_complete(self):
+        if not self.peer_manager.all_pieces_downloaded():
+            return
+        for peer_id, conn in self.peer_manager.drop_interest():
+            ConnectionManager.send_message(
+                self.peer_id, peer_id, conn, Message.NOT_INTERESTED
+            )
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} sent the 'not interested' message to Peer {peer_id}.",
             )
-            conn.close()
 
     def request_pieces(self, conn, target_peer_id):
         try:
-            for piece_index in range(self.peer_manager.total_pieces):
-                with self.peer_manager.lock:
-                    if piece_index < 0 or piece_index >= self.peer_manager.total_pieces:
-                        LogManager.log(
-                            self.peer_id, f"Invalid piece index {piece_index} received."
-                        )
-                        return
-                    is_needed = self.peer_manager.bitfield[piece_index] == 0
-                    is_available = (
-                        self.peer_manager.connected_peers[target_peer_id]["bitfield"][
-                            piece_index
-                        ]
-                        == 1
-                    )
-                    is_not_choked = not self.peer_manager.is_peer_choked(target_peer_id)
-
-                    if is_needed and is_available and is_not_choked:
-                        request_message = Request.create(piece_index)
-                        ConnectionManager.send_message(
-                            self.peer_id,
-                            target_peer_id,
-                            conn,
-                            Message.REQUEST,
-                            request_message,
-                        )
-                        LogManager.log(
-                            self.peer_id,
-                            f"Peer {self.peer_id} requested piece {piece_index} from Peer {target_peer_id}.",
-                        )
-                        time.sleep(0.1)
+            # Blocks are picked under the PeerManager lock inside the pipeline;
+            # their REQUESTs are packed into one buffer and sent without it.
+            blocks = self.get_pipeline(target_peer_id).next_requests()
+            if not blocks:
+                return
+            buffer = bytearray(Request.SIZE * len(blocks))
+            offset = 0
+            for piece_index, begin, length in blocks:
+                offset = Request.pack_into(buffer, offset, piece_index, begin, length)
+                EventTrace.record(EventTrace.REQUEST_SENT, target_peer_id, piece_index)
+            ConnectionManager.send_frames(
+                self.peer_id, target_peer_id, conn, Message.REQUEST, buffer
+            )
+            LogManager.debug(
+                self.peer_id,
+                "Peer %s requested %s blocks from Peer %s.",
+                self.peer_id,
+                len(blocks),
+                target_peer_id,
+            )
         except Exception as e:
             LogManager.log(
                 self.peer_id, f"Error requesting pieces from Peer {target_peer_id}: {e}"
             )
 
+    def cancel_duplicates(self, target_peer_id, piece_index, begin, length):
+        # Withdraws endgame requests for a block that just arrived.
+        block = (piece_index, begin)
+        for peer_id in self.peer_manager.claim_request(block, target_peer_id):
+            with self.pipelines_lock:
+                pipeline = self.pipelines.get(peer_id)
+            if pipeline is None or not pipeline.cancel(block):
+                continue
+            conn = self.peer_manager.connected_peers.get(peer_id, {}).get("download_socket")
+            if conn is None:
+                continue
+            ConnectionManager.send_message(
+                self.peer_id,
+                peer_id,
+                conn,
+                Message.CANCEL,
+                Cancel.create_payload(piece_index, begin, length),
+            )
+            LogManager.debug(
+                self.peer_id,
+                "Peer %s cancelled piece %s, block %s, at Peer %s.",
+                self.peer_id,
+                piece_index,
+                begin,
+                peer_id,
+            )
+            self.request_pieces(conn, peer_id)
+
+    def expire_requests(self):
+        expired = self.peer_manager.expire_requests()
+        for target_peer_id, blocks in expired.items():
+            LogManager.log(
+                self.peer_id,
+                f"{len(blocks)} requests to Peer {target_peer_id} timed out.",
+            )
+            with self.pipelines_lock:
+                pipeline = self.pipelines.get(target_peer_id)
+            if pipeline is not None:
+                pipeline.forget(blocks)
+        if expired:
+            self.reassign()
+
+    def reassign(self, exclude=None):
+        # Offers blocks released by a choke, disconnect or timeout to every
+        # other source, least loaded first; each takes what fits its pipeline.
+        for target_peer_id, conn in self.peer_manager.get_download_sources(exclude):
+            self.request_pieces(conn, target_peer_id)
+
+    def on_download_closed(self, target_peer_id):
+        with self.pipelines_lock:
+            pipeline = self.pipelines.pop(target_peer_id, None)
+        if pipeline is not None:
+            pipeline.reset()
+        self.reassign(target_peer_id)
+
     def trigger_have(self, target_peer_id, piece_index):
-        payload = piece_index.to_bytes(4, "big")
-        for peer_id, peer_info in self.peer_manager.connected_peers.items():
+        announcer = self.peer_manager.announcer
+        if announcer is not None:
+            announcer.announce(piece_index)
+            return
+        payload = Have.create_payload(piece_index)
+        for peer_id, peer_info in list(self.peer_manager.connected_peers.items()):
             if peer_id != self.peer_id:
                 if peer_info["socket"] is not None:
                     ConnectionManager.send_message(
@@ -555,9 +1118,12 @@ class ClientListener:
                         Message.HAVE,
                         payload,
                     )
-                    LogManager.log(
+                    LogManager.debug(
                         self.peer_id,
-                        f"Peer {self.peer_id} sent 'have' message for piece {piece_index} to Peer {peer_id}.",
+                        "Peer %s sent 'have' message for piece %s to Peer %s.",
+                        self.peer_id,
+                        piece_index,
+                        peer_id,
                     )
                 else:
                     LogManager.log(
@@ -0,0 +1,168 @@
+import threading
+from collections import deque
+from utils.log_manager import LogManager
+from utils.metainfo import PieceHashError
+
+
+class DiskIO:
+    # Runs piece reads and writes on a few worker threads so socket threads
+    # never wait on the disk. Completion callbacks run on the worker thread
+    # as callback(piece_index, error), with error None on success; read
+    # callbacks also get the piece data when it came from the piece cache.
+    def __init__(
+        self,
+        peer_id,
+        file_manager,
+        workers=2,
+        max_pending_writes=64,
+        coalesce_window=0.002,
+        durable=True,
+    ):
+        self.peer_id = peer_id
+        self.file_manager = file_manager
+        self.max_pending_writes = max_pending_writes
+        self.coalesce_window = coalesce_window
+        self.durable = durable
+        self.reads = deque()
+        self.writes = deque()
+        self.pending_writes = 0
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.threads = [
+            threading.Thread(target=self._worker, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, piece_index, piece_data, callback):
+        # piece_data must not alias a buffer the caller is about to reuse.
+        with self.cond:
+            if self.stopping:
+                raise RuntimeError("Disk I/O is stopped.")
+            self.writes.append((piece_index, piece_data, callback))
+            self.pending_writes += 1
+            self.cond.notify()
+
+    def read(self, piece_index, callback, begin=0, length=None):
+        with self.cond:
+            if self.stopping:
+                raise RuntimeError("Disk I/O is stopped.")
+            self.reads.append((piece_index, callback, begin, length))
+            self.cond.notify()
+
+    def queue_depth(self):
+        with self.cond:
+            return len(self.reads) + self.pending_writes
+
+    def is_backlogged(self):
+        return self.pending_writes >= self.max_pending_writes
+
+    def throttle(self):
+        # Blocks the calling network thread while the disk is behind, so TCP
+        # flow control pushes back on the sender instead of memory growing.
+        with self.cond:
+            while self.pending_writes >= self.max_pending_writes and not self.stopping:
+                self.cond.wait()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def _next_job(self, prefer_reads):
+        with self.cond:
+            while not self.reads and not self.writes:
+                if self.stopping:
+                    return None, None
+                self.cond.wait()
+            if self.reads and (prefer_reads or not self.writes):
+                return "read", self.reads.popleft()
+            if len(self.writes) == 1 and self.coalesce_window and not self.stopping:
+                # Give a neighbouring piece a moment to arrive so both go out
+                # in one vectored write.
+                self.cond.wait(self.coalesce_window)
+                if not self.writes:
+                    return "idle", None
+            batch = list(self.writes)
+            self.writes.clear()
+            return "write", batch
+
+    def _worker(self):
+        scratch = bytearray()
+        prefer_reads = True
+        while True:
+            kind, job = self._next_job(prefer_reads)
+            if kind is None:
+                return
+            prefer_reads = not prefer_reads
+            if kind == "read":
+                self._run_read(job, scratch)
+            elif kind == "write":
+                self._run_writes(job)
+
+    def _run_read(self, job, scratch):
+        piece_index, callback, begin, length = job
+        error = None
+        piece_data = None
+        try:
+            piece_data = self.file_manager.prefetch_piece(piece_index, scratch, begin, length)
+        except Exception as e:
+            error = e
+            LogManager.log(self.peer_id, f"Error reading piece {piece_index}: {e}")
+        self._complete(callback, piece_index, error, piece_data)
+
+    def _run_writes(self, batch):
+        errors = {}
+        latest = {}
+        for piece_index, piece_data, callback in batch:
+            try:
+                # Hashing runs here, off the network threads; bad pieces never
+                # reach the file.
+                self.file_manager.verify_piece(piece_index, piece_data)
+            except Exception as e:
+                if not isinstance(e, PieceHashError):
+                    LogManager.log(self.peer_id, f"Error verifying piece {piece_index}: {e}")
+                errors[piece_index] = e
+                latest.pop(piece_index, None)
+                continue
+            errors.pop(piece_index, None)
+            latest[piece_index] = piece_data
+        runs = []
+        for piece_index in sorted(latest):
+            if runs and runs[-1][0] + len(runs[-1][1]) == piece_index:
+                runs[-1][1].append(latest[piece_index])
+            else:
+                runs.append((piece_index, [latest[piece_index]]))
+
+        for first_index, pieces in runs:
+            try:
+                self.file_manager.save_run(first_index, pieces)
+            except Exception as e:
+                LogManager.log(self.peer_id, f"Error writing pieces: {e}")
+                for i in range(len(pieces)):
+                    errors[first_index + i] = e
+        if self.durable:
+            # One sync for the whole batch before anything is announced.
+            try:
+                self.file_manager.flush()
+            except Exception as e:
+                LogManager.log(self.peer_id, f"Error flushing pieces: {e}")
+                for piece_index in latest:
+                    errors.setdefault(piece_index, e)
+
+        for piece_index, _, callback in batch:
+            self._complete(callback, piece_index, errors.get(piece_index))
+
+        with self.cond:
+            self.pending_writes -= len(batch)
+            self.cond.notify_all()
+
+    def _complete(self, callback, piece_index, error, *args):
+        try:
+            callback(piece_index, error, *args)
+        except Exception as e:
+            LogManager.log(
+                self.peer_id, f"Error in disk completion for piece {piece_index}: {e}"
+            )
@@ -0,0 +1,143 @@
+import os
+import struct
+import threading
+import time
+
+TRACE_MAGIC = b"P2PTRACE"
+TRACE_VERSION = 1
+# magic, version, local peer id, record size
+TRACE_HEADER = struct.Struct("<8sHIH")
+# time_ns, event, remote peer id, piece index (-1 if none), value
+TRACE_RECORD = struct.Struct("<QB3xIiI")
+
+
+class EventTrace:
+    CONNECT = 1
+    DISCONNECT = 2
+    CHOKED = 3
+    UNCHOKED = 4
+    CHOKE_SENT = 5
+    UNCHOKE_SENT = 6
+    REQUEST_SENT = 7
+    PIECE_RECEIVED = 8
+    PIECE_SENT = 9
+    PIECE_COMPLETED = 10
+    DOWNLOAD_COMPLETE = 11
+    START = 12
+    EVENT_NAMES = {
+        CONNECT: "connect",
+        DISCONNECT: "disconnect",
+        CHOKED: "choked",
+        UNCHOKED: "unchoked",
+        CHOKE_SENT: "choke_sent",
+        UNCHOKE_SENT: "unchoke_sent",
+        REQUEST_SENT: "request_sent",
+        PIECE_RECEIVED: "piece_received",
+        PIECE_SENT: "piece_sent",
+        PIECE_COMPLETED: "piece_completed",
+        DOWNLOAD_COMPLETE: "download_complete",
+        START: "start",
+    }
+
+    # Fixed-size records go into a preallocated ring; a flusher thread appends
+    # the unflushed part to trace_peer_<id>.bin. If the ring laps the flusher,
+    # the oldest unflushed records are lost and counted in dropped.
+    buffer = None
+    capacity = 0
+    head = 0
+    flushed = 0
+    dropped = 0
+    trace_file = None
+    flush_interval = 1.0
+    lock = threading.Lock()
+    stop_event = None
+    flusher = None
+
+    @staticmethod
+    def get_trace_file(peer_id):
+        return f"peer_{peer_id}/trace_peer_{peer_id}.bin"
+
+    @staticmethod
+    def start(peer_id, capacity=65536, flush_interval=1.0):
+        os.makedirs(f"peer_{peer_id}", exist_ok=True)
+        EventTrace.trace_file = open(EventTrace.get_trace_file(peer_id), "wb")
+        EventTrace.trace_file.write(
+            TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, peer_id, TRACE_RECORD.size)
+        )
+        EventTrace.capacity = capacity
+        EventTrace.head = EventTrace.flushed = EventTrace.dropped = 0
+        EventTrace.flush_interval = flush_interval
+        EventTrace.buffer = bytearray(capacity * TRACE_RECORD.size)
+        EventTrace.stop_event = threading.Event()
+        EventTrace.flusher = threading.Thread(target=EventTrace._run_flusher, daemon=True)
+        EventTrace.flusher.start()
+
+    @staticmethod
+    def record(event, remote_peer_id=0, piece_index=-1, value=0):
+        if EventTrace.buffer is None:
+            return
+        try:
+            with EventTrace.lock:
+                slot = EventTrace.head % EventTrace.capacity
+                TRACE_RECORD.pack_into(
+                    EventTrace.buffer,
+                    slot * TRACE_RECORD.size,
+                    time.time_ns(),
+                    event,
+                    remote_peer_id,
+                    piece_index,
+                    value,
+                )
+                EventTrace.head += 1
+        except (struct.error, TypeError):
+            pass
+
+    @staticmethod
+    def flush():
+        with EventTrace.lock:
+            if EventTrace.buffer is None:
+                return
+            head = EventTrace.head
+            start = max(EventTrace.flushed, head - EventTrace.capacity)
+            EventTrace.dropped += start - EventTrace.flushed
+            first = start % EventTrace.capacity
+            count = head - start
+            # At most two slices: up to the end of the ring, then from the start.
+            tail_count = min(count, EventTrace.capacity - first)
+            size = TRACE_RECORD.size
+            chunks = [bytes(EventTrace.buffer[first * size : (first + tail_count) * size])]
+            if count > tail_count:
+                chunks.append(bytes(EventTrace.buffer[: (count - tail_count) * size]))
+            EventTrace.flushed = head
+        for chunk in chunks:
+            EventTrace.trace_file.write(chunk)
+        EventTrace.trace_file.flush()
+
+    @staticmethod
+    def _run_flusher():
+        while not EventTrace.stop_event.wait(EventTrace.flush_interval):
+            EventTrace.flush()
+
+    @staticmethod
+    def stop():
+        if EventTrace.buffer is None:
+            return
+        EventTrace.stop_event.set()
+        EventTrace.flusher.join()
+        EventTrace.flush()
+        EventTrace.buffer = None
+        EventTrace.trace_file.close()
+        EventTrace.trace_file = None
+
+    @staticmethod
+    def read_trace(path):
+        # Returns (peer_id, records) with records as
+        # (time_ns, event, remote_peer_id, piece_index, value) tuples.
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, version, peer_id, record_size = TRACE_HEADER.unpack_from(data)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} trace file.")
+        body = memoryview(data)[TRACE_HEADER.size :]
+        usable = len(body) - len(body) % record_size
+        return peer_id, list(TRACE_RECORD.iter_unpack(body[:usable]))
@@ -1,5 +1,10 @@
 import os
+import time
+from threading import Lock
 from utils.log_manager import LogManager
+from utils.storage import create_storage
+from utils.piece_cache import PieceCache
+from utils.metainfo import PieceHashError
 
 class FileManager:
     @staticmethod
@@ -35,63 +40,232 @@ class FileManager:
             raise Exception(f"Error parsing PeerInfo.cfg: {e}")
         return peers
 
-    def __init__(self, peer_id, piece_size, file_name, total_pieces):
+    def __init__(
+        self,
+        peer_id,
+        piece_size,
+        file_name,
+        total_pieces,
+        file_size=None,
+        storage="file",
+        flush_pieces=64,
+        flush_interval=5.0,
+        cache_bytes=0,
+        metainfo=None,
+        block_size=16384,
+    ):
         self.peer_id = peer_id
         self.piece_size = piece_size
         self.file_name = file_name
         self.total_pieces = total_pieces
-        self.pieces = {}
+        self.file_size = file_size if file_size is not None else piece_size * total_pieces
+        self.saved_pieces = set()
         self.peer_dir = f"peer_{peer_id}"
         self.file_path = os.path.join(self.peer_dir, file_name)
+        self.flush_pieces = flush_pieces
+        self.flush_interval = flush_interval
+        self.unflushed_pieces = 0
+        self.last_flush = time.monotonic()
+        self.flush_lock = Lock()
+        self.cache = PieceCache(cache_bytes) if cache_bytes > 0 else None
+        self.metainfo = metainfo
+        self.block_size = max(1, min(block_size, piece_size))
+        # piece index -> [assembly buffer, bytes received] for pieces whose
+        # blocks are still arriving
+        self.partial_pieces = {}
+        self.partial_lock = Lock()
         self._initialize_directory()
-        LogManager.log(self.peer_id, "FileManager initialized.")
+        self.storage = create_storage(storage, self.file_path, self.file_size)
+        LogManager.log(self.peer_id, f"FileManager initialized with {self.storage.name} storage.")
 
     def _initialize_directory(self):
         try:
+            self.existing_size = (
+                os.path.getsize(self.file_path) if os.path.exists(self.file_path) else 0
+            )
             if not os.path.exists(self.peer_dir):
                 os.makedirs(self.peer_dir, exist_ok=True)
                 LogManager.log(self.peer_id, f"Directory created at {self.peer_dir}.")
             if not os.path.exists(self.file_path):
                 with open(self.file_path, "wb") as file:
-                    file.truncate(self.piece_size * self.total_pieces)
+                    file.truncate(self.file_size)
                 LogManager.log(self.peer_id, f"File '{self.file_name}' created at {self.file_path}.")
         except Exception as e:
             raise Exception(f"Error initializing directory or file for Peer {self.peer_id}: {e}")
 
-    def save_piece(self, piece_index, piece_data):
+    def piece_span(self, piece_index):
+        if not (0 <= piece_index < self.total_pieces):
+            raise ValueError(f"Invalid piece index {piece_index}.")
+        offset = piece_index * self.piece_size
+        return offset, max(0, min(self.piece_size, self.file_size - offset))
+
+    def block_spans(self, piece_index):
+        # (begin, length) of each block of the piece.
+        _, length = self.piece_span(piece_index)
+        return [
+            (begin, min(self.block_size, length - begin))
+            for begin in range(0, length, self.block_size)
+        ]
+
+    def store_block(self, piece_index, begin, block_data):
+        # Copies one block into the piece's assembly buffer. Returns the whole
+        # piece once its last block is in, otherwise None. Callers must not
+        # pass the same block twice.
+        _, length = self.piece_span(piece_index)
+        if begin < 0 or begin + len(block_data) > length:
+            raise ValueError(
+                f"Block at {begin} of {len(block_data)} bytes is outside piece {piece_index}."
+            )
+        if begin == 0 and len(block_data) == length:
+            return bytes(block_data)
+        with self.partial_lock:
+            entry = self.partial_pieces.get(piece_index)
+            if entry is None:
+                entry = self.partial_pieces[piece_index] = [bytearray(length), 0]
+            entry[0][begin : begin + len(block_data)] = block_data
+            entry[1] += len(block_data)
+            if entry[1] < length:
+                return None
+            del self.partial_pieces[piece_index]
+        return bytes(entry[0])
+
+    def discard_partial(self, piece_index):
+        with self.partial_lock:
+            self.partial_pieces.pop(piece_index, None)
+
+    def verify_piece(self, piece_index, piece_data):
+        if self.metainfo is None:
+            return
+        _, length = self.piece_span(piece_index)
+        if len(piece_data) != length or not self.metainfo.verify(piece_index, piece_data):
+            raise PieceHashError(f"Piece {piece_index} failed hash verification.")
+
+    def save_piece(self, piece_index, piece_data, admit=True):
         try:
-            if not (0 <= piece_index < self.total_pieces):
-                raise ValueError(f"Invalid piece index {piece_index}.")
-            self.pieces[piece_index] = piece_data
-            with open(self.file_path, "r+b") as file:
-                file.seek(piece_index * self.piece_size)
-                file.write(piece_data)
-            LogManager.log(self.peer_id, f"Piece {piece_index} saved. Size: {len(piece_data)} bytes.")
+            offset, length = self.piece_span(piece_index)
+            if len(piece_data) > length:
+                raise ValueError(
+                    f"Piece {piece_index} is {len(piece_data)} bytes, expected at most {length}."
+                )
+            self.storage.write(offset, piece_data)
+            self.saved_pieces.add(piece_index)
+            if admit and self.cache is not None:
+                # Freshly downloaded pieces are what other leechers ask for next.
+                self.cache.put(piece_index, bytes(piece_data))
+            self._maybe_flush()
+            LogManager.debug(
+                self.peer_id,
+                "Piece %s saved. Size: %s bytes.",
+                piece_index,
+                len(piece_data),
+            )
         except Exception as e:
             raise Exception(f"Error saving piece {piece_index}: {e}")
 
+    def save_run(self, first_index, pieces):
+        # Writes pieces first_index, first_index + 1, ... with one vectored write.
+        try:
+            offset, _ = self.piece_span(first_index)
+            total = 0
+            for i, piece_data in enumerate(pieces):
+                _, length = self.piece_span(first_index + i)
+                if len(piece_data) > length:
+                    raise ValueError(
+                        f"Piece {first_index + i} is {len(piece_data)} bytes, expected at most {length}."
+                    )
+                total += len(piece_data)
+            self.storage.write_many(offset, pieces)
+            for i, piece_data in enumerate(pieces):
+                self.saved_pieces.add(first_index + i)
+                if self.cache is not None:
+                    self.cache.put(first_index + i, bytes(piece_data))
+            self._maybe_flush(len(pieces))
+            LogManager.debug(
+                self.peer_id,
+                "Pieces %s-%s saved. Size: %s bytes.",
+                first_index,
+                first_index + len(pieces) - 1,
+                total,
+            )
+        except Exception as e:
+            raise Exception(f"Error saving pieces starting at {first_index}: {e}")
+
+    def prefetch_piece(self, piece_index, scratch, begin=0, length=None):
+        # Warms the page cache for one block of the piece (the whole piece by
+        # default), or loads the whole piece into the piece cache. Returns the
+        # piece from the piece cache, so the send needs no second lookup, and
+        # None without one.
+        if self.cache is not None:
+            return self.get_piece(piece_index)
+        offset, piece_length = self.piece_span(piece_index)
+        if length is None:
+            length = piece_length - begin
+        length = max(0, min(length, piece_length - begin))
+        if length:
+            self.storage.prefetch(offset + begin, length, scratch)
+        return None
+
+    def _maybe_flush(self, count=1):
+        with self.flush_lock:
+            self.unflushed_pieces += count
+            due = (
+                self.flush_pieces and self.unflushed_pieces >= self.flush_pieces
+            ) or time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        # The sync runs under the lock so a caller that finds nothing left to
+        # flush knows any sync covering its writes has already finished.
+        with self.flush_lock:
+            if self.unflushed_pieces == 0:
+                return
+            self.unflushed_pieces = 0
+            self.last_flush = time.monotonic()
+            self.storage.flush()
+
+    def fileno(self):
+        return self.storage.fileno()
+
     def get_piece(self, piece_index):
         try:
-            with open(self.file_path, "rb") as file:
-                file.seek(piece_index * self.piece_size)
-                piece_data = file.read(self.piece_size)
-                if piece_data:
-                    LogManager.log(self.peer_id, f"Piece {piece_index} retrieved.")
+            if self.cache is not None:
+                piece_data = self.cache.get(piece_index)
+                if piece_data is not None:
+                    LogManager.debug(self.peer_id, "Piece %s retrieved from cache.", piece_index)
                     return piece_data
+            offset, length = self.piece_span(piece_index)
+            if length:
+                piece_data = self.storage.read(offset, length)
+                if self.cache is not None:
+                    piece_data = bytes(piece_data)
+                    self.cache.put(piece_index, piece_data)
+                LogManager.debug(self.peer_id, "Piece %s retrieved.", piece_index)
+                return piece_data
             LogManager.log(self.peer_id, f"Piece {piece_index} not found.")
             return None
-        except FileNotFoundError:
-            LogManager.log(self.peer_id, f"File '{self.file_path}' not found.")
-            return None
         except Exception as e:
             LogManager.log(self.peer_id, f"Error retrieving piece {piece_index}: {e}")
             return None
 
+    def get_stats(self):
+        stats = {"saved_pieces": len(self.saved_pieces), "storage": self.storage.name}
+        if self.cache is not None:
+            stats["cache"] = self.cache.get_stats()
+        return stats
+
+    def close(self):
+        try:
+            self.flush()
+            self.storage.close()
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error closing storage: {e}")
+
     def reconstruct_file(self):
         try:
-            if sorted(self.pieces.keys()) != list(range(self.total_pieces)):
+            if len(self.saved_pieces) != self.total_pieces:
                 raise Exception("Missing or invalid pieces.")
-            file_data = b"".join(self.pieces[i] for i in range(self.total_pieces))
+            file_data = bytes(self.storage.read(0, self.file_size))
             LogManager.log(self.peer_id, "File reconstructed successfully.")
             return file_data
         except Exception as e:
@@ -100,15 +274,24 @@ class FileManager:
     def initialize_pieces(self, has_complete_file):
         try:
             if has_complete_file:
-                file_data = b"X" * (self.piece_size * self.total_pieces)
-                for index in range(self.total_pieces):
-                    start = index * self.piece_size
-                    end = start + self.piece_size
-                    piece_data = file_data[start:end]
-                    self.save_piece(index, piece_data)
+                # The file is served as it is on disk; nothing is rewritten.
+                if self.existing_size < self.file_size:
+                    LogManager.log(
+                        self.peer_id,
+                        f"'{self.file_path}' had {self.existing_size} of {self.file_size} bytes; "
+                        "the rest was preallocated.",
+                    )
+                self.saved_pieces = set(range(self.total_pieces))
                 LogManager.log(self.peer_id, "All pieces initialized.")
             else:
-                self.pieces = {}
+                self.saved_pieces = set()
                 LogManager.log(self.peer_id, "Initialized with empty pieces.")
         except Exception as e:
             raise Exception(f"Error initializing pieces: {e}")
+
+    def restore_pieces(self, bitfield):
+        try:
+            self.saved_pieces = set(bitfield.iter_set())
+            LogManager.log(self.peer_id, f"Restored {len(self.saved_pieces)} pieces from disk.")
+        except Exception as e:
+            raise Exception(f"Error initializing pieces: {e}")
@@ -0,0 +1,87 @@
+import struct
+from collections import deque
+from utils.message import Message
+
+_LENGTH = struct.Struct(">I")
+
+
+class FramedReader:
+    HEADER_SIZE = 4
+    INITIAL_BUFFER_SIZE = 256 * 1024
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+    # Reads length-prefixed messages from a socket into one reusable buffer.
+    # Payloads are returned as memoryviews into that buffer and stay valid
+    # only until the next call to read_message() or read_exact(). Every
+    # complete message in a read is decoded in one pass and handed out from
+    # pending before the socket is read again.
+    def __init__(self, sock, initial_size=INITIAL_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(initial_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.pending = deque()
+
+    def buffered(self):
+        return self.end - self.start
+
+    def _reserve(self, needed):
+        if self.start + needed <= len(self.buffer):
+            return
+        available = self.end - self.start
+        if needed > len(self.buffer):
+            # Payload views handed out earlier keep the old buffer alive, so
+            # growing means allocating a new one rather than resizing in place.
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[:available] = self.view[self.start : self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:available] = self.buffer[self.start : self.end]
+        self.start = 0
+        self.end = available
+
+    def _fill(self, needed):
+        self._reserve(needed)
+        while self.end - self.start < needed:
+            received = self.sock.recv_into(self.view[self.end :])
+            if received == 0:
+                if self.end > self.start:
+                    raise ConnectionError(
+                        "Connection closed before full message was received."
+                    )
+                return False
+            self.end += received
+        return True
+
+    def read_exact(self, size):
+        if not self._fill(size):
+            return None
+        data = bytes(self.view[self.start : self.start + size])
+        self._consume(size)
+        return data
+
+    def _consume(self, size):
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def read_message(self):
+        if self.pending:
+            return self.pending.popleft()
+        if self.end - self.start < self.HEADER_SIZE and not self._fill(self.HEADER_SIZE):
+            return None
+        (length,) = _LENGTH.unpack_from(self.buffer, self.start)
+        if length <= 0 or length > self.MAX_MESSAGE_SIZE:
+            raise ValueError(f"Invalid message length received: {length}")
+        frame_size = self.HEADER_SIZE + length
+        if self.end - self.start < frame_size:
+            self._fill(frame_size)
+        consumed = self.start
+        for msg_type, payload, consumed in Message.iter_messages(
+            self.view, self.start, self.end, self.MAX_MESSAGE_SIZE
+        ):
+            self.pending.append((msg_type, payload))
+        self._consume(consumed - self.start)
+        return self.pending.popleft()
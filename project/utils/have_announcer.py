@@ -0,0 +1,68 @@
+import threading
+from utils.connection import ConnectionManager
+from utils.log_manager import LogManager
+from utils.message import Message, Have, HaveBatch
+
+
+class HaveAnnouncer:
+    # Buffers completed pieces and announces them once per window: a peer
+    # gets one HAVE_BATCH for everything it is missing instead of one HAVE
+    # per piece, and nothing for pieces it already has. With a window of 0
+    # each piece is announced as soon as it completes.
+    def __init__(self, peer_id, peer_manager, window=0.05):
+        self.peer_id = peer_id
+        self.peer_manager = peer_manager
+        self.window = window
+        self.pending = []
+        self.lock = threading.Lock()
+        self.messages_sent = 0
+        self.pieces_announced = 0
+        self.pieces_suppressed = 0
+
+    def announce(self, piece_index):
+        with self.lock:
+            self.pending.append(piece_index)
+        if self.window <= 0:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pieces, self.pending = self.pending, []
+        if not pieces:
+            return
+        messages_sent = 0
+        pieces_announced = 0
+        pieces_suppressed = 0
+        for target_peer_id, conn, missing in self.peer_manager.get_have_targets(pieces):
+            pieces_suppressed += len(pieces) - len(missing)
+            if not missing:
+                continue
+            if len(missing) == 1:
+                msg_type, payload = Message.HAVE, Have.create_payload(missing[0])
+            else:
+                msg_type, payload = Message.HAVE_BATCH, HaveBatch.create_payload(missing)
+            ConnectionManager.send_message(
+                self.peer_id, target_peer_id, conn, msg_type, payload
+            )
+            messages_sent += 1
+            pieces_announced += len(missing)
+            LogManager.debug(
+                self.peer_id,
+                "Peer %s sent 'have' message for %s pieces to Peer %s.",
+                self.peer_id,
+                len(missing),
+                target_peer_id,
+            )
+        # flush() runs on several threads at once when the window is 0.
+        with self.lock:
+            self.messages_sent += messages_sent
+            self.pieces_announced += pieces_announced
+            self.pieces_suppressed += pieces_suppressed
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "messages_sent": self.messages_sent,
+                "pieces_announced": self.pieces_announced,
+                "pieces_suppressed": self.pieces_suppressed,
+            }
@@ -1,9 +1,57 @@
+import atexit
 import os
 import datetime
+import queue
+import threading
+import time
 
 
 class LogManager:
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+    LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
     log_files = {}
+    level = INFO
+    # With level DEBUG, keep one in every debug_sample debug messages.
+    debug_sample = 1
+    flush_bytes = 64 * 1024
+    flush_interval = 0.5
+    max_bytes = 10 * 1024 * 1024
+    backups = 3
+
+    # log() only enqueues; a single writer thread formats timestamps, batches
+    # lines per peer and writes them out on the size/time flush policy above.
+    _queue = queue.SimpleQueue()
+    _writer = None
+    _writer_lock = threading.Lock()
+    _files_lock = threading.Lock()
+    _file_sizes = {}
+    _debug_count = 0
+    _FLUSH = object()
+
+    @staticmethod
+    def configure(
+        level="INFO",
+        debug_sample=1,
+        flush_bytes=64 * 1024,
+        flush_interval=0.5,
+        max_bytes=10 * 1024 * 1024,
+        backups=3,
+    ):
+        if level.upper() not in LogManager.LEVELS:
+            raise ValueError(
+                f"Unknown log level '{level}'. Expected one of {sorted(LogManager.LEVELS)}."
+            )
+        LogManager.level = LogManager.LEVELS[level.upper()]
+        LogManager.debug_sample = max(1, debug_sample)
+        LogManager.flush_bytes = flush_bytes
+        LogManager.flush_interval = flush_interval
+        LogManager.max_bytes = max_bytes
+        LogManager.backups = backups
 
     @staticmethod
     def start_logger(peer_id):
@@ -12,39 +60,174 @@ class LogManager:
             log_file_path = os.path.join(log_dir, f"log_peer_{peer_id}.log")
             os.makedirs(log_dir, exist_ok=True)
             log_file = open(log_file_path, "a")
-            LogManager.log_files[peer_id] = log_file
+            with LogManager._files_lock:
+                LogManager.log_files[peer_id] = log_file
+                LogManager._file_sizes[peer_id] = log_file.tell()
+            LogManager._start_writer()
             LogManager.log(peer_id, "Logger initialized successfully.")
         except Exception as e:
             raise RuntimeError(f"Failed to start logger for Peer {peer_id}: {e}")
 
     @staticmethod
-    def log(peer_id, message):
+    def _start_writer():
+        with LogManager._writer_lock:
+            if LogManager._writer is None:
+                LogManager._writer = threading.Thread(
+                    target=LogManager._run_writer, daemon=True
+                )
+                LogManager._writer.start()
+                atexit.register(LogManager.flush)
+
+    @staticmethod
+    def log(peer_id, message, level=INFO):
+        if level < LogManager.level:
+            return
         try:
             if peer_id not in LogManager.log_files:
                 raise KeyError(f"Logger for Peer {peer_id} is not initialized.")
-            timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-            log_message = f"{timestamp} {message}\n"
-            log_file = LogManager.log_files[peer_id]
-            log_file.write(log_message)
-            log_file.flush()
+            LogManager._queue.put((peer_id, level, time.time(), message))
         except Exception as e:
             print(f"Failed to log message for Peer {peer_id}: {e}")
 
+    @staticmethod
+    def debug_enabled():
+        return LogManager.level <= LogManager.DEBUG
+
+    @staticmethod
+    def debug(peer_id, message, *args):
+        # Per-message chatter. Dropped before it is queued unless the level
+        # is DEBUG, and then sampled down by debug_sample. Callers pass a
+        # %-format string and its arguments so nothing is formatted for a
+        # message that is dropped.
+        if LogManager.level > LogManager.DEBUG:
+            return
+        if LogManager.debug_sample > 1:
+            LogManager._debug_count += 1
+            if LogManager._debug_count % LogManager.debug_sample:
+                return
+        if args:
+            message = message % args
+        LogManager.log(peer_id, message, LogManager.DEBUG)
+
+    @staticmethod
+    def warning(peer_id, message):
+        LogManager.log(peer_id, message, LogManager.WARNING)
+
+    @staticmethod
+    def error(peer_id, message):
+        LogManager.log(peer_id, message, LogManager.ERROR)
+
+    @staticmethod
+    def flush(timeout=5):
+        # Blocks until everything logged before the call is written.
+        if LogManager._writer is None or not LogManager._writer.is_alive():
+            return
+        done = threading.Event()
+        LogManager._queue.put((LogManager._FLUSH, done))
+        done.wait(timeout)
+
+    @staticmethod
+    def _run_writer():
+        pending = {}
+        pending_bytes = 0
+        last_flush = time.monotonic()
+        stamp_second = None
+        stamp = ""
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0.0, LogManager.flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = LogManager._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is not None and item[0] is LogManager._FLUSH:
+                LogManager._write_pending(pending)
+                pending = {}
+                pending_bytes = 0
+                last_flush = time.monotonic()
+                item[1].set()
+                continue
+            if item is not None:
+                peer_id, level, created, message = item
+                second = int(created)
+                if second != stamp_second:
+                    stamp_second = second
+                    stamp = datetime.datetime.fromtimestamp(second).strftime(
+                        "[%Y-%m-%d %H:%M:%S]"
+                    )
+                if level == LogManager.INFO:
+                    line = f"{stamp} {message}\n"
+                else:
+                    line = f"{stamp} {LogManager.LEVEL_NAMES.get(level, level)} {message}\n"
+                pending.setdefault(peer_id, []).append(line)
+                pending_bytes += len(line)
+                if (
+                    pending_bytes < LogManager.flush_bytes
+                    and time.monotonic() - last_flush < LogManager.flush_interval
+                ):
+                    continue
+            LogManager._write_pending(pending)
+            pending = {}
+            pending_bytes = 0
+            last_flush = time.monotonic()
+
+    @staticmethod
+    def _write_pending(pending):
+        with LogManager._files_lock:
+            for peer_id, lines in pending.items():
+                log_file = LogManager.log_files.get(peer_id)
+                if log_file is None:
+                    continue
+                try:
+                    data = "".join(lines)
+                    log_file.write(data)
+                    log_file.flush()
+                    LogManager._file_sizes[peer_id] = (
+                        LogManager._file_sizes.get(peer_id, 0) + len(data)
+                    )
+                    if LogManager.max_bytes and LogManager._file_sizes[peer_id] >= LogManager.max_bytes:
+                        LogManager._rotate(peer_id)
+                except Exception as e:
+                    print(f"Failed to write log for Peer {peer_id}: {e}")
+
+    @staticmethod
+    def _rotate(peer_id):
+        # log_peer_N.log -> .log.1 -> .log.2 ... keeping LogManager.backups files.
+        log_file_path = LogManager.get_log_file(peer_id)
+        LogManager.log_files[peer_id].close()
+        if LogManager.backups > 0:
+            for index in range(LogManager.backups - 1, 0, -1):
+                source = f"{log_file_path}.{index}"
+                if os.path.exists(source):
+                    os.replace(source, f"{log_file_path}.{index + 1}")
+            os.replace(log_file_path, f"{log_file_path}.1")
+            LogManager.log_files[peer_id] = open(log_file_path, "a")
+        else:
+            LogManager.log_files[peer_id] = open(log_file_path, "w")
+        LogManager._file_sizes[peer_id] = 0
+
     @staticmethod
     def close_logger(peer_id):
         try:
-            if peer_id in LogManager.log_files:
-                log_file = LogManager.log_files.pop(peer_id)
-                log_file.close()
+            LogManager.flush()
+            with LogManager._files_lock:
+                if peer_id in LogManager.log_files:
+                    log_file = LogManager.log_files.pop(peer_id)
+                    LogManager._file_sizes.pop(peer_id, None)
+                    log_file.close()
         except Exception as e:
             print(f"Failed to close logger for Peer {peer_id}: {e}")
 
     @staticmethod
     def close_all_loggers():
         try:
-            for log_file in LogManager.log_files.values():
-                log_file.close()
-            LogManager.log_files.clear()
+            LogManager.flush()
+            with LogManager._files_lock:
+                for log_file in LogManager.log_files.values():
+                    log_file.close()
+                LogManager.log_files.clear()
+                LogManager._file_sizes.clear()
         except Exception as e:
             print(f"Failed to close all loggers: {e}")
 
@@ -55,6 +238,7 @@ class LogManager:
     @staticmethod
     def fetch_log_tail(peer_id, num_lines=10):
         try:
+            LogManager.flush()
             log_file_path = LogManager.get_log_file(peer_id)
             with open(log_file_path, "r") as log_file:
                 return log_file.readlines()[-num_lines:]
@@ -1,7 +1,19 @@
 import logging
+import struct
 
+# Every message is a 4-byte big-endian length (type byte plus payload), the
+# type byte, and the payload. Piece indices, block offsets and lengths are
+# 32-bit big-endian integers.
+_HEADER = struct.Struct(">IB")
+_INDEX = struct.Struct(">I")
+_BLOCK = struct.Struct(">III")
+_BLOCK_START = struct.Struct(">II")
+_HAVE_MESSAGE = struct.Struct(">IBI")
+_BLOCK_MESSAGE = struct.Struct(">IBIII")
+_PIECE_HEADER = struct.Struct(">IBII")
 
-class InvalidMessageError(Exception):
+
+class InvalidMessageError(ValueError):
     def __init__(self, message="Invalid message format"):
         super().__init__(message)
         self.message = message
@@ -19,58 +31,79 @@ class Message:
     BITFIELD = 5
     REQUEST = 6
     PIECE = 7
+    CANCEL = 8
+    HAVE_ALL = 9
+    HAVE_NONE = 10
+    HAVE_BATCH = 11
+    COMPACT_BITFIELD = 12
+
+    HEADER_SIZE = _HEADER.size
+    NAMES = {
+        CHOKE: "CHOKE",
+        UNCHOKE: "UNCHOKE",
+        INTERESTED: "INTERESTED",
+        NOT_INTERESTED: "NOT_INTERESTED",
+        HAVE: "HAVE",
+        BITFIELD: "BITFIELD",
+        REQUEST: "REQUEST",
+        PIECE: "PIECE",
+        CANCEL: "CANCEL",
+        HAVE_ALL: "HAVE_ALL",
+        HAVE_NONE: "HAVE_NONE",
+        HAVE_BATCH: "HAVE_BATCH",
+        COMPACT_BITFIELD: "COMPACT_BITFIELD",
+    }
 
     @staticmethod
     def get_message_type_name(msg_type):
-        message_type_map = {
-            Message.CHOKE: "CHOKE",
-            Message.UNCHOKE: "UNCHOKE",
-            Message.INTERESTED: "INTERESTED",
-            Message.NOT_INTERESTED: "NOT_INTERESTED",
-            Message.HAVE: "HAVE",
-            Message.BITFIELD: "BITFIELD",
-            Message.REQUEST: "REQUEST",
-            Message.PIECE: "PIECE",
-        }
-        return message_type_map.get(msg_type, "UNKNOWN")
+        return Message.NAMES.get(msg_type, "UNKNOWN")
 
     @staticmethod
     def create_message(msg_type, payload=b""):
-        if not isinstance(payload, (bytes, bytearray)):
+        if not isinstance(payload, (bytes, bytearray, memoryview)):
             raise TypeError("Payload must be bytes or bytearray.")
-        try:
-            length = len(payload) + 1
-            message = length.to_bytes(4, "big") + msg_type.to_bytes(1, "big") + payload
-            logging.debug(
-                f"Created message: type={msg_type}, length={length}, payload_length={len(payload)}"
-            )
-            return message
-        except Exception as e:
-            logging.error(f"Error creating message: {e}")
-            raise
+        return _HEADER.pack(len(payload) + 1, msg_type) + payload
+
+    @staticmethod
+    def pack_into(buffer, offset, msg_type, payload=b""):
+        # Writes the message into buffer at offset and returns the offset
+        # just past it.
+        _HEADER.pack_into(buffer, offset, len(payload) + 1, msg_type)
+        offset += _HEADER.size
+        buffer[offset : offset + len(payload)] = payload
+        return offset + len(payload)
 
     @staticmethod
     def parse_message(data):
-        if len(data) < 5:
+        if len(data) < _HEADER.size:
             raise InvalidMessageError("Message too short to parse.")
-        try:
-            length = int.from_bytes(data[:4], "big")
-            msg_type = int.from_bytes(data[4:5], "big")
-            payload = data[5:]
-            if len(payload) != length - 1:
-                raise InvalidMessageError(
-                    f"Payload length mismatch: expected {length - 1}, got {len(payload)}"
-                )
-            logging.debug(
-                f"Parsed message: type={msg_type}, length={length}, payload_length={len(payload)}"
+        length, msg_type = _HEADER.unpack_from(data)
+        payload = data[_HEADER.size :]
+        if len(payload) != length - 1:
+            raise InvalidMessageError(
+                f"Payload length mismatch: expected {length - 1}, got {len(payload)}"
             )
-            return msg_type, payload
-        except InvalidMessageError as ime:
-            logging.warning(f"Invalid message encountered: {ime}")
-            raise
-        except Exception as e:
-            logging.error(f"Error parsing message: {e}")
-            raise
+        return msg_type, payload
+
+    @staticmethod
+    def iter_messages(buffer, start=0, end=None, max_length=None):
+        # Yields (msg_type, payload, next_start) for every complete message in
+        # buffer[start:end]; payloads are memoryviews into buffer. The last
+        # next_start is where the first incomplete message begins.
+        view = memoryview(buffer)
+        if end is None:
+            end = len(buffer)
+        unpack_from = _HEADER.unpack_from
+        header_size = _HEADER.size
+        while end - start >= header_size:
+            length, msg_type = unpack_from(buffer, start)
+            if length <= 0 or (max_length is not None and length > max_length):
+                raise InvalidMessageError(f"Invalid message length received: {length}")
+            frame_end = start + 4 + length
+            if frame_end > end:
+                return
+            yield msg_type, view[start + header_size : frame_end], frame_end
+            start = frame_end
 
 
 class Choke:
@@ -98,55 +131,185 @@ class NotInterested:
 
 
 class Have:
+    SIZE = _HAVE_MESSAGE.size
+
     @staticmethod
     def create(piece_index):
         if not isinstance(piece_index, int) or piece_index < 0:
             raise ValueError("Piece index must be a non-negative integer.")
+        return _HAVE_MESSAGE.pack(1 + _INDEX.size, Message.HAVE, piece_index)
+
+    @staticmethod
+    def create_payload(piece_index):
+        return _INDEX.pack(piece_index)
+
+    @staticmethod
+    def parse_payload(payload):
+        return _INDEX.unpack_from(payload)[0]
+
+
+class HaveAll:
+    @staticmethod
+    def create():
+        return Message.create_message(Message.HAVE_ALL)
+
+
+class HaveNone:
+    @staticmethod
+    def create():
+        return Message.create_message(Message.HAVE_NONE)
+
+
+class HaveBatch:
+    @staticmethod
+    def create(piece_indices):
         try:
-            payload = piece_index.to_bytes(4, "big")
-            return Message.create_message(Message.HAVE, payload)
+            return Message.create_message(
+                Message.HAVE_BATCH, HaveBatch.create_payload(piece_indices)
+            )
         except Exception as e:
-            logging.error(f"Error creating HAVE message: {e}")
+            logging.error(f"Error creating HAVE_BATCH message: {e}")
             raise
 
+    @staticmethod
+    def create_payload(piece_indices):
+        # One 4-byte piece index after another.
+        return struct.pack(f">{len(piece_indices)}I", *piece_indices)
+
+    @staticmethod
+    def parse_payload(payload):
+        if len(payload) % 4:
+            raise InvalidMessageError(
+                f"HAVE_BATCH payload of {len(payload)} bytes is not a list of piece indices."
+            )
+        return list(struct.unpack_from(f">{len(payload) // 4}I", payload))
+
+
+class CompactBitfield:
+    # Payload: one encoding byte, then the bitfield as packed bits or as run
+    # lengths. Only sent to peers whose handshake advertised the encoding.
+    PACKED = 0
+    RUN_LENGTH = 1
+
+    @staticmethod
+    def create_payload(encoding, data):
+        return encoding.to_bytes(1, "big") + data
+
+    @staticmethod
+    def parse_payload(payload):
+        if not payload:
+            raise InvalidMessageError("Empty COMPACT_BITFIELD payload.")
+        return payload[0], payload[1:]
+
 
 class Request:
+    # Payload: piece index, block offset, block length. A length of 0 asks for
+    # the rest of the piece.
+    SIZE = _BLOCK_MESSAGE.size
+
     @staticmethod
-    def create(piece_index):
+    def create(piece_index, begin=0, length=0):
+        buffer = bytearray(Request.SIZE)
+        Request.pack_into(buffer, 0, piece_index, begin, length)
+        return bytes(buffer)
+
+    @staticmethod
+    def pack_into(buffer, offset, piece_index, begin=0, length=0):
+        # Writes a whole REQUEST message; returns the offset just past it.
+        if piece_index < 0 or begin < 0 or length < 0:
+            raise ValueError("Piece index, block offset and length must be non-negative.")
+        _BLOCK_MESSAGE.pack_into(
+            buffer, offset, 1 + _BLOCK.size, Message.REQUEST, piece_index, begin, length
+        )
+        return offset + Request.SIZE
+
+    @staticmethod
+    def create_payload(piece_index, begin=0, length=0):
+        return _BLOCK.pack(piece_index, begin, length)
+
+    @staticmethod
+    def parse_payload(payload):
+        if len(payload) != _BLOCK.size:
+            raise InvalidMessageError(f"REQUEST payload of {len(payload)} bytes.")
+        return _BLOCK.unpack_from(payload)
+
+
+class Cancel:
+    # Same payload as the REQUEST being withdrawn.
+    SIZE = _BLOCK_MESSAGE.size
+
+    @staticmethod
+    def create(piece_index, begin=0, length=0):
         if not isinstance(piece_index, int) or piece_index < 0:
             raise ValueError("Piece index must be a non-negative integer.")
-        try:
-            payload = b"\x06" + piece_index.to_bytes(4, "big")
-            return Message.create_message(Message.REQUEST, payload)
-        except Exception as e:
-            logging.error(f"Error creating REQUEST message: {e}")
-            raise
+        return _BLOCK_MESSAGE.pack(
+            1 + _BLOCK.size, Message.CANCEL, piece_index, begin, length
+        )
+
+    @staticmethod
+    def create_payload(piece_index, begin=0, length=0):
+        return _BLOCK.pack(piece_index, begin, length)
+
+    @staticmethod
+    def parse_payload(payload):
+        if len(payload) != _BLOCK.size:
+            raise InvalidMessageError(f"CANCEL payload of {len(payload)} bytes.")
+        return _BLOCK.unpack_from(payload)
 
 
 class Piece:
+    # Payload: piece index, block offset, then the block data.
+    HEADER_SIZE = _PIECE_HEADER.size
+
     @staticmethod
-    def create(piece_index, piece_data):
+    def create(piece_index, piece_data, begin=0):
         if not isinstance(piece_index, int) or piece_index < 0:
             raise ValueError("Piece index must be a non-negative integer.")
-        if not isinstance(piece_data, (bytes, bytearray)):
+        if not isinstance(piece_data, (bytes, bytearray, memoryview)):
             raise TypeError("Piece data must be bytes or bytearray.")
-        try:
-            payload = piece_index.to_bytes(4, "big") + piece_data
-            return Message.create_message(Message.PIECE, payload)
-        except Exception as e:
-            logging.error(f"Error creating PIECE message: {e}")
-            raise
+        return Piece.create_header(piece_index, len(piece_data), begin) + piece_data
+
+    @staticmethod
+    def create_header(piece_index, data_length, begin=0):
+        # Everything that precedes the block data on the wire, so the data
+        # itself can be sent straight from the cache or the file.
+        if not isinstance(piece_index, int) or piece_index < 0:
+            raise ValueError("Piece index must be a non-negative integer.")
+        return _PIECE_HEADER.pack(
+            1 + _BLOCK_START.size + data_length, Message.PIECE, piece_index, begin
+        )
+
+    @staticmethod
+    def parse_payload(payload):
+        # (piece index, block offset, block data); the data is a view into
+        # payload.
+        if len(payload) < _BLOCK_START.size:
+            raise InvalidMessageError(f"PIECE payload of {len(payload)} bytes.")
+        piece_index, begin = _BLOCK_START.unpack_from(payload)
+        return piece_index, begin, payload[_BLOCK_START.size :]
 
 
 class Handshake:
     HEADER = b"P2PFILESHARINGPROJ0000000000"
+    # The last zero digit of the header carries the optional features the
+    # sender supports, as an ASCII digit; a peer without any still sends "0".
+    # A peer advertising features gets a handshake back, so both ends know
+    # what the other can decode before sending a bitfield.
+    PACKED_BITFIELD = 1
+    RLE_BITFIELD = 2
 
     @staticmethod
-    def create_handshake(peer_id):
+    def create_handshake(peer_id, features=0):
         if not (0 <= peer_id < 2**32):
             raise ValueError("Peer ID must be a 32-bit unsigned integer.")
+        if not (0 <= features <= 9):
+            raise ValueError("Handshake features must fit in one digit.")
         try:
-            return Handshake.HEADER + peer_id.to_bytes(4, "big")
+            return (
+                Handshake.HEADER[:-1]
+                + str(features).encode("ascii")
+                + peer_id.to_bytes(4, "big")
+            )
         except Exception as e:
             logging.error(f"Error creating handshake: {e}")
             raise
@@ -156,9 +319,14 @@ class Handshake:
         if len(handshake) != 32:
             raise ValueError("Invalid handshake length.")
         try:
-            if handshake[:28] != Handshake.HEADER:
+            if handshake[:27] != Handshake.HEADER[:27]:
                 raise ValueError("Invalid handshake header.")
             return int.from_bytes(handshake[28:], "big")
         except Exception as e:
             logging.error(f"Error parsing handshake: {e}")
             raise
+
+    @staticmethod
+    def parse_features(handshake):
+        digit = handshake[27]
+        return digit - ord("0") if ord("0") <= digit <= ord("9") else 0
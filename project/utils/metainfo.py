@@ -0,0 +1,127 @@
+import base64
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+HASH_NAME = "sha256"
+DIGEST_SIZE = hashlib.new(HASH_NAME).digest_size
+# Pieces hashed per pool task; large enough that pickling one result costs
+# far less than hashing the batch.
+HASH_BATCH_PIECES = 256
+
+
+class PieceHashError(Exception):
+    pass
+
+
+def _hash_pieces(file_path, piece_size, file_size, first_index, count):
+    digests = []
+    fd = os.open(file_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        for piece_index in range(first_index, first_index + count):
+            offset = piece_index * piece_size
+            length = min(piece_size, file_size - offset)
+            data = os.pread(fd, length, offset)
+            if len(data) != length:
+                raise ValueError(f"Short read for piece {piece_index}.")
+            digests.append(hashlib.new(HASH_NAME, data).digest())
+    finally:
+        os.close(fd)
+    return b"".join(digests)
+
+
+def _hash_file(file_path, piece_size, file_size, workers=None):
+    total_pieces = -(-file_size // piece_size)
+    batches = [
+        (first_index, min(HASH_BATCH_PIECES, total_pieces - first_index))
+        for first_index in range(0, total_pieces, HASH_BATCH_PIECES)
+    ]
+    if workers == 1 or len(batches) <= 1:
+        return b"".join(
+            _hash_pieces(file_path, piece_size, file_size, first, count)
+            for first, count in batches
+        )
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_hash_pieces, file_path, piece_size, file_size, first, count)
+            for first, count in batches
+        ]
+        return b"".join(future.result() for future in futures)
+
+
+class Metainfo:
+    # Per-piece SHA-256 digests of the shared file, stored concatenated in
+    # piece order like a BitTorrent "pieces" string.
+    def __init__(self, file_name, file_size, piece_size, piece_hashes):
+        self.file_name = file_name
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.piece_hashes = piece_hashes
+        self.total_pieces = -(-file_size // piece_size)
+        if len(piece_hashes) != self.total_pieces * DIGEST_SIZE:
+            raise ValueError(
+                f"Metainfo has {len(piece_hashes) // DIGEST_SIZE} piece hashes, expected {self.total_pieces}."
+            )
+
+    def piece_hash(self, piece_index):
+        if not 0 <= piece_index < self.total_pieces:
+            raise IndexError(f"Piece index {piece_index} out of range.")
+        start = piece_index * DIGEST_SIZE
+        return self.piece_hashes[start : start + DIGEST_SIZE]
+
+    def verify(self, piece_index, piece_data):
+        return hashlib.new(HASH_NAME, piece_data).digest() == self.piece_hash(piece_index)
+
+    def check_config(self, file_size, piece_size):
+        if file_size != self.file_size or piece_size != self.piece_size:
+            raise ValueError(
+                f"Metainfo describes {self.file_size} bytes in {self.piece_size}-byte pieces, "
+                f"but Common.cfg has {file_size} bytes in {piece_size}-byte pieces."
+            )
+
+    def save(self, path):
+        data = {
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "piece_size": self.piece_size,
+            "hash": HASH_NAME,
+            "pieces": base64.b64encode(self.piece_hashes).decode("ascii"),
+        }
+        with open(path, "w") as file:
+            json.dump(data, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as file:
+            data = json.load(file)
+        if data.get("hash") != HASH_NAME:
+            raise ValueError(f"Unsupported piece hash '{data.get('hash')}'.")
+        return cls(
+            data["file_name"],
+            int(data["file_size"]),
+            int(data["piece_size"]),
+            base64.b64decode(data["pieces"]),
+        )
+
+    def verify_file(self, file_path, workers=None):
+        # Hashes the whole file on a process pool; returns the failed pieces.
+        if os.path.getsize(file_path) < self.file_size:
+            raise ValueError(f"{file_path} is shorter than {self.file_size} bytes.")
+        piece_hashes = _hash_file(file_path, self.piece_size, self.file_size, workers)
+        if piece_hashes == self.piece_hashes:
+            return []
+        return [
+            piece_index
+            for piece_index in range(self.total_pieces)
+            if piece_hashes[piece_index * DIGEST_SIZE : (piece_index + 1) * DIGEST_SIZE]
+            != self.piece_hash(piece_index)
+        ]
+
+    @classmethod
+    def generate(cls, file_path, piece_size, file_name=None, workers=None):
+        file_size = os.path.getsize(file_path)
+        piece_hashes = _hash_file(file_path, piece_size, file_size, workers)
+        return cls(
+            file_name or os.path.basename(file_path), file_size, piece_size, piece_hashes
+        )
@@ -0,0 +1,236 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.log_manager import LogManager
+
+
+class RateCounter:
+    # A running total plus one bucket per second over a sliding window. Updates
+    # are plain integer adds without a lock; a racing add can at worst be lost,
+    # which is acceptable for monitoring.
+    def __init__(self, window=10):
+        self.window = window
+        self.total = 0
+        self.buckets = [0] * window
+        self.seconds = [0] * window
+        self.started = int(time.monotonic())
+
+    def add(self, amount=1):
+        second = int(time.monotonic())
+        slot = second % self.window
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.buckets[slot] = 0
+        self.buckets[slot] += amount
+        self.total += amount
+
+    def rate(self):
+        # Per-second average over the last window seconds, excluding the
+        # current, still-filling second.
+        now = int(time.monotonic())
+        total = 0
+        for slot in range(self.window):
+            if now - self.window <= self.seconds[slot] < now:
+                total += self.buckets[slot]
+        return total / max(1, min(self.window, now - self.started))
+
+
+class TimedLock:
+    # Drop-in for threading.Lock that accounts how long callers waited. The
+    # uncontended path is a single non-blocking acquire with no timing.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        self.acquisitions += 1
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.contended += 1
+        self.wait_seconds += time.perf_counter() - started
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Metrics:
+    downloaded = {}
+    uploaded = {}
+    pieces = RateCounter()
+    window = 10
+
+    @staticmethod
+    def _counter(counters, peer_id):
+        counter = counters.get(peer_id)
+        if counter is None:
+            counter = counters.setdefault(peer_id, RateCounter(Metrics.window))
+        return counter
+
+    @staticmethod
+    def add_download(peer_id, size):
+        Metrics._counter(Metrics.downloaded, peer_id).add(size)
+
+    @staticmethod
+    def add_upload(peer_id, size):
+        Metrics._counter(Metrics.uploaded, peer_id).add(size)
+
+    @staticmethod
+    def piece_completed():
+        Metrics.pieces.add()
+
+
+class MetricsServer:
+    # Serves GET /metrics in the Prometheus text exposition format. Gauges are
+    # read from the live objects at scrape time, so nothing is sampled between
+    # scrapes.
+    def __init__(self, peer_id, port, peer_manager, get_pipelines, get_writers=None, host="127.0.0.1"):
+        self.peer_id = peer_id
+        self.port = port
+        self.host = host
+        self.peer_manager = peer_manager
+        self.get_pipelines = get_pipelines
+        self.get_writers = get_writers
+        self.server = None
+
+    def start(self):
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics_server.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        LogManager.log(
+            self.peer_id, f"Metrics served on http://{self.host}:{self.server.server_port}/metrics."
+        )
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP p2p_{name} {help_text}")
+            lines.append(f"# TYPE p2p_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"p2p_{name}{{{label_text}}} {value}" if label_text else f"p2p_{name} {value}")
+
+        peer_manager = self.peer_manager
+        with peer_manager.lock:
+            peers = {
+                peer_id: (
+                    info["choked"],
+                    info["interested"],
+                    info["hash_failures"],
+                    info["choking_us"],
+                )
+                for peer_id, info in peer_manager.connected_peers.items()
+                if peer_id != peer_manager.peer_id
+            }
+            have = peer_manager.bitfield.popcount()
+            pending = len(peer_manager.pending_pieces)
+        pipelines = dict(self.get_pipelines())
+
+        downloaded = dict(Metrics.downloaded)
+        uploaded = dict(Metrics.uploaded)
+        metric("bytes_downloaded_total", "counter", "Piece bytes received from each peer.",
+               [({"peer": p}, c.total) for p, c in sorted(downloaded.items())])
+        metric("download_rate_bytes", "gauge", f"Piece bytes per second received over the last {Metrics.window}s.",
+               [({"peer": p}, f"{c.rate():.1f}") for p, c in sorted(downloaded.items())])
+        metric("bytes_uploaded_total", "counter", "Piece bytes sent to each peer.",
+               [({"peer": p}, c.total) for p, c in sorted(uploaded.items())])
+        metric("upload_rate_bytes", "gauge", f"Piece bytes per second sent over the last {Metrics.window}s.",
+               [({"peer": p}, f"{c.rate():.1f}") for p, c in sorted(uploaded.items())])
+        metric("pieces_completed_total", "counter", "Pieces verified and stored.",
+               [({}, Metrics.pieces.total)])
+        metric("pieces_per_second", "gauge", f"Pieces completed per second over the last {Metrics.window}s.",
+               [({}, f"{Metrics.pieces.rate():.2f}")])
+        metric("pieces_have", "gauge", "Pieces held.", [({}, have)])
+        metric("pieces_total", "gauge", "Pieces in the file.", [({}, peer_manager.total_pieces)])
+        metric("pieces_pending_write", "gauge", "Received pieces waiting for their disk write.", [({}, pending)])
+        metric("requests_in_flight", "gauge", "REQUESTs sent and not yet answered.",
+               [({"peer": p}, pipeline.outstanding()) for p, pipeline in sorted(pipelines.items())])
+        metric("peer_choked", "gauge", "1 if we are choking the peer.",
+               [({"peer": p}, int(state[0])) for p, state in sorted(peers.items())])
+        metric("peer_choking_us", "gauge", "1 if the peer is choking us.",
+               [({"peer": p}, int(state[3])) for p, state in sorted(peers.items())])
+        metric("peer_interested", "gauge", "1 if the peer is interested in our pieces.",
+               [({"peer": p}, int(state[1])) for p, state in sorted(peers.items())])
+        metric("peer_hash_failures_total", "counter", "Corrupt pieces received from the peer.",
+               [({"peer": p}, state[2]) for p, state in sorted(peers.items())])
+        metric("connected_peers", "gauge", "Connected remote peers.", [({}, len(peers))])
+
+        if self.get_writers is not None:
+            writers = sorted(
+                (((writer.target_peer_id, writer.direction), writer.get_stats())
+                 for writer in self.get_writers()),
+                key=lambda item: item[0],
+            )
+            metric("send_queue_bytes", "gauge", "Bytes queued for sending on each connection.",
+                   [({"peer": p, "direction": d}, stats["queued_bytes"]) for (p, d), stats in writers])
+            metric("send_syscalls_total", "counter", "sendmsg calls made for each connection.",
+                   [({"peer": p, "direction": d}, stats["syscalls"]) for (p, d), stats in writers])
+            metric("send_messages_total", "counter", "Messages sent on each connection; a packed run of REQUESTs counts once.",
+                   [({"peer": p, "direction": d}, stats["messages_sent"]) for (p, d), stats in writers])
+
+        rate_limiter = peer_manager.rate_limiter
+        if rate_limiter is not None:
+            stats = rate_limiter.get_stats()
+            metric("rate_limit_wait_seconds_total", "counter", "Time spent waiting for rate limit tokens.",
+                   [({"direction": "upload"}, f"{stats['upload_wait_seconds']:.3f}"),
+                    ({"direction": "download"}, f"{stats['download_wait_seconds']:.3f}")])
+
+        disk_io = peer_manager.disk_io
+        if disk_io is not None:
+            metric("disk_queue_depth", "gauge", "Queued disk reads and writes.", [({}, disk_io.queue_depth())])
+
+        lock = peer_manager.lock
+        if isinstance(lock, TimedLock):
+            metric("lock_acquisitions_total", "counter", "PeerManager lock acquisitions.",
+                   [({"lock": "peer_manager"}, lock.acquisitions)])
+            metric("lock_contended_total", "counter", "PeerManager lock acquisitions that had to wait.",
+                   [({"lock": "peer_manager"}, lock.contended)])
+            metric("lock_wait_seconds_total", "counter", "Time spent waiting for the PeerManager lock.",
+                   [({"lock": "peer_manager"}, f"{lock.wait_seconds:.6f}")])
+
+        cache = peer_manager.file_manager.cache
+        if cache is not None:
+            stats = cache.get_stats()
+            metric("piece_cache_hits_total", "counter", "Piece cache hits.", [({}, stats["hits"])])
+            metric("piece_cache_misses_total", "counter", "Piece cache misses.", [({}, stats["misses"])])
+            metric("piece_cache_bytes", "gauge", "Bytes held by the piece cache.", [({}, stats["size_bytes"])])
+        return "\n".join(lines) + "\n"
@@ -1,47 +1,119 @@
 from utils.log_manager import LogManager
 from utils.connection import ConnectionManager
-from utils.message import Message
-from threading import Lock
+from utils.message import Message, Handshake
+from utils.piece_picker import PiecePicker
+from utils.bitfield import BitField
+from utils.event_trace import EventTrace
+from utils.metrics import Metrics, TimedLock
+from utils.rate_limiter import RateLimiter
 import random
 import time
 
 
 class PeerManager:
-    def __init__(self, peer_id, total_pieces, file_manager):
+    def __init__(
+        self,
+        peer_id,
+        total_pieces,
+        file_manager,
+        max_hash_failures=3,
+        preferred_neighbors=3,
+        endgame=True,
+        request_timeout=30,
+        bitfield_features=Handshake.PACKED_BITFIELD | Handshake.RLE_BITFIELD,
+        send_high_water=1024 * 1024,
+    ):
         self.peer_id = peer_id
         self.total_pieces = total_pieces
         self.file_manager = file_manager
         self.connected_peers = {}
-        self.bitfield = [0] * total_pieces
+        self.bitfield = BitField(total_pieces)
         self.downloaded_pieces = set()
-        self.lock = Lock()
+        self.picker = PiecePicker(total_pieces)
+        self.pending_pieces = set()
+        self.disk_io = None
+        self.resume = None
+        self.announcer = None
+        self.rate_limiter = None
+        # Bitfield encodings advertised in our handshakes.
+        self.bitfield_features = bitfield_features
+        # Bytes queued for sending on one connection before its reader pauses.
+        self.send_high_water = send_high_water
+        self.max_hash_failures = max_hash_failures
+        self.banned_peers = set()
+        # piece index -> peers that sent a corrupt copy of it
+        self.bad_sources = {}
+        # The swarm-wide in-flight table: (piece index, block offset) ->
+        # {peer id: deadline} for every connection the block is requested on.
+        self.requested = {}
+        self.request_timeout = request_timeout
+        self.expired_requests = 0
+        # piece index -> {"missing": {block offset: length}, "sources": peers}
+        # for pieces whose blocks are being downloaded
+        self.partial = {}
+        self.endgame = endgame
+        self.in_endgame = False
+        self.duplicate_blocks = 0
+        self.preferred_neighbors_count = preferred_neighbors
+        self.preferred_neighbors = set()
+        self.optimistic_peer = None
+        # peer id -> piece bytes received from it since the last choking round
+        self.interval_downloads = {}
+        self.last_choking_round = time.monotonic()
+        self.lock = TimedLock()
 
-    def initialize_peer_bitfield(self, complete):
+    def initialize_peer_bitfield(self, complete, resumed=None):
         try:
             with self.lock:
-                self.bitfield = (
-                    [1] * self.total_pieces if complete else [0] * self.total_pieces
+                self.bitfield = BitField(self.total_pieces, complete=complete)
+                if resumed is not None:
+                    self.bitfield.update(resumed)
+                    self.downloaded_pieces.update(resumed.iter_set())
+                self.picker.reset(self.bitfield.iter_missing())
+                LogManager.log(
+                    self.peer_id,
+                    f"Bitfield initialized: {self.bitfield.popcount()}/{self.total_pieces} pieces.",
                 )
-                LogManager.log(self.peer_id, f"Bitfield initialized: {self.bitfield}")
+                if resumed is not None and len(self.downloaded_pieces) == self.total_pieces:
+                    LogManager.log(
+                        self.peer_id, "Download of complete file is complete."
+                    )
         except Exception as e:
             LogManager.log(self.peer_id, f"Error initializing bitfield: {e}")
             raise
 
-    def add_peer(self, peer_id, conn):
+    def add_peer(self, peer_id, conn, direction=None):
+        # direction is "upload" for the connection the peer dialled (we serve
+        # pieces on it) and "download" for the one we dialled.
         try:
             with self.lock:
                 if peer_id not in self.connected_peers:
                     self.connected_peers[peer_id] = {
                         "socket": conn,
-                        "bitfield": [0] * self.total_pieces,
+                        "upload_socket": None,
+                        "download_socket": None,
+                        "bitfield": BitField(self.total_pieces),
                         "status": "connected",
+                        # we are choking the peer
                         "choked": True,
+                        # the peer is choking us
+                        "choking_us": True,
                         "interested": False,
+                        "am_interested": False,
+                        "connections": 1,
+                        "hash_failures": 0,
                     }
+                    if direction is not None:
+                        self.connected_peers[peer_id][f"{direction}_socket"] = conn
+                    if peer_id != self.peer_id:
+                        EventTrace.record(EventTrace.CONNECT, peer_id)
                     LogManager.log(
                         self.peer_id, f"Added Peer {peer_id} to connections."
                     )
                 else:
+                    self.connected_peers[peer_id]["connections"] += 1
+                    if direction is not None:
+                        self.connected_peers[peer_id][f"{direction}_socket"] = conn
                     LogManager.log(self.peer_id, f"Peer {peer_id} already exists.")
         except Exception as e:
             LogManager.log(self.peer_id, f"Error adding Peer {peer_id}: {e}")
@@ -51,7 +123,19 @@ class PeerManager:
         try:
             with self.lock:
                 if peer_id in self.connected_peers:
-                    del self.connected_peers[peer_id]
+                    peer_info = self.connected_peers.pop(peer_id)
+                    self.preferred_neighbors.discard(peer_id)
+                    if self.optimistic_peer == peer_id:
+                        self.optimistic_peer = None
+                    for block in [
+                        block for block, peers in self.requested.items() if peer_id in peers
+                    ]:
+                        self._release_request(block, peer_id)
+                    if peer_id != self.peer_id:
+                        self.picker.remove_bitfield(peer_info["bitfield"])
+                        EventTrace.record(EventTrace.DISCONNECT, peer_id)
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.forget_peer(peer_id)
                     LogManager.log(self.peer_id, f"Removed Peer {peer_id}.")
                 else:
                     LogManager.log(
@@ -62,6 +146,38 @@ class PeerManager:
             LogManager.log(self.peer_id, f"Error removing Peer {peer_id}: {e}")
             raise
 
+    def disconnect_peer(self, peer_id):
+        try:
+            with self.lock:
+                peer_info = self.connected_peers.get(peer_id)
+                if peer_info is None:
+                    return
+                peer_info["connections"] -= 1
+                if peer_info["connections"] > 0:
+                    return
+            self.remove_peer(peer_id)
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error disconnecting Peer {peer_id}: {e}")
+            raise
+
+    def merge_peer_bitfield(self, peer_id, peer_bitfield):
+        try:
+            with self.lock:
+                if peer_id not in self.connected_peers:
+                    LogManager.log(self.peer_id, f"Peer {peer_id} is not connected.")
+                    return
+                current = self.connected_peers[peer_id]["bitfield"]
+                new_pieces = peer_bitfield.and_not(current)
+                for piece_index in new_pieces.iter_set():
+                    self.picker.increment(piece_index)
+                current.update(new_pieces)
+                LogManager.log(self.peer_id, f"Merged bitfield of Peer {peer_id}.")
+        except Exception as e:
+            LogManager.log(
+                self.peer_id, f"Error merging bitfield for Peer {peer_id}: {e}"
+            )
+            raise
+
     def update_peer_bitfield(self, peer_id, piece_index):
         try:
             with self.lock:
@@ -69,10 +185,15 @@ class PeerManager:
                     peer_id in self.connected_peers
                     and 0 <= piece_index < self.total_pieces
                 ):
-                    self.connected_peers[peer_id]["bitfield"][piece_index] = 1
-                    LogManager.log(
+                    peer_bitfield = self.connected_peers[peer_id]["bitfield"]
+                    if not peer_bitfield.test(piece_index):
+                        peer_bitfield.set(piece_index)
+                        self.picker.increment(piece_index)
+                    LogManager.debug(
                         self.peer_id,
-                        f"Updated bitfield of Peer {peer_id} for piece {piece_index}.",
+                        "Updated bitfield of Peer %s for piece %s.",
+                        peer_id,
+                        piece_index,
                     )
                 else:
                     LogManager.log(
@@ -85,19 +206,75 @@ class PeerManager:
             )
             raise
 
+    def update_peer_pieces(self, peer_id, piece_indices):
+        # Applies a batch of HAVEs under one lock acquisition.
+        try:
+            with self.lock:
+                peer_info = self.connected_peers.get(peer_id)
+                if peer_info is None:
+                    LogManager.log(self.peer_id, f"Peer {peer_id} is not connected.")
+                    return
+                peer_bitfield = peer_info["bitfield"]
+                for piece_index in piece_indices:
+                    if 0 <= piece_index < self.total_pieces and not peer_bitfield.test(
+                        piece_index
+                    ):
+                        peer_bitfield.set(piece_index)
+                        self.picker.increment(piece_index)
+            LogManager.debug(
+                self.peer_id,
+                "Updated bitfield of Peer %s for %s pieces.",
+                peer_id,
+                len(piece_indices),
+            )
+        except Exception as e:
+            LogManager.log(
+                self.peer_id, f"Error updating bitfield for Peer {peer_id}: {e}"
+            )
+            raise
+
+    def get_have_targets(self, piece_indices):
+        # (peer id, socket, pieces it does not have yet) for every connected
+        # peer; announcing a piece the peer already holds is wasted traffic.
+        with self.lock:
+            targets = []
+            for peer_id, peer_info in self.connected_peers.items():
+                if peer_id == self.peer_id or peer_info["socket"] is None:
+                    continue
+                peer_bitfield = peer_info["bitfield"]
+                missing = [
+                    piece_index
+                    for piece_index in piece_indices
+                    if not peer_bitfield.test(piece_index)
+                ]
+                targets.append((peer_id, peer_info["socket"], missing))
+            return targets
+
     def mark_piece_downloaded(self, piece_index, sender_peer_id=None):
         try:
             if 0 <= piece_index < self.total_pieces:
-                self.bitfield[piece_index] = 1
-                self.downloaded_pieces.add(piece_index)
+                with self.lock:
+                    self.bitfield.set(piece_index)
+                    self.downloaded_pieces.add(piece_index)
+                    self.pending_pieces.discard(piece_index)
+                    self.picker.mark_have(piece_index)
+                    self.bad_sources.pop(piece_index, None)
+                EventTrace.record(
+                    EventTrace.PIECE_COMPLETED, sender_peer_id or 0, piece_index
+                )
+                Metrics.piece_completed()
+                if self.resume is not None:
+                    self.resume.record(piece_index)
                 message = f"Downloaded piece {piece_index}."
                 if sender_peer_id:
                     message += f" Source: Peer {sender_peer_id}."
                 LogManager.log(self.peer_id, message)
                 if len(self.downloaded_pieces) == self.total_pieces:
+                    EventTrace.record(EventTrace.DOWNLOAD_COMPLETE)
                     LogManager.log(
                         self.peer_id, "Download of complete file is complete."
                     )
+                    self.log_stats()
             else:
                 LogManager.log(self.peer_id, f"Invalid piece index: {piece_index}")
         except Exception as e:
@@ -106,6 +283,107 @@ class PeerManager:
             )
             raise
 
+    def receive_block(self, piece_index, begin, length, sender_peer_id):
+        # Returns True if the block is one we are still missing; duplicates
+        # and blocks we never asked for are dropped.
+        with self.lock:
+            partial = self.partial.get(piece_index)
+            if partial is None or partial["missing"].get(begin) != length:
+                self.duplicate_blocks += 1
+                return False
+            del partial["missing"][begin]
+            partial["sources"].add(sender_peer_id)
+            return True
+
+    def mark_piece_pending(self, piece_index):
+        # A fully assembled piece waiting for its disk write: no longer
+        # requested, not yet advertised. Returns the peers that sent its
+        # blocks, or None for duplicates.
+        try:
+            with self.lock:
+                if not (0 <= piece_index < self.total_pieces):
+                    LogManager.log(self.peer_id, f"Invalid piece index: {piece_index}")
+                    return None
+                if self.bitfield.test(piece_index) or piece_index in self.pending_pieces:
+                    return None
+                self.pending_pieces.add(piece_index)
+                self.picker.mark_have(piece_index)
+                partial = self.partial.pop(piece_index, None)
+                return partial["sources"] if partial is not None else set()
+        except Exception as e:
+            LogManager.log(
+                self.peer_id, f"Error marking piece {piece_index} as pending: {e}"
+            )
+            raise
+
+    def mark_piece_failed(self, piece_index):
+        try:
+            with self.lock:
+                self.pending_pieces.discard(piece_index)
+                if not self.bitfield.test(piece_index):
+                    self.picker.mark_needed(piece_index)
+            LogManager.log(self.peer_id, f"Piece {piece_index} will be requested again.")
+        except Exception as e:
+            LogManager.log(
+                self.peer_id, f"Error marking piece {piece_index} as failed: {e}"
+            )
+            raise
+
+    def record_hash_failure(self, peer_ids, piece_index):
+        # Penalises the peers that sent the blocks of a corrupt piece. The
+        # piece is re-requested from someone else when another peer has it.
+        # Only a piece from a single peer counts towards a ban, since with
+        # several the culprit is unknown. Returns the peers now banned.
+        peer_ids = set(peer_ids)
+        try:
+            with self.lock:
+                bad_sources = self.bad_sources.setdefault(piece_index, set())
+                bad_sources.update(peer_ids)
+                failures = {}
+                for peer_id in peer_ids:
+                    peer_info = self.connected_peers.get(peer_id)
+                    if peer_info is None:
+                        continue
+                    if len(peer_ids) == 1:
+                        peer_info["hash_failures"] += 1
+                    failures[peer_id] = peer_info["hash_failures"]
+                has_alternative = any(
+                    pid != self.peer_id
+                    and pid not in bad_sources
+                    and pid not in self.banned_peers
+                    and info["bitfield"].test(piece_index)
+                    for pid, info in self.connected_peers.items()
+                )
+                if not has_alternative:
+                    # Nobody else can serve it; allow the same peers to retry.
+                    self.bad_sources.pop(piece_index, None)
+                banned = {
+                    peer_id
+                    for peer_id, count in failures.items()
+                    if count >= self.max_hash_failures
+                }
+                self.banned_peers.update(banned)
+            for peer_id in sorted(peer_ids):
+                LogManager.log(
+                    self.peer_id,
+                    f"Piece {piece_index} from Peer {peer_id} failed verification "
+                    f"({failures.get(peer_id, 0)} failures).",
+                )
+            for peer_id in sorted(banned):
+                LogManager.log(
+                    self.peer_id,
+                    f"Peer {peer_id} banned after {failures[peer_id]} corrupt pieces.",
+                )
+            return banned
+        except Exception as e:
+            LogManager.log(
+                self.peer_id, f"Error recording hash failure for piece {piece_index}: {e}"
+            )
+            raise
+
+    def is_peer_banned(self, peer_id):
+        return peer_id in self.banned_peers
+
     def get_peers_with_piece(self, piece_index):
         try:
             if 0 <= piece_index < self.total_pieces:
@@ -113,7 +391,7 @@ class PeerManager:
                     peers = [
                         peer_id
                         for peer_id, peer in self.connected_peers.items()
-                        if peer["bitfield"][piece_index] == 1
+                        if peer["bitfield"].test(piece_index)
                     ]
                 LogManager.log(self.peer_id, f"Peers with piece {piece_index}: {peers}")
                 return peers
@@ -125,6 +403,149 @@ class PeerManager:
             )
             raise
 
+    def select_blocks(self, peer_id, count, exclude=()):
+        # Picks up to count (piece index, begin, length) blocks to request from
+        # the peer: missing blocks of pieces already started first, then the
+        # blocks of new pieces, rarest first. Blocks requested from another
+        # peer are skipped until endgame, when every needed block some peer
+        # has is in flight; then they are requested here too, least
+        # duplicated first. exclude holds blocks already requested here.
+        try:
+            with self.lock:
+                peer_info = self.connected_peers.get(peer_id)
+                if peer_info is None or peer_info["choking_us"] or peer_id in self.banned_peers:
+                    return []
+                bitfield = peer_info["bitfield"]
+                bad_pieces = {
+                    piece_index
+                    for piece_index, peers in self.bad_sources.items()
+                    if peer_id in peers
+                }
+                picked = []
+                for piece_index, partial in self.partial.items():
+                    if piece_index in bad_pieces or not bitfield.test(piece_index):
+                        continue
+                    for begin, length in partial["missing"].items():
+                        block = (piece_index, begin)
+                        if block not in self.requested and block not in exclude:
+                            picked.append((piece_index, begin, length))
+                            if len(picked) >= count:
+                                break
+                    if len(picked) >= count:
+                        break
+                if len(picked) < count:
+                    blocks_per_piece = -(-self.file_manager.piece_size // self.file_manager.block_size)
+                    new_pieces = self.picker.pick(
+                        bitfield,
+                        -(-(count - len(picked)) // blocks_per_piece),
+                        bad_pieces.union(self.partial),
+                    )
+                    for piece_index in new_pieces:
+                        spans = self.file_manager.block_spans(piece_index)
+                        self.partial[piece_index] = {"missing": dict(spans), "sources": set()}
+                        for begin, length in spans[: count - len(picked)]:
+                            picked.append((piece_index, begin, length))
+                if (
+                    len(picked) < count
+                    and self.endgame
+                    and self.requested
+                    and len(self.partial) >= self.picker.available_count()
+                    and len(self.requested)
+                    >= sum(len(partial["missing"]) for partial in self.partial.values())
+                ):
+                    if not self.in_endgame:
+                        self.in_endgame = True
+                        LogManager.log(
+                            self.peer_id,
+                            f"Entering endgame with {len(self.requested)} blocks in flight.",
+                        )
+                    duplicates = sorted(
+                        (
+                            block
+                            for block, peers in self.requested.items()
+                            if peer_id not in peers
+                            and block not in exclude
+                            and block[0] not in bad_pieces
+                            and bitfield.test(block[0])
+                            # A block can still be listed for a moment after
+                            # another copy was stored.
+                            and block[1] in self.partial.get(block[0], {}).get("missing", ())
+                        ),
+                        key=lambda block: len(self.requested[block]),
+                    )
+                    picked.extend(
+                        (piece_index, begin, self.partial[piece_index]["missing"][begin])
+                        for piece_index, begin in duplicates[: count - len(picked)]
+                    )
+                deadline = (
+                    time.monotonic() + self.request_timeout
+                    if self.request_timeout > 0
+                    else float("inf")
+                )
+                for piece_index, begin, _ in picked:
+                    self.requested.setdefault((piece_index, begin), {})[peer_id] = deadline
+                return picked
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error selecting blocks for Peer {peer_id}: {e}")
+            raise
+
+    def _release_request(self, block, peer_id):
+        peers = self.requested.get(block)
+        if peers is not None:
+            peers.pop(peer_id, None)
+            if not peers:
+                del self.requested[block]
+
+    def release_requests(self, peer_id, blocks):
+        # Block requests that were choked away or whose connection closed.
+        if not blocks:
+            return
+        with self.lock:
+            for block in blocks:
+                self._release_request(block, peer_id)
+
+    def claim_request(self, block, sender_peer_id):
+        # A copy of the block arrived from sender_peer_id. Returns the other
+        # peers it is still requested from, which should be sent CANCEL.
+        with self.lock:
+            peers = set(self.requested.pop(block, {}))
+        peers.discard(sender_peer_id)
+        return peers
+
+    def expire_requests(self):
+        # Releases requests past their deadline so the blocks can go to
+        # another source. Returns {peer id: expired blocks}.
+        now = time.monotonic()
+        expired = {}
+        with self.lock:
+            for block, peers in list(self.requested.items()):
+                for peer_id, deadline in list(peers.items()):
+                    if deadline < now:
+                        expired.setdefault(peer_id, []).append(block)
+                        self._release_request(block, peer_id)
+            self.expired_requests += sum(len(blocks) for blocks in expired.values())
+        return expired
+
+    def get_download_sources(self, exclude=None):
+        # Connections that could take released blocks: peers not choking us
+        # that have a piece we need, least loaded first.
+        with self.lock:
+            load = {}
+            for peers in self.requested.values():
+                for peer_id in peers:
+                    load[peer_id] = load.get(peer_id, 0) + 1
+            sources = [
+                (load.get(peer_id, 0), peer_id, peer_info["download_socket"])
+                for peer_id, peer_info in self.connected_peers.items()
+                if peer_id != self.peer_id
+                and peer_id != exclude
+                and peer_id not in self.banned_peers
+                and not peer_info["choking_us"]
+                and peer_info.get("download_socket") is not None
+                and peer_info["bitfield"].any_and_not(self.bitfield)
+            ]
+        return [(peer_id, conn) for _, peer_id, conn in sorted(sources)]
+
     def all_pieces_downloaded(self):
         try:
             with self.lock:
@@ -177,6 +598,28 @@ class PeerManager:
             )
             raise
 
+    def mark_choked_by(self, peer_id):
+        try:
+            with self.lock:
+                if peer_id in self.connected_peers:
+                    self.connected_peers[peer_id]["choking_us"] = True
+                else:
+                    LogManager.log(self.peer_id, f"Peer {peer_id} is not connected.")
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error marking choke by Peer {peer_id}: {e}")
+            raise
+
+    def mark_unchoked_by(self, peer_id):
+        try:
+            with self.lock:
+                if peer_id in self.connected_peers:
+                    self.connected_peers[peer_id]["choking_us"] = False
+                else:
+                    LogManager.log(self.peer_id, f"Peer {peer_id} is not connected.")
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error marking unchoke by Peer {peer_id}: {e}")
+            raise
+
     def mark_peer_interested(self, peer_id):
         try:
             with self.lock:
@@ -209,6 +652,186 @@ class PeerManager:
             )
             raise
 
+    def update_interest(self, peer_id, piece_indices):
+        # Called when the peer announces pieces. Returns the socket to send
+        # INTERESTED on if they make us newly interested, else None.
+        with self.lock:
+            peer_info = self.connected_peers.get(peer_id)
+            if (
+                peer_info is None
+                or peer_info["am_interested"]
+                or peer_info["download_socket"] is None
+                or not any(
+                    0 <= piece_index < self.total_pieces
+                    and not self.bitfield.test(piece_index)
+                    and piece_index not in self.pending_pieces
+                    for piece_index in piece_indices
+                )
+            ):
+                return None
+            peer_info["am_interested"] = True
+            return peer_info["download_socket"]
+
+    def set_am_interested(self, peer_id, interested):
+        with self.lock:
+            peer_info = self.connected_peers.get(peer_id)
+            if peer_info is not None:
+                peer_info["am_interested"] = interested
+
+    def drop_interest(self):
+        # Once the download is complete nobody has anything we need. Returns
+        # (peer_id, socket) pairs to send NOT_INTERESTED on.
+        with self.lock:
+            peers = []
+            for peer_id, info in self.connected_peers.items():
+                if info["am_interested"] and info["download_socket"] is not None:
+                    info["am_interested"] = False
+                    peers.append((peer_id, info["download_socket"]))
+            return peers
+
+    def record_download(self, peer_id, size):
+        # Lock-free; a lost add under a race only skews one interval's rate.
+        self.interval_downloads[peer_id] = self.interval_downloads.get(peer_id, 0) + size
+
+    def unchoke_if_slot_free(self, peer_id):
+        # Lets a newly interested peer in right away while there is a free
+        # preferred slot instead of making it wait for the next round.
+        with self.lock:
+            peer_info = self.connected_peers.get(peer_id)
+            if peer_info is None or not peer_info["choked"] or not peer_info["interested"]:
+                return False
+            if len(self.preferred_neighbors) >= self.preferred_neighbors_count:
+                return False
+            self.preferred_neighbors.add(peer_id)
+            peer_info["choked"] = False
+            return True
+
+    def choke_if_unchoked(self, peer_id):
+        with self.lock:
+            peer_info = self.connected_peers.get(peer_id)
+            self.preferred_neighbors.discard(peer_id)
+            if peer_info is None or peer_info["choked"]:
+                return False
+            peer_info["choked"] = True
+            if self.optimistic_peer == peer_id:
+                self.optimistic_peer = None
+            return True
+
+    def select_preferred_neighbors(self):
+        # One tit-for-tat round: interested peers are ranked by the bytes they
+        # sent us during the last interval (randomly once we have the whole
+        # file) and the top preferred_neighbors_count are unchoked. Returns
+        # the (peer_id, message type, socket) changes to send.
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - self.last_choking_round, 1e-3)
+            self.last_choking_round = now
+            received = self.interval_downloads
+            self.interval_downloads = {}
+            candidates = [
+                peer_id
+                for peer_id, info in self.connected_peers.items()
+                if peer_id != self.peer_id
+                and info["interested"]
+                and info["upload_socket"] is not None
+            ]
+            # Shuffling first breaks ties between equal rates at random.
+            random.shuffle(candidates)
+            if not self.bitfield.is_complete():
+                candidates.sort(key=lambda peer_id: received.get(peer_id, 0), reverse=True)
+            preferred = set(candidates[: self.preferred_neighbors_count])
+            changes = []
+            for peer_id, info in self.connected_peers.items():
+                if peer_id == self.peer_id or info["upload_socket"] is None:
+                    continue
+                unchoke = peer_id in preferred or peer_id == self.optimistic_peer
+                if unchoke and info["choked"]:
+                    info["choked"] = False
+                    changes.append((peer_id, Message.UNCHOKE, info["upload_socket"]))
+                elif not unchoke and not info["choked"]:
+                    info["choked"] = True
+                    changes.append((peer_id, Message.CHOKE, info["upload_socket"]))
+            changed = preferred != self.preferred_neighbors
+            self.preferred_neighbors = preferred
+        if changed:
+            rates = ", ".join(
+                f"{peer_id} ({received.get(peer_id, 0) / elapsed / 1024:.1f} KiB/s)"
+                for peer_id in sorted(preferred)
+            )
+            LogManager.log(
+                self.peer_id,
+                f"Peer {self.peer_id} has the preferred neighbors [{rates}].",
+            )
+        return changes
+
+    def run_choking_round(self):
+        try:
+            for peer_id, msg_type, conn in self.select_preferred_neighbors():
+                ConnectionManager.send_message(self.peer_id, peer_id, conn, msg_type)
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error selecting preferred neighbors: {e}")
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                "downloaded_pieces": len(self.downloaded_pieces),
+                "have_pieces": self.bitfield.popcount(),
+                "total_pieces": self.total_pieces,
+                "connected_peers": len(
+                    [pid for pid in self.connected_peers if pid != self.peer_id]
+                ),
+                "duplicate_blocks": self.duplicate_blocks,
+                "partial_pieces": len(self.partial),
+                "requests_in_flight": sum(len(peers) for peers in self.requested.values()),
+                "expired_requests": self.expired_requests,
+            }
+        stats.update(self.file_manager.get_stats())
+        if self.announcer is not None:
+            stats["have"] = self.announcer.get_stats()
+        if self.rate_limiter is not None:
+            stats["rate_limit"] = self.rate_limiter.get_stats()
+        return stats
+
+    def log_stats(self):
+        try:
+            stats = self.get_stats()
+            message = (
+                f"Stats: have {stats['have_pieces']}/{stats['total_pieces']} pieces, "
+                f"{stats['connected_peers']} connected peers, "
+                f"{stats['partial_pieces']} partial pieces, "
+                f"{stats['requests_in_flight']} requests in flight, "
+                f"{stats['expired_requests']} expired, "
+                f"{stats['duplicate_blocks']} duplicate blocks"
+            )
+            have = stats.get("have")
+            if have:
+                message += (
+                    f", {have['messages_sent']} HAVE messages for "
+                    f"{have['pieces_announced']} pieces ({have['pieces_suppressed']} suppressed)"
+                )
+            rate_limit = stats.get("rate_limit")
+            if rate_limit and (rate_limit["upload_throttled"] or rate_limit["download_throttled"]):
+                message += (
+                    f", rate limit waits {rate_limit['upload_wait_seconds']:.1f} s up, "
+                    f"{rate_limit['download_wait_seconds']:.1f} s down"
+                )
+            cache = stats.get("cache")
+            if cache:
+                message += (
+                    f", piece cache hit rate {cache['hit_rate']:.1%} "
+                    f"({cache['hits']} hits, {cache['misses']} misses, "
+                    f"{cache['evictions']} evictions, {cache['size_bytes']} bytes)"
+                )
+            LogManager.log(self.peer_id, message + ".")
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error collecting stats: {e}")
+
+    def throttle_download(self, peer_id, size):
+        # Called by a connection's reader after each message; sleeping here
+        # stops reading the socket, so TCP slows the sender down.
+        if self.rate_limiter is not None:
+            self.rate_limiter.throttle(RateLimiter.DOWNLOAD, peer_id, size)
+
     def get_choked_peers(self):
         with self.lock:
             return [
@@ -217,29 +840,49 @@ class PeerManager:
                 if info["choked"]
             ]
 
-    def optimistic_unchoking(self):
-        try:
-            choked_peers = [
+    def select_optimistic_peer(self):
+        # Picks a random choked, interested peer outside the preferred set.
+        # The previous optimistic peer is choked again unless a choking round
+        # has since made it preferred. Returns the changes to send.
+        with self.lock:
+            candidates = [
                 peer_id
                 for peer_id, info in self.connected_peers.items()
-                if info["choked"] and peer_id != self.peer_id
+                if peer_id != self.peer_id
+                and info["interested"]
+                and info["choked"]
+                and info["upload_socket"] is not None
+                and peer_id not in self.preferred_neighbors
             ]
-            if not choked_peers:
-                LogManager.log(self.peer_id, "No choked peers available for optimistic unchoking.")
-                return
-
-            optimistic_peer = random.choice(choked_peers)
+            if not candidates:
+                return None, []
+            changes = []
+            previous = self.optimistic_peer
+            self.optimistic_peer = random.choice(candidates)
+            previous_info = self.connected_peers.get(previous)
+            if (
+                previous_info is not None
+                and previous not in self.preferred_neighbors
+                and not previous_info["choked"]
+            ):
+                previous_info["choked"] = True
+                changes.append((previous, Message.CHOKE, previous_info["upload_socket"]))
+            info = self.connected_peers[self.optimistic_peer]
+            info["choked"] = False
+            changes.append((self.optimistic_peer, Message.UNCHOKE, info["upload_socket"]))
+            return self.optimistic_peer, changes
 
-            self.mark_peer_unchoked(optimistic_peer)
-            ConnectionManager.send_message(
-                self.peer_id,
-                optimistic_peer,  # Target peer ID
-                self.connected_peers[optimistic_peer]["socket"],
-                Message.UNCHOKE,
-            )
+    def run_optimistic_unchoke(self):
+        try:
+            optimistic_peer, changes = self.select_optimistic_peer()
+            if optimistic_peer is None:
+                LogManager.debug(self.peer_id, "No choked peers available for optimistic unchoking.")
+                return
             LogManager.log(
                 self.peer_id,
-                f"Peer {self.peer_id} optimistically unchoked Peer {optimistic_peer}.",
+                f"Peer {self.peer_id} has the optimistically unchoked neighbor {optimistic_peer}.",
             )
+            for peer_id, msg_type, conn in changes:
+                ConnectionManager.send_message(self.peer_id, peer_id, conn, msg_type)
         except Exception as e:
             LogManager.log(self.peer_id, f"Error during optimistic unchoking: {e}")
@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class PieceCache:
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, piece_index):
+        with self.lock:
+            data = self.entries.get(piece_index)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(piece_index)
+            self.hits += 1
+            return data
+
+    def put(self, piece_index, data):
+        if len(data) > self.capacity_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(piece_index, None)
+            if previous is not None:
+                self.size_bytes -= len(previous)
+            self.entries[piece_index] = data
+            self.size_bytes += len(data)
+            while self.size_bytes > self.capacity_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def discard(self, piece_index):
+        with self.lock:
+            data = self.entries.pop(piece_index, None)
+            if data is not None:
+                self.size_bytes -= len(data)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "size_bytes": self.size_bytes,
+                "capacity_bytes": self.capacity_bytes,
+            }
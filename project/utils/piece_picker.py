@@ -0,0 +1,103 @@
+import random
+from array import array
+
+
+class PiecePicker:
+    RANDOM_PROBES = 8
+
+    def __init__(self, total_pieces):
+        self.total_pieces = total_pieces
+        self.availability = array("I", [0]) * total_pieces
+        # buckets[n] lists the pieces we still need that n peers have;
+        # positions maps a needed piece to its slot in its bucket so moves
+        # between buckets are O(1) swap-removes.
+        self.buckets = [list(range(total_pieces))]
+        self.positions = array("i", range(total_pieces))
+
+    def reset(self, needed_pieces):
+        self.buckets = [[]]
+        self.positions = array("i", [-1]) * self.total_pieces
+        for piece_index in needed_pieces:
+            self._insert(piece_index)
+
+    def available_count(self):
+        # Needed pieces that at least one connected peer has.
+        return sum(len(bucket) for bucket in self.buckets[1:])
+
+    def is_needed(self, piece_index):
+        return self.positions[piece_index] >= 0
+
+    def _insert(self, piece_index):
+        count = self.availability[piece_index]
+        while len(self.buckets) <= count:
+            self.buckets.append([])
+        bucket = self.buckets[count]
+        self.positions[piece_index] = len(bucket)
+        bucket.append(piece_index)
+
+    def _discard(self, piece_index):
+        position = self.positions[piece_index]
+        if position < 0:
+            return False
+        bucket = self.buckets[self.availability[piece_index]]
+        last = bucket.pop()
+        if last != piece_index:
+            bucket[position] = last
+            self.positions[last] = position
+        self.positions[piece_index] = -1
+        return True
+
+    def mark_have(self, piece_index):
+        self._discard(piece_index)
+
+    def mark_needed(self, piece_index):
+        if not self.is_needed(piece_index):
+            self._insert(piece_index)
+
+    def increment(self, piece_index):
+        needed = self._discard(piece_index)
+        self.availability[piece_index] += 1
+        if needed:
+            self._insert(piece_index)
+
+    def decrement(self, piece_index):
+        if self.availability[piece_index] == 0:
+            return
+        needed = self._discard(piece_index)
+        self.availability[piece_index] -= 1
+        if needed:
+            self._insert(piece_index)
+
+    def remove_bitfield(self, bitfield):
+        for piece_index in bitfield.iter_set():
+            self.decrement(piece_index)
+
+    def pick(self, peer_bitfield, count, exclude=()):
+        # Rarest first: walk the buckets from the lowest non-zero availability
+        # and take pieces the remote peer has, choosing randomly among ties.
+        picked = []
+        for bucket in self.buckets[1:]:
+            if not bucket:
+                continue
+            seen = set()
+            for _ in range(min(self.RANDOM_PROBES, len(bucket))):
+                piece_index = bucket[random.randrange(len(bucket))]
+                if piece_index in seen:
+                    continue
+                seen.add(piece_index)
+                if peer_bitfield.test(piece_index) and piece_index not in exclude:
+                    picked.append(piece_index)
+                    if len(picked) >= count:
+                        return picked
+            start = random.randrange(len(bucket))
+            for offset in range(len(bucket)):
+                piece_index = bucket[(start + offset) % len(bucket)]
+                if (
+                    piece_index not in seen
+                    and peer_bitfield.test(piece_index)
+                    and piece_index not in exclude
+                ):
+                    picked.append(piece_index)
+                    if len(picked) >= count:
+                        return picked
+        return picked
@@ -0,0 +1,132 @@
+import threading
+import time
+
+
+class TokenBucket:
+    # Refills at rate tokens (bytes) per second up to burst. A reservation
+    # larger than the tokens left is granted anyway and leaves the bucket in
+    # debt; the caller waits until the debt is repaid. Concurrent callers
+    # therefore queue up behind each other in the order they reserved.
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            else:
+                # A bucket that was unlimited starts out full.
+                self.tokens = float("inf")
+            self.updated = now
+            self.rate = max(0, rate)
+            self.burst = self.rate if burst is None else burst
+            # Carried-over debt still has to be repaid; credit is capped.
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, amount):
+        # Seconds the caller has to wait before sending amount bytes; 0 when
+        # the bucket is unlimited.
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+            self.tokens = tokens
+            self.updated = now
+            return -tokens / self.rate if tokens < 0 else 0.0
+
+
+class RateLimiter:
+    # Hierarchical limits per direction: every transfer takes tokens from the
+    # global bucket and from its peer's bucket, and waits for whichever is
+    # slower. A rate of 0 disables that bucket; with every rate at 0 a
+    # reservation returns without taking a lock. Senders block while they
+    # wait, so each connection holds at most one reservation in the global
+    # bucket and peers sharing it take turns.
+    UPLOAD = 0
+    DOWNLOAD = 1
+
+    def __init__(
+        self, upload_rate=0, download_rate=0, peer_upload_rate=0, peer_download_rate=0, burst=0.25
+    ):
+        self.lock = threading.Lock()
+        self.total = [TokenBucket(), TokenBucket()]
+        # direction -> {peer id: TokenBucket}
+        self.peers = [{}, {}]
+        self.peer_rates = [0, 0]
+        self.burst = burst
+        self.waited = [0.0, 0.0]
+        self.throttled = [0, 0]
+        self.set_limits(upload_rate, download_rate, peer_upload_rate, peer_download_rate, burst)
+
+    def set_limits(self, upload_rate, download_rate, peer_upload_rate, peer_download_rate, burst=None):
+        # Applies new limits to the running buckets; safe from any thread.
+        with self.lock:
+            if burst is not None:
+                self.burst = burst
+            rates = ((upload_rate, peer_upload_rate), (download_rate, peer_download_rate))
+            for direction, (total_rate, peer_rate) in enumerate(rates):
+                self.total[direction].set_rate(total_rate, self._burst(total_rate))
+                self.peer_rates[direction] = max(0, peer_rate)
+                for bucket in self.peers[direction].values():
+                    bucket.set_rate(peer_rate, self._burst(peer_rate))
+
+    def _burst(self, rate):
+        return max(rate * self.burst, 1)
+
+    def get_limits(self):
+        return {
+            "upload_rate": self.total[self.UPLOAD].rate,
+            "download_rate": self.total[self.DOWNLOAD].rate,
+            "peer_upload_rate": self.peer_rates[self.UPLOAD],
+            "peer_download_rate": self.peer_rates[self.DOWNLOAD],
+        }
+
+    def delay(self, direction, peer_id, amount):
+        # Takes amount tokens for peer_id and returns the seconds to wait
+        # before the bytes may go (or, when receiving, before reading more).
+        total = self.total[direction]
+        peer_rate = self.peer_rates[direction]
+        if total.rate <= 0 and peer_rate <= 0:
+            return 0.0
+        wait = total.reserve(amount)
+        if peer_rate > 0:
+            bucket = self.peers[direction].get(peer_id)
+            if bucket is None:
+                with self.lock:
+                    bucket = self.peers[direction].get(peer_id)
+                    if bucket is None:
+                        rate = self.peer_rates[direction]
+                        bucket = TokenBucket(rate, self._burst(rate))
+                        self.peers[direction][peer_id] = bucket
+            wait = max(wait, bucket.reserve(amount))
+        if wait > 0:
+            self.waited[direction] += wait
+            self.throttled[direction] += 1
+        return wait
+
+    def forget_peer(self, peer_id):
+        # Drops the peer's buckets once it disconnects; a reconnect starts
+        # with full ones.
+        with self.lock:
+            for buckets in self.peers:
+                buckets.pop(peer_id, None)
+
+    def throttle(self, direction, peer_id, amount):
+        wait = self.delay(direction, peer_id, amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    def get_stats(self):
+        return {
+            "upload_wait_seconds": self.waited[self.UPLOAD],
+            "download_wait_seconds": self.waited[self.DOWNLOAD],
+            "upload_throttled": self.throttled[self.UPLOAD],
+            "download_throttled": self.throttled[self.DOWNLOAD],
+        }
@@ -0,0 +1,91 @@
+import math
+import time
+from threading import Lock
+
+
+class RequestPipeline:
+    RTT_GAIN = 0.125
+
+    def __init__(self, peer_manager, target_peer_id, depth=10, adaptive=False, max_depth=64):
+        if depth < 1:
+            raise ValueError("Request pipeline depth must be at least 1.")
+        self.peer_manager = peer_manager
+        self.target_peer_id = target_peer_id
+        self.depth = depth
+        self.adaptive = adaptive
+        self.max_depth = max(depth, max_depth)
+        self.in_flight = {}
+        self.srtt = None
+        self.min_rtt = None
+        self.arrival_interval = None
+        self.last_arrival = None
+        self.lock = Lock()
+
+    def next_requests(self):
+        with self.lock:
+            slots = self.depth - len(self.in_flight)
+            if slots <= 0:
+                return []
+            blocks = self.peer_manager.select_blocks(
+                self.target_peer_id, slots, exclude=self.in_flight
+            )
+            now = time.monotonic()
+            for piece_index, begin, _ in blocks:
+                self.in_flight[(piece_index, begin)] = now
+            return blocks
+
+    def on_block(self, block):
+        now = time.monotonic()
+        with self.lock:
+            sent_at = self.in_flight.pop(block, None)
+            if sent_at is None:
+                return
+            rtt = now - sent_at
+            if self.srtt is None:
+                self.srtt = rtt
+                self.min_rtt = rtt
+            else:
+                self.srtt += self.RTT_GAIN * (rtt - self.srtt)
+                self.min_rtt = min(self.min_rtt, rtt)
+            if self.last_arrival is not None:
+                interval = now - self.last_arrival
+                if self.arrival_interval is None:
+                    self.arrival_interval = interval
+                else:
+                    self.arrival_interval += self.RTT_GAIN * (
+                        interval - self.arrival_interval
+                    )
+            self.last_arrival = now
+            if self.adaptive:
+                self._adapt_depth()
+
+    def _adapt_depth(self):
+        # Keep roughly two bandwidth-delay products outstanding: the delivery
+        # rate times the unloaded round trip is what the link can hold.
+        if not self.arrival_interval or self.min_rtt is None:
+            return
+        target = math.ceil(2 * self.min_rtt / self.arrival_interval) + 1
+        self.depth = max(1, min(self.max_depth, target))
+
+    def forget(self, blocks):
+        # Drops blocks the coordinator took back, e.g. past their deadline,
+        # so their slots can be reissued.
+        with self.lock:
+            for block in blocks:
+                self.in_flight.pop(block, None)
+
+    def cancel(self, block):
+        # Another peer delivered the block first.
+        with self.lock:
+            return self.in_flight.pop(block, None) is not None
+
+    def reset(self):
+        with self.lock:
+            released = list(self.in_flight)
+            self.in_flight.clear()
+            self.last_arrival = None
+        self.peer_manager.release_requests(self.target_peer_id, released)
+
+    def outstanding(self):
+        with self.lock:
+            return len(self.in_flight)
@@ -0,0 +1,203 @@
+import base64
+import json
+import os
+import struct
+from threading import Lock
+from utils.log_manager import LogManager
+from utils.bitfield import BitField
+
+RESUME_VERSION = 1
+_INDEX = struct.Struct(">I")
+
+
+class ResumeState:
+    # Fast-resume for a partially downloaded file. A checkpoint holds the
+    # bitfield of pieces that were verified and synced to disk; it is rewritten
+    # through a temp file and os.replace so a crash leaves either the old or the
+    # new checkpoint, never a torn one. Pieces completed since the checkpoint
+    # are appended to a small journal and are the only ones rechecked on start.
+    def __init__(
+        self,
+        peer_id,
+        file_manager,
+        get_bitfield,
+        checkpoint_pieces=64,
+        checkpoint_interval=5.0,
+    ):
+        self.peer_id = peer_id
+        self.file_manager = file_manager
+        self.get_bitfield = get_bitfield
+        self.checkpoint_pieces = checkpoint_pieces
+        self.checkpoint_interval = checkpoint_interval
+        self.path = f"{file_manager.file_path}.resume"
+        self.journal_path = f"{self.path}.journal"
+        self.journal_fd = None
+        self.recorded_pieces = 0
+        self.lock = Lock()
+
+    def load(self):
+        # Returns the BitField of pieces already on disk.
+        total_pieces = self.file_manager.total_pieces
+        bitfield = BitField(total_pieces)
+        try:
+            with open(self.path, "r") as file:
+                state = json.load(file)
+            if (
+                state.get("version") != RESUME_VERSION
+                or state.get("file_size") != self.file_manager.file_size
+                or state.get("piece_size") != self.file_manager.piece_size
+            ):
+                LogManager.log(self.peer_id, "Resume checkpoint does not match this file; ignoring it.")
+            else:
+                bitfield = self._check_file(
+                    BitField.from_bytes(base64.b64decode(state["bitfield"]), total_pieces)
+                )
+        except FileNotFoundError:
+            LogManager.log(self.peer_id, "No resume checkpoint found.")
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error reading resume checkpoint: {e}")
+        checkpointed = bitfield.popcount()
+
+        rechecked = 0
+        for piece_index in self._read_journal(total_pieces):
+            if bitfield.test(piece_index):
+                continue
+            if self._recheck(piece_index):
+                bitfield.set(piece_index)
+                rechecked += 1
+        LogManager.log(
+            self.peer_id,
+            f"Resumed {checkpointed} checkpointed and {rechecked} rechecked pieces "
+            f"({bitfield.popcount()}/{total_pieces}).",
+        )
+        return bitfield
+
+    def load_trusted(self):
+        # For a peer that starts with the complete file: returns the
+        # checkpointed BitField only if the file has not been modified since
+        # the checkpoint was written, otherwise None.
+        try:
+            with open(self.path, "r") as file:
+                state = json.load(file)
+            stat = os.stat(self.file_manager.file_path)
+            if (
+                state.get("version") != RESUME_VERSION
+                or state.get("file_size") != self.file_manager.file_size
+                or state.get("piece_size") != self.file_manager.piece_size
+                or state.get("file_mtime_ns") != stat.st_mtime_ns
+                or stat.st_size != self.file_manager.file_size
+            ):
+                LogManager.log(self.peer_id, "Resume record is stale; the file will be rechecked.")
+                return None
+            bitfield = BitField.from_bytes(
+                base64.b64decode(state["bitfield"]), self.file_manager.total_pieces
+            )
+            LogManager.log(
+                self.peer_id,
+                f"Trusted resume record: {bitfield.popcount()}/{bitfield.total_pieces} pieces.",
+            )
+            return bitfield
+        except FileNotFoundError:
+            LogManager.log(self.peer_id, "No resume record found.")
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error reading resume record: {e}")
+        return None
+
+    def _check_file(self, bitfield):
+        # The checkpoint only describes the data file it was written for; a
+        # file that was missing or resized at startup invalidates it. The
+        # file's mtime is no check here: pieces written after the last
+        # checkpoint change it, and those are the journaled ones load()
+        # rechecks anyway.
+        if self.file_manager.existing_size != self.file_manager.file_size:
+            LogManager.log(
+                self.peer_id,
+                "Data file is missing or has the wrong size; ignoring the resume checkpoint.",
+            )
+            return BitField(self.file_manager.total_pieces)
+        return bitfield
+
+    def _read_journal(self, total_pieces):
+        try:
+            with open(self.journal_path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return []
+        # A torn final record from a crash is ignored.
+        usable = len(data) - len(data) % _INDEX.size
+        return sorted(
+            {
+                piece_index
+                for (piece_index,) in _INDEX.iter_unpack(data[:usable])
+                if piece_index < total_pieces
+            }
+        )
+
+    def _recheck(self, piece_index):
+        # Journal entries may point at data that never reached the disk, so
+        # they are only trusted once the piece hash matches.
+        if self.file_manager.metainfo is None:
+            return False
+        offset, length = self.file_manager.piece_span(piece_index)
+        piece_data = self.file_manager.storage.read(offset, length)
+        return self.file_manager.metainfo.verify(piece_index, piece_data)
+
+    def record(self, piece_index):
+        try:
+            with self.lock:
+                if self.journal_fd is None:
+                    self.journal_fd = os.open(
+                        self.journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+                    )
+                os.write(self.journal_fd, _INDEX.pack(piece_index))
+                self.recorded_pieces += 1
+                due = self.checkpoint_pieces and self.recorded_pieces >= self.checkpoint_pieces
+            if due:
+                self.checkpoint()
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error recording piece {piece_index} for resume: {e}")
+
+    def checkpoint(self, bitfield=None):
+        try:
+            with self.lock:
+                if bitfield is None:
+                    bitfield = self.get_bitfield()
+                # The checkpoint must never claim a piece whose data could
+                # still be lost in a crash.
+                self.file_manager.flush()
+                state = {
+                    "version": RESUME_VERSION,
+                    "file_size": self.file_manager.file_size,
+                    "piece_size": self.file_manager.piece_size,
+                    "file_mtime_ns": os.stat(self.file_manager.file_path).st_mtime_ns,
+                    "bitfield": base64.b64encode(bitfield.to_bytes()).decode("ascii"),
+                }
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, "w") as file:
+                    json.dump(state, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+                if self.journal_fd is not None:
+                    os.ftruncate(self.journal_fd, 0)
+                self.recorded_pieces = 0
+            LogManager.log(
+                self.peer_id,
+                f"Resume checkpoint written: {bitfield.popcount()}/{bitfield.total_pieces} pieces.",
+            )
+        except Exception as e:
+            LogManager.log(self.peer_id, f"Error writing resume checkpoint: {e}")
+
+    def checkpoint_if_dirty(self):
+        # Scheduled every checkpoint_interval, so a slow trickle of pieces
+        # still reaches a checkpoint.
+        if self.recorded_pieces:
+            self.checkpoint()
+
+    def close(self):
+        if self.recorded_pieces:
+            self.checkpoint()
+        with self.lock:
+            if self.journal_fd is not None:
+                os.close(self.journal_fd)
+                self.journal_fd = None
@@ -0,0 +1,105 @@
+import heapq
+import random
+import threading
+import time
+from utils.log_manager import LogManager
+
+
+class Scheduler:
+    # Runs every periodic job on one thread, from a heap ordered by due time.
+    # A job's n-th run is due at start + n * interval plus a fresh jitter, so
+    # a late or slow run never shifts the runs after it. Runs that fall
+    # entirely behind are skipped rather than run back to back.
+    def __init__(self, peer_id):
+        self.peer_id = peer_id
+        self.jobs = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def every(self, name, interval, func, jitter=0.1, delay=None):
+        # jitter is a fraction of the interval; delay defaults to one interval.
+        if interval <= 0:
+            raise ValueError(f"Interval of job '{name}' must be positive.")
+        job = {
+            "name": name,
+            "interval": interval,
+            "func": func,
+            "jitter": min(max(jitter, 0.0), 0.5),
+            "base": time.monotonic() + (interval if delay is None else delay),
+            "runs": 0,
+            "skipped": 0,
+            "max_lateness": 0.0,
+        }
+        with self.condition:
+            self._push(job)
+            self.condition.notify()
+        return job
+
+    def _push(self, job):
+        due = job["base"] + random.uniform(-job["jitter"], job["jitter"]) * job["interval"]
+        self.sequence += 1
+        heapq.heappush(self.jobs, (due, self.sequence, job))
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _next_due(self):
+        with self.condition:
+            while self.running:
+                if not self.jobs:
+                    self.condition.wait()
+                    continue
+                due, _, job = self.jobs[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.jobs)
+                job["max_lateness"] = max(job["max_lateness"], -wait)
+                return job
+            return None
+
+    def _run(self):
+        while True:
+            job = self._next_due()
+            if job is None:
+                return
+            try:
+                job["func"]()
+            except Exception as e:
+                LogManager.log(self.peer_id, f"Error in scheduled job '{job['name']}': {e}")
+            job["runs"] += 1
+            with self.condition:
+                job["base"] += job["interval"]
+                behind = time.monotonic() - job["base"]
+                if behind > 0:
+                    missed = int(behind // job["interval"]) + 1
+                    job["base"] += missed * job["interval"]
+                    job["skipped"] += missed
+                self._push(job)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                job["name"]: {
+                    "interval": job["interval"],
+                    "runs": job["runs"],
+                    "skipped": job["skipped"],
+                    "max_lateness": job["max_lateness"],
+                }
+                for _, _, job in self.jobs
+            }
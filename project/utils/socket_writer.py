@@ -0,0 +1,207 @@
+import socket
+import threading
+import time
+from collections import deque
+from utils.log_manager import LogManager
+from utils.rate_limiter import RateLimiter
+
+
+class SocketWriter:
+    # Owns the sending side of one connection. Senders queue whole messages
+    # and return; one thread writes them out, control messages ahead of
+    # queued PIECE data, gathering what is queued into one sendmsg call. A
+    # part of a message can also be a callable that writes to the socket
+    # itself, such as a sendfile range. With a rate limiter the PIECE data in
+    # each batch waits for its upload tokens; control messages never do.
+    MAX_BATCH_BUFFERS = 512
+    MAX_BATCH_BYTES = 256 * 1024
+
+    def __init__(
+        self,
+        peer_id,
+        target_peer_id,
+        sock,
+        direction=None,
+        high_water=1024 * 1024,
+        low_water=None,
+        rate_limiter=None,
+    ):
+        self.peer_id = peer_id
+        self.target_peer_id = target_peer_id
+        self.sock = sock
+        # "upload" or "download", for stats
+        self.direction = direction
+        self.high_water = high_water
+        self.low_water = high_water // 2 if low_water is None else low_water
+        self.rate_limiter = rate_limiter
+        self.control = deque()
+        self.bulk = deque()
+        self.queued_bytes = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.syscalls = 0
+        self.peak_queued_bytes = 0
+        self.stalls = 0
+        try:
+            # Messages are already gathered here, so Nagle would only add delay.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
+            pass
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send(self, parts, bulk=False, size=None):
+        if size is None:
+            size = sum(len(part) for part in parts)
+        with self.condition:
+            if self.closed:
+                raise BrokenPipeError("Connection writer is closed.")
+            (self.bulk if bulk else self.control).append((parts, size))
+            self.queued_bytes += size
+            self.peak_queued_bytes = max(self.peak_queued_bytes, self.queued_bytes)
+            self.condition.notify_all()
+
+    def wait_for_space(self, timeout=None):
+        # Blocks while more than high_water bytes are queued, until the queue
+        # has drained to low_water or the writer closes.
+        with self.condition:
+            if self.queued_bytes <= self.high_water:
+                return True
+            self.stalls += 1
+            return self.condition.wait_for(
+                lambda: self.closed or self.queued_bytes <= self.low_water, timeout
+            )
+
+    def close(self):
+        # Drops whatever is still queued. shutdown() also wakes the writer
+        # thread if it is blocked on a peer that stopped reading.
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.control.clear()
+            self.bulk.clear()
+            self.queued_bytes = 0
+            self.condition.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _take(self, bulk=True):
+        # Returns (control batch, bulk batch, bulk size), control messages
+        # first; with bulk False only control messages are taken.
+        with self.condition:
+            while not self.closed and not self.control and not (bulk and self.bulk):
+                self.condition.wait()
+            if self.closed:
+                return None
+            control = []
+            bulk_batch = []
+            buffers = 0
+            size = 0
+            queues = [(self.control, control)]
+            if bulk:
+                queues.append((self.bulk, bulk_batch))
+            for queue, batch in queues:
+                while queue and buffers < self.MAX_BATCH_BUFFERS and size < self.MAX_BATCH_BYTES:
+                    parts, part_size = queue.popleft()
+                    batch.append((parts, part_size))
+                    buffers += len(parts)
+                    size += part_size
+            return control, bulk_batch, sum(part_size for _, part_size in bulk_batch)
+
+    def _write(self, buffers):
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(buffers))
+            self.syscalls += 1
+            return
+        first = 0
+        while first < len(buffers):
+            sent = self.sock.sendmsg(buffers[first : first + self.MAX_BATCH_BUFFERS])
+            self.syscalls += 1
+            # Skip the buffers written in full and trim a partly written one.
+            while sent:
+                length = len(buffers[first])
+                if sent < length:
+                    buffers[first] = memoryview(buffers[first])[sent:]
+                    break
+                sent -= length
+                first += 1
+
+    def _send(self, batch):
+        buffers = []
+        for parts, _ in batch:
+            for part in parts:
+                if callable(part):
+                    self._write(buffers)
+                    buffers = []
+                    part(self.sock)
+                elif len(part):
+                    buffers.append(part)
+        self._write(buffers)
+        size = sum(part_size for _, part_size in batch)
+        with self.condition:
+            if not self.closed:
+                self.queued_bytes -= size
+            self.messages_sent += len(batch)
+            self.bytes_sent += size
+            self.condition.notify_all()
+
+    def _wait_for_tokens(self, wait):
+        # Sleeps out a bulk reservation, writing control messages that are
+        # queued meanwhile instead of holding them behind the PIECE data.
+        deadline = time.monotonic() + wait
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.control, remaining)
+                if self.closed:
+                    return
+                if not self.control:
+                    continue
+            taken = self._take(bulk=False)
+            if taken is None:
+                return
+            self._send(taken[0])
+
+    def _run(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                return
+            control, bulk, bulk_size = taken
+            try:
+                # Only PIECE data is charged to the upload limit.
+                if control:
+                    self._send(control)
+                if bulk:
+                    if self.rate_limiter is not None:
+                        wait = self.rate_limiter.delay(
+                            RateLimiter.UPLOAD, self.target_peer_id, bulk_size
+                        )
+                        if wait > 0:
+                            self._wait_for_tokens(wait)
+                    self._send(bulk)
+            except Exception as e:
+                if not self.closed:
+                    LogManager.log(
+                        self.peer_id, f"Error sending to Peer {self.target_peer_id}: {e}"
+                    )
+                self.close()
+                return
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "queued_bytes": self.queued_bytes,
+                "peak_queued_bytes": self.peak_queued_bytes,
+                "messages_sent": self.messages_sent,
+                "bytes_sent": self.bytes_sent,
+                "syscalls": self.syscalls,
+                "stalls": self.stalls,
+            }
@@ -0,0 +1,123 @@
+import mmap
+import os
+
+
+class FileStorage:
+    name = "file"
+
+    def __init__(self, file_path, size):
+        self.file_path = file_path
+        self.size = size
+        self.fd = os.open(file_path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def write_many(self, offset, buffers):
+        if hasattr(os, "pwritev"):
+            views = [memoryview(buffer) for buffer in buffers]
+            written = os.pwritev(self.fd, views, offset)
+            total = sum(len(view) for view in views)
+            if written == total:
+                return
+            # Short vectored write: finish the remainder buffer by buffer.
+            for view in views:
+                if written >= len(view):
+                    written -= len(view)
+                    offset += len(view)
+                    continue
+                self.write(offset + written, view[written:])
+                offset += len(view)
+                written = 0
+            return
+        for buffer in buffers:
+            self.write(offset, buffer)
+            offset += len(buffer)
+
+    def prefetch(self, offset, length, scratch):
+        # Pull the range into the page cache so a later sendfile/pread of it
+        # does not wait on the disk; scratch is a reusable bytearray.
+        if hasattr(os, "preadv"):
+            if len(scratch) < length:
+                scratch.extend(bytes(length - len(scratch)))
+            os.preadv(self.fd, [memoryview(scratch)[:length]], offset)
+        else:
+            os.pread(self.fd, length, offset)
+
+    def flush(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MmapStorage(FileStorage):
+    name = "mmap"
+
+    # The whole file is mapped once; reads are memoryview slices of the
+    # mapping and writes are slice assignments, so piece data never has to
+    # live on the Python heap. flush() is an msync of the mapping.
+    def __init__(self, file_path, size):
+        super().__init__(file_path, size)
+        self.map = mmap.mmap(self.fd, size) if size else None
+        self.view = memoryview(self.map) if size else memoryview(b"")
+
+    def read(self, offset, length):
+        return self.view[offset : offset + length]
+
+    def write(self, offset, data):
+        self.view[offset : offset + len(data)] = data
+
+    def write_many(self, offset, buffers):
+        for buffer in buffers:
+            self.write(offset, buffer)
+            offset += len(buffer)
+
+    def prefetch(self, offset, length, scratch):
+        # Touch one byte per page to fault the range in.
+        bytes(self.view[offset : offset + length : mmap.PAGESIZE])
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.view.release()
+            try:
+                self.map.close()
+            except BufferError:
+                # A caller still holds a slice from read(); the mapping is
+                # released when that view goes away.
+                pass
+            self.map = None
+        super().close()
+
+
+STORAGE_BACKENDS = {
+    FileStorage.name: FileStorage,
+    MmapStorage.name: MmapStorage,
+}
+
+
+def create_storage(backend, file_path, size):
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"Unknown storage backend '{backend}'. Expected one of {sorted(STORAGE_BACKENDS)}."
+        )
+    return STORAGE_BACKENDS[backend](file_path, size)